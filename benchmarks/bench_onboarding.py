@@ -0,0 +1,376 @@
+"""Offline benchmarks for the bot's setup commands and onboarding flow.
+
+Runs the real handlers from ncaa_discord_bot.py against a fake guild and HTTP layer
+(see fake_discord.py) and reports wall time, REST calls per route, 429s and peak memory
+for each scenario at each guild size. Results are written as JSON so runs can be compared.
+
+The sync_team_emojis scenarios serve generated logos from a local HTTP server and work on a
+temporary copy of the teams JSON; the rerun should upload nothing.
+
+The nickname_rejected scenario is nickname_flow with Discord refusing one step of every
+change (the #general overwrite with --mode overwrites, the member edit otherwise), and reports
+how many steps the journal undid: only the ones that had been applied.
+
+The join_after_rules scenario queues each new member's rules job before their join job (the
+order a crash replay or a slow join can produce), then asks for the Unverified stage again
+directly; stage_conflicts counts members left holding more than one stage role.
+
+The startup scenario runs in its own process and also reports the time until on_ready
+returns and resident memory before and after; compare it with and without --low-memory.
+
+Usage:
+    python benchmarks/bench_onboarding.py --members 100,1000,10000,50000 --channels 20,60,200
+    python benchmarks/bench_onboarding.py --scenarios member_join,nickname_flow --output results.json
+    python benchmarks/bench_onboarding.py --scenarios startup --members 50000 --low-memory
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import struct
+import sys
+import time
+import tracemalloc
+import zlib
+
+from aiohttp import web
+
+import discord
+
+from fake_discord import Harness
+
+SCENARIOS = ['startup', 'ready', 'setup_permissions', 'setup_permissions_rerun', 'setup_team_roles',
+             'member_join', 'rules_reaction', 'join_after_rules', 'nickname_flow', 'nickname_rejected',
+             'sync_team_emojis', 'sync_team_emojis_rerun']
+
+
+async def scenario_startup(h, args):
+    # GUILD_CREATE, then on_ready; in low-memory mode the members download in the background
+    start = time.perf_counter()
+    h.guild = h.server.install()
+    await h.mod.on_ready()
+    h.ready_s = time.perf_counter() - start
+
+
+async def scenario_ready(h, args):
+    await h.mod.on_ready()
+
+
+async def prepare_setup_permissions_rerun(h, args):
+    await h.mod.setup_permissions.callback(h.context())
+    await h.settle()
+
+
+async def scenario_setup_permissions(h, args):
+    await h.mod.setup_permissions.callback(h.context())
+
+
+async def scenario_setup_team_roles(h, args):
+    await h.mod.setup_team_roles.callback(h.context())
+
+
+async def scenario_member_join(h, args):
+    for i in range(args.wave):
+        h.server.member_join(f"joiner{i}")
+
+
+async def prepare_rules_reaction(h, args):
+    await h.mod.post_rules.callback(h.context('rules'))
+    h.joiners = [h.server.member_join(f"joiner{i}") for i in range(args.wave)]
+    await h.settle()
+
+
+async def scenario_rules_reaction(h, args):
+    rules = h.channel('rules')
+    message_id = h.mod.state_store.rules_message(h.guild.id)
+    for member_id in h.joiners:
+        h.server.reaction_add(member_id, rules.id, message_id=message_id)
+
+
+async def prepare_join_after_rules(h, args):
+    h.joiners = [h.server.add_member(f"joiner{i}") for i in range(args.wave)]
+    h.guild = h.server.install()
+    await h.mod.on_ready()
+
+
+async def scenario_join_after_rules(h, args):
+    queue = h.mod.onboarding_queue
+    for member_id in h.joiners:
+        await queue.enqueue(h.guild.id, member_id, 'rules')
+        await queue.enqueue(h.guild.id, member_id, 'join')
+    await h.settle()
+    # Stages only move forward, whoever asks
+    for member_id in h.joiners:
+        await h.mod.set_onboarding_stage(await h.mod.fetch_member(h.guild, member_id), h.mod.UNVERIFIED_ROLE)
+
+
+def stage_conflicts(h, member_ids):
+    """Members holding Unverified next to a later stage role."""
+    later = {h.mod.LEAGUE_MEMBER_ROLE, h.mod.ONBOARDED_ROLE}
+    conflicts = 0
+    for member_id in member_ids:
+        names = {role.name for role in h.member(member_id).roles}
+        if h.mod.UNVERIFIED_ROLE in names and names & later:
+            conflicts += 1
+    return conflicts
+
+
+async def prepare_nickname_flow(h, args):
+    # Members who accepted the rules but haven't picked a team yet
+    league = discord.utils.get(h.guild.roles, name='League Member')
+    h.pickers = []
+    for i in range(args.wave):
+        member_id = h.server.add_member(f"picker{i}", roles=[league.id])
+        h.pickers.append(member_id)
+    h.guild = h.server.install()
+    await h.mod.on_ready()
+
+
+async def scenario_nickname_flow(h, args):
+    teams = h.mod.catalog.teams
+
+    async def pick(i, member_id):
+        member = h.member(member_id)
+        team = teams[i % len(teams)].name
+        interaction = h.interaction(member)
+        await h.mod.handle_team_selection(interaction, team)
+        modal = interaction.response.modal
+        modal.nickname._value = f"picker{i} | {team}"[:32]
+        await modal.on_submit(h.interaction(h.member(member_id)))
+
+    await asyncio.gather(*(pick(i, member_id) for i, member_id in enumerate(h.pickers)))
+
+
+async def prepare_nickname_rejected(h, args):
+    await prepare_nickname_flow(h, args)
+    general = h.channel('general').id
+
+    def fault(route):
+        if args.mode == 'overwrites':
+            rejected = route.method == 'PUT' and route.path.startswith('/channels/') and route.channel_id == general
+        else:
+            rejected = route.method == 'PATCH' and route.path == '/guilds/{guild_id}/members/{user_id}'
+        return 403 if rejected else None
+    h.http.fault = fault
+    h.undo_calls = 0
+    journal = h.mod.operation_journal
+    undo = journal._undo
+
+    async def counted_undo(member, step):
+        h.undo_calls += 1
+        await undo(member, step)
+    journal._undo = counted_undo
+
+
+def png(width, height, rgb):
+    """A solid-colour PNG, so each team gets a distinct logo without needing an image library."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + bytes(rgb) * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+async def prepare_sync_team_emojis(h, args):
+    # Logos at http://127.0.0.1:<port>/<n>.png, listed in a LOGO_URLS_FILE
+    logos = {f"{i}.png": png(96, 96, (i % 256, i // 256, 128)) for i in range(len(h.mod.catalog.teams))}
+    app = web.Application()
+    app.router.add_get('/{name}', lambda request: web.Response(body=logos[request.match_info['name']],
+                                                               content_type='image/png'))
+    h.logo_server = web.AppRunner(app)
+    await h.logo_server.setup()
+    site = web.TCPSite(h.logo_server, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    tmp = h._tmp.name
+    urls = {team.name: f"http://127.0.0.1:{port}/{i}.png" for i, team in enumerate(h.mod.catalog.teams)}
+    h.mod.LOGO_URLS_FILE = os.path.join(tmp, 'team_logo_urls.json')
+    with open(h.mod.LOGO_URLS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(urls, f)
+    h.mod.EMOJI_CACHE_DIR = os.path.join(tmp, 'emoji_cache')
+    teams_file = os.path.join(tmp, 'teams.json')
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), h.mod.TEAMS_FILE), teams_file)
+    h.mod.catalogs[teams_file] = h.mod.catalog
+    h.mod.guild_configs[h.guild.id] = h.mod.DEFAULT_CONFIG._replace(teams_file=teams_file)
+    # Boost level 3, so every team fits in the server's emoji slots
+    h.server.premium_tier = 3
+    h.guild = h.server.install()
+
+
+async def prepare_sync_team_emojis_rerun(h, args):
+    await prepare_sync_team_emojis(h, args)
+    await h.mod.sync_team_emojis.callback(h.context())
+    await h.settle()
+
+
+async def scenario_sync_team_emojis(h, args):
+    await h.mod.sync_team_emojis.callback(h.context())
+
+
+PREPARE = {
+    'setup_permissions_rerun': prepare_setup_permissions_rerun,
+    'rules_reaction': prepare_rules_reaction,
+    'join_after_rules': prepare_join_after_rules,
+    'nickname_flow': prepare_nickname_flow,
+    'nickname_rejected': prepare_nickname_rejected,
+    'sync_team_emojis': prepare_sync_team_emojis,
+    'sync_team_emojis_rerun': prepare_sync_team_emojis_rerun,
+}
+RUN = {
+    'startup': scenario_startup,
+    'ready': scenario_ready,
+    'setup_permissions': scenario_setup_permissions,
+    'setup_permissions_rerun': scenario_setup_permissions,
+    'setup_team_roles': scenario_setup_team_roles,
+    'member_join': scenario_member_join,
+    'rules_reaction': scenario_rules_reaction,
+    'join_after_rules': scenario_join_after_rules,
+    'nickname_flow': scenario_nickname_flow,
+    'nickname_rejected': scenario_nickname_flow,
+    'sync_team_emojis': scenario_sync_team_emojis,
+    'sync_team_emojis_rerun': scenario_sync_team_emojis,
+}
+
+
+async def run_scenario(name, members, channels, args):
+    h = Harness(latency=args.latency, bucket_limit=args.bucket_limit, bucket_window=args.bucket_window,
+                global_limit=args.global_limit, low_memory=args.low_memory)
+    try:
+        h.mod.ONBOARDING_MODE = args.mode
+        h.build_guild(members=members, channels=channels, setup_roles=name != 'setup_team_roles',
+                      install=name != 'startup')
+        await h.start()
+        if name not in ('startup', 'ready'):
+            await h.mod.on_ready()
+        if name in PREPARE:
+            await PREPARE[name](h, args)
+        await h.settle()
+        h.http.reset_counters()
+        h.interaction_calls.clear()
+
+        rss_before = h.mod.resident_memory()
+        tracemalloc.start()
+        start = time.perf_counter()
+        await RUN[name](h, args)
+        await h.settle()
+        wall = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        result = {
+            'scenario': name,
+            'members': members,
+            'channels': channels,
+            'wall_s': round(wall, 4),
+            'rest_total': sum(h.http.calls.values()),
+            'rest_calls': dict(sorted(h.http.calls.items())),
+            'rate_limited_total': sum(h.http.rate_limited.values()),
+            'rate_limited': dict(sorted(h.http.rate_limited.items())),
+            'peak_in_flight': h.http.peak_in_flight,
+            'interaction_calls': dict(sorted(h.interaction_calls.items())),
+            'peak_mem_kb': round(peak / 1024, 1),
+        }
+        if name == 'nickname_rejected':
+            result['undo_calls'] = h.undo_calls
+        if name == 'join_after_rules':
+            result['stage_conflicts'] = stage_conflicts(h, h.joiners)
+        if name.startswith('sync_team_emojis'):
+            result['emojis'] = len(h.guild.emojis)
+        if name == 'startup':
+            result.update({
+                'ready_s': round(h.ready_s, 4),
+                'retained_mem_kb': round(retained / 1024, 1),
+                'cached_members': len(h.guild.members),
+                'rss_before_kb': rss_before // 1024 if rss_before else None,
+                'rss_after_kb': h.mod.resident_memory() // 1024 if rss_before else None,
+            })
+        return result
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if getattr(h, 'logo_server', None):
+            await h.logo_server.cleanup()
+        h.close()
+
+
+def run(name, members, channels, args):
+    # Each scenario gets a fresh event loop and a fresh copy of the bot module
+    return asyncio.run(run_scenario(name, members, channels, args))
+
+
+def run_isolated(name, members, channels, args):
+    # A fresh process, so resident memory isn't inflated by earlier runs
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run, name, members, channels, args).result()
+
+
+def parse_ints(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=parse_ints, default=[100, 1000], help='guild sizes, e.g. 100,1000,10000,50000')
+    parser.add_argument('--channels', type=parse_ints, default=[20, 60], help='text channel counts, e.g. 20,60,200')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--wave', type=int, default=50, help='members joining / reacting / picking a team per scenario')
+    parser.add_argument('--mode', default='roles', choices=['roles', 'overwrites'], help='ONBOARDING_MODE to benchmark')
+    parser.add_argument('--latency', type=float, default=0.01, help='simulated seconds per REST call')
+    parser.add_argument('--bucket-limit', type=int, default=10, help='requests per rate-limit bucket per window')
+    parser.add_argument('--bucket-window', type=float, default=1.0, help='rate-limit bucket window in seconds')
+    parser.add_argument('--global-limit', type=int, default=50, help='global requests per second')
+    parser.add_argument('--low-memory', action='store_true', help='run the bot with LOW_MEMORY_MODE on')
+    parser.add_argument('--output', default='bench_results.json', help='JSON file to write')
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = []
+    for members in args.members:
+        for channels in args.channels:
+            for name in scenarios:
+                result = (run_isolated if name == 'startup' else run)(name, members, channels, args)
+                results.append(result)
+                print(f"{name:<24} members={members:<6} channels={channels:<4} "
+                      f"wall={result['wall_s']:>8.3f}s rest={result['rest_total']:<6} "
+                      f"429s={result['rate_limited_total']:<4} peak_mem={result['peak_mem_kb']:>9.1f}KB")
+                if name == 'startup':
+                    print(f"{'':<24} ready={result['ready_s']:.3f}s retained_mem={result['retained_mem_kb']:.1f}KB "
+                          f"cached_members={result['cached_members']} "
+                          f"rss={result['rss_before_kb']}KB -> {result['rss_after_kb']}KB")
+                if name == 'nickname_rejected':
+                    print(f"{'':<24} undo_calls={result['undo_calls']}")
+                if name == 'join_after_rules':
+                    print(f"{'':<24} stage_conflicts={result['stage_conflicts']}")
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'discord.py': discord.__version__,
+            'mode': args.mode,
+            'low_memory': args.low_memory,
+            'wave': args.wave,
+            'latency': args.latency,
+            'bucket_limit': args.bucket_limit,
+            'bucket_window': args.bucket_window,
+            'global_limit': args.global_limit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
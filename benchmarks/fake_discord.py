@@ -0,0 +1,633 @@
+"""In-process stand-in for a Discord guild and the REST API.
+
+FakeHTTP replaces discord.py's HTTPClient, so the bot's real handlers and discord.py's real
+model objects (Guild, TextChannel, Role, Member, ...) run unchanged. Each request is applied to
+an in-memory guild, answered with the payload Discord would return, and followed by the gateway
+event Discord would send, so the bot's caches and event handlers see the change too.
+Interaction responses and followups, which discord.py sends through its webhook adapter
+rather than HTTPClient, are served by FakeWebhookAdapter the same way.
+
+Requests are counted per route, wait a simulated latency, and go through simulated per-bucket
+and global rate limits that answer with 429s the same way discord.py handles them.
+"""
+import asyncio
+import base64
+import collections
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import discord
+from discord.http import HTTPClient
+from discord.webhook.async_ import AsyncWebhookAdapter, async_context
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMESTAMP = '2024-01-01T00:00:00+00:00'
+
+# Channels a league server normally has; make_guild pads with chat channels up to the requested count
+BASE_TEXT_CHANNELS = [
+    'welcome', 'rules', 'team-selection', 'bot-logs', 'general', 'scores', 'admin-chat',
+    'trophy-room', 'pre-season-all-americans', '247sports-recruits-crystal-ball',
+]
+BASE_ROLES = ['League Member', 'Admin', 'Media Team', 'Unverified', 'Onboarded']
+
+
+def load_bot_module(name='ncaa_discord_bot_bench'):
+    """Import a fresh copy of ncaa_discord_bot (no shared state between runs)."""
+    cwd = os.getcwd()
+    os.chdir(REPO_DIR)  # The team JSON is loaded relative to the repo
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, 'ncaa_discord_bot.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+class RateLimiter:
+    """Fixed-window request limits per bucket plus a global limit, like Discord's."""
+
+    def __init__(self, bucket_limit=10, bucket_window=1.0, global_limit=50):
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self.global_limit = global_limit
+        self._windows = {}  # bucket -> (window start, count)
+
+    def _take(self, bucket, limit, window, now):
+        start, count = self._windows.get(bucket, (now, 0))
+        if now - start >= window:
+            start, count = now, 0
+        if count >= limit:
+            return start + window - now
+        self._windows[bucket] = (start, count + 1)
+        return 0.0
+
+    def acquire(self, bucket, now):
+        """0 if the request may go ahead, otherwise retry_after seconds (a 429)."""
+        retry = self._take('global', self.global_limit, 1.0, now)
+        if retry:
+            return retry
+        return self._take(bucket, self.bucket_limit, self.bucket_window, now)
+
+
+class FakeResponseStatus:
+    """The bits of an aiohttp response discord.HTTPException reads."""
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'Injected fault'
+
+
+def http_error(status):
+    """The exception discord.py raises for an error response with this status."""
+    error = {403: discord.Forbidden, 404: discord.NotFound}.get(status)
+    if error is None:
+        error = discord.DiscordServerError if status >= 500 else discord.HTTPException
+    return error(FakeResponseStatus(status), 'Injected fault')
+
+
+class FakeHTTP(HTTPClient):
+    """HTTPClient whose requests are served by a FakeGuildServer instead of Discord."""
+
+    def __init__(self, server, loop=None, latency=0.01, limiter=None, max_ratelimit_timeout=None):
+        super().__init__(loop, max_ratelimit_timeout=max_ratelimit_timeout)
+        self.server = server
+        self.latency = latency
+        self.limiter = limiter or RateLimiter()
+        self.calls = collections.Counter()  # "METHOD /path/{template}" -> count
+        self.rate_limited = collections.Counter()  # same keys, number of 429s
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        # fault(route) -> HTTP status to fail the request with (e.g. 503, 403), or None to serve it
+        self.fault = None
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        key = f"{route.method} {route.path}"
+        bucket = (key, route.channel_id, route.guild_id)
+        loop = asyncio.get_running_loop()
+        while True:
+            retry_after = self.limiter.acquire(bucket, loop.time())
+            if not retry_after:
+                break
+            # What discord.py does with a 429: sleep and retry, or raise past max_ratelimit_timeout
+            self.rate_limited[key] += 1
+            if self.max_ratelimit_timeout and retry_after > self.max_ratelimit_timeout:
+                raise discord.RateLimited(retry_after)
+            await asyncio.sleep(retry_after)
+        self.calls[key] += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            status = self.fault(route) if self.fault else None
+            if status:
+                raise http_error(status)
+            return self.server.handle(route, kwargs.get('json'))
+        finally:
+            self.in_flight -= 1
+
+    async def get_from_cdn(self, url):
+        # Emoji.read(): https://cdn.discordapp.com/emojis/<id>.png
+        self.calls['GET cdn/emojis'] += 1
+        emoji_id = int(url.rsplit('/', 1)[1].split('.')[0])
+        return self.server.emoji_images[emoji_id]
+
+    async def close(self):
+        pass
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.rate_limited.clear()
+        self.peak_in_flight = 0
+
+
+class FakeWebhookAdapter(AsyncWebhookAdapter):
+    """Answers interaction callbacks and followups, counted in the FakeHTTP's counters."""
+
+    def __init__(self, http):
+        super().__init__()
+        self.http = http
+        self.modals = {}  # interaction id -> modal payload the bot answered it with
+
+    async def request(self, route, session=None, *, payload=None, multipart=None, **kwargs):
+        self.http.calls[f"{route.method} {route.path}"] += 1
+        if self.http.latency:
+            await asyncio.sleep(self.http.latency)
+        if payload is None and multipart:
+            payload = json.loads(multipart[0]['value'])  # payload_json
+        payload = payload or {}
+        if route.path.endswith('/callback'):
+            if payload.get('type') == 9:
+                self.modals[int(route.webhook_id)] = payload['data']
+            return {'interaction': {'id': str(route.webhook_id), 'type': 3}}
+        if route.method == 'DELETE':
+            return None
+        return self.http.server.message_payload(0, payload.get('content'))
+
+
+class FakeGuildServer:
+    """The Discord side: one guild's channels, roles and members as API payloads."""
+
+    def __init__(self, state, guild_id=900000000000000000):
+        self.state = state
+        self.guild_id = guild_id
+        self._ids = itertools.count(guild_id + 1)
+        self.channels = {}  # id -> channel payload
+        self.roles = {}  # id -> role payload
+        self.members = {}  # id -> member payload
+        self.threads = {}  # id -> thread payload
+        self.emojis = {}  # id -> emoji payload
+        self.emoji_images = {}  # id -> image bytes, served by FakeHTTP.get_from_cdn
+        self.premium_tier = 0  # Boost level; sets guild.emoji_limit (50 at tier 0, 250 at tier 3)
+        self.messages = 0
+        self.lazy_members = False  # True to leave members out of GUILD_CREATE, as for LOW_MEMORY_MODE
+        self.bot_user = self.user_payload(self.next_id(), 'league-bot', bot=True)
+        self.roles[guild_id] = self.role_payload(guild_id, '@everyone', 0)
+        # The bot's integration role, above every role it creates
+        self.bot_role = self.next_id()
+        self.roles[self.bot_role] = dict(self.role_payload(self.bot_role, 'league-bot', 1000), managed=True)
+
+    def next_id(self):
+        return next(self._ids)
+
+    # Payload builders
+
+    @staticmethod
+    def user_payload(user_id, name, bot=False):
+        return {'id': str(user_id), 'username': name, 'discriminator': '0', 'avatar': None,
+                'global_name': None, 'bot': bot}
+
+    @staticmethod
+    def role_payload(role_id, name, position):
+        return {'id': str(role_id), 'name': name, 'colors': {'primary_color': 0}, 'hoist': False, 'position': position,
+                'permissions': '0', 'managed': False, 'mentionable': False}
+
+    def channel_payload(self, channel_id, name, position, channel_type=0, overwrites=None):
+        data = {'id': str(channel_id), 'type': channel_type, 'guild_id': str(self.guild_id), 'name': name,
+                'position': position, 'permission_overwrites': overwrites or [], 'nsfw': False,
+                'parent_id': None, 'topic': None}
+        if channel_type == 2:
+            data.update(bitrate=64000, user_limit=0, rtc_region=None)
+        return data
+
+    def member_payload(self, user, roles=(), nick=None):
+        return {'user': user, 'roles': [str(r) for r in roles], 'nick': nick, 'joined_at': TIMESTAMP,
+                'deaf': False, 'mute': False, 'flags': 0}
+
+    def message_payload(self, channel_id, content, message_id=None):
+        return {'id': str(message_id or self.next_id()), 'channel_id': str(channel_id),
+                'author': self.bot_user, 'content': content or '', 'timestamp': TIMESTAMP,
+                'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [],
+                'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0}
+
+    # Building the guild
+
+    def add_role(self, name):
+        role_id = self.next_id()
+        self.roles[role_id] = self.role_payload(role_id, name, len(self.roles))
+        return role_id
+
+    def add_channel(self, name, channel_type=0):
+        channel_id = self.next_id()
+        self.channels[channel_id] = self.channel_payload(channel_id, name, len(self.channels), channel_type)
+        return channel_id
+
+    def add_member(self, name, roles=(), nick=None):
+        member_id = self.next_id()
+        self.members[member_id] = self.member_payload(self.user_payload(member_id, name), roles, nick)
+        return member_id
+
+    def guild_payload(self):
+        members = [self.member_payload(self.bot_user, [self.bot_role])]
+        if not self.lazy_members:
+            members += self.members.values()
+        return {'id': str(self.guild_id), 'name': 'Fake League', 'owner_id': str(self.bot_user['id']),
+                'roles': list(self.roles.values()), 'channels': list(self.channels.values()),
+                'members': members, 'member_count': len(self.members) + 1,
+                'emojis': list(self.emojis.values()), 'stickers': [],
+                'features': [], 'verification_level': 0, 'default_message_notifications': 0,
+                'explicit_content_filter': 0, 'mfa_level': 0, 'premium_tier': self.premium_tier, 'afk_timeout': 300,
+                'system_channel_flags': 0, 'preferred_locale': 'en-US', 'nsfw_level': 0, 'icon': None,
+                'splash': None, 'large': True}
+
+    def install(self):
+        """Create the discord.py Guild from the payloads and add it to the bot's cache."""
+        state = self.state
+        state.user = discord.ClientUser(state=state, data=self.bot_user)
+        guild = discord.Guild(data=self.guild_payload(), state=state)
+        state._add_guild(guild)
+        return guild
+
+    def add_emoji(self, name, image):
+        emoji_id = self.next_id()
+        self.emojis[emoji_id] = {'id': str(emoji_id), 'name': name, 'roles': [], 'require_colons': True,
+                                 'managed': False, 'animated': False, 'available': True}
+        self.emoji_images[emoji_id] = image
+        return emoji_id
+
+    # Gateway events (sent after the REST response, as Discord does)
+
+    def _gateway(self, parser, data):
+        asyncio.get_running_loop().call_soon(parser, data)
+
+    def _member_event(self, member_id):
+        data = dict(self.members[member_id], guild_id=str(self.guild_id))
+        self._gateway(self.state.parsers['GUILD_MEMBER_UPDATE'], data)
+
+    def _channel_event(self, channel_id, parser=None):
+        self._gateway(parser or self.state.parse_channel_update, self.channels[channel_id])
+
+    async def chunker(self, guild_id, query='', limit=0, presences=False, *, nonce=None):
+        """Stands in for ConnectionState.chunker: answers a member request in 1000-member chunks."""
+        members = list(self.members.values()) + [self.member_payload(self.bot_user, [self.bot_role])]
+        chunks = [members[i:i + 1000] for i in range(0, len(members), 1000)]
+        for index, chunk in enumerate(chunks):
+            self._gateway(self.state.parse_guild_members_chunk, {
+                'guild_id': str(guild_id), 'members': chunk, 'chunk_index': index,
+                'chunk_count': len(chunks), 'nonce': nonce,
+            })
+
+    # Gateway events the benchmark triggers directly, looked up in state.parsers as the gateway
+    # does (so anything wrapping a parser, like the bot's TraceRecorder, sees them too)
+
+    def member_join(self, name, member_id=None):
+        """A member joins: a new one named name, or member_id again after leaving."""
+        member_id = member_id or self.add_member(name)
+        data = dict(self.members[member_id], guild_id=str(self.guild_id))
+        self.state.parsers['GUILD_MEMBER_ADD'](data)
+        return member_id
+
+    def reaction_add(self, member_id, channel_id, emoji='✅', message_id=None, author_id=None):
+        """A reaction on message_id (a new id if None), posted by author_id (the bot if None)."""
+        self.state.parsers['MESSAGE_REACTION_ADD']({
+            'user_id': str(member_id), 'channel_id': str(channel_id), 'message_id': str(message_id or self.next_id()),
+            'message_author_id': str(author_id or self.bot_user['id']),
+            'guild_id': str(self.guild_id), 'emoji': {'id': None, 'name': emoji}, 'burst': False, 'type': 0,
+            'member': self.members[member_id],
+        })
+
+    def interaction_create(self, member_id, kind, data, channel_id=None, message_id=None):
+        """A component (kind 3) or modal submit (kind 5) interaction; in DMs if channel_id is None.
+
+        Returns the interaction id, which FakeWebhookAdapter.modals is keyed by.
+        """
+        member = self.members[member_id]
+        interaction_id = self.next_id()
+        payload = {'id': str(interaction_id), 'application_id': self.bot_user['id'], 'type': kind, 'data': data,
+                   'token': f'token{interaction_id}', 'version': 1, 'locale': 'en-US', 'app_permissions': '0',
+                   'attachment_size_limit': 8388608, 'entitlements': [], 'authorizing_integration_owners': {}}
+        if channel_id is None:
+            channel_id = member_id  # One DM channel per member
+            payload.update(user=member['user'], channel={'id': str(channel_id), 'type': 1, 'recipients': [member['user']]})
+        else:
+            payload.update(guild_id=str(self.guild_id), member=dict(member, permissions='0'),
+                           channel=self.channels[channel_id], channel_id=str(channel_id))
+        if message_id:
+            payload['message'] = self.message_payload(channel_id, '', message_id)
+        self.state.parsers['INTERACTION_CREATE'](payload)
+        return interaction_id
+
+    # REST API
+
+    def handle(self, route, payload):
+        method, path, payload = route.method, route.path, payload or {}
+        params = route.url[len(route.BASE):].split('/')
+        if path == '/channels/{channel_id}/permissions/{target}':
+            channel = self.channels[int(route.channel_id)]
+            target = params[4]
+            overwrites = [o for o in channel['permission_overwrites'] if o['id'] != target]
+            if method == 'PUT':
+                overwrites.append({'id': target, 'type': payload.get('type', 0),
+                                   'allow': str(payload.get('allow', 0)), 'deny': str(payload.get('deny', 0))})
+            channel['permission_overwrites'] = overwrites
+            self._channel_event(int(route.channel_id))
+            return None
+        if path == '/channels/{channel_id}/threads' and method == 'POST':
+            thread_id = self.next_id()
+            self.threads[thread_id] = {
+                'id': str(thread_id), 'type': payload.get('type', 12), 'guild_id': str(self.guild_id),
+                'name': payload['name'], 'parent_id': str(route.channel_id), 'owner_id': self.bot_user['id'],
+                'member_count': 0, 'message_count': 0, 'rate_limit_per_user': 0, 'flags': 0,
+                'thread_metadata': {'archived': False, 'locked': False, 'invitable': payload.get('invitable', True),
+                                    'auto_archive_duration': payload.get('auto_archive_duration', 10080),
+                                    'archive_timestamp': TIMESTAMP},
+            }
+            self._gateway(self.state.parse_thread_create, self.threads[thread_id])
+            return self.threads[thread_id]
+        if path == '/channels/{channel_id}' and method == 'PATCH' and int(route.channel_id) in self.threads:
+            thread = self.threads[int(route.channel_id)]
+            for field in ('archived', 'locked'):
+                if field in payload:
+                    thread['thread_metadata'][field] = payload[field]
+            self._gateway(self.state.parse_thread_update, thread)
+            return thread
+        if path == '/channels/{channel_id}' and method == 'PATCH':
+            channel = self.channels[int(route.channel_id)]
+            if 'permission_overwrites' in payload:
+                channel['permission_overwrites'] = [
+                    {'id': str(o['id']), 'type': o['type'], 'allow': str(o['allow']), 'deny': str(o['deny'])}
+                    for o in payload['permission_overwrites']
+                ]
+            for field in ('name', 'topic', 'position'):
+                if field in payload:
+                    channel[field] = payload[field]
+            self._channel_event(int(route.channel_id))
+            return channel
+        if path == '/channels/{channel_id}' and method == 'DELETE':
+            channel = self.channels.pop(int(route.channel_id))
+            self._gateway(self.state.parse_channel_delete, channel)
+            return channel
+        if path == '/guilds/{guild_id}/channels' and method == 'POST':
+            channel_id = self.next_id()
+            overwrites = [{'id': str(o['id']), 'type': o['type'], 'allow': str(o['allow']), 'deny': str(o['deny'])}
+                          for o in payload.get('permission_overwrites', [])]
+            self.channels[channel_id] = self.channel_payload(channel_id, payload['name'], len(self.channels),
+                                                             payload.get('type', 0), overwrites)
+            self._channel_event(channel_id, self.state.parse_channel_create)
+            return self.channels[channel_id]
+        if path == '/guilds/{guild_id}/roles' and method == 'POST':
+            role_id = self.add_role(payload.get('name', 'new role'))
+            role = self.roles[role_id]
+            for field in ('colors', 'hoist', 'mentionable'):
+                if field in payload:
+                    role[field] = payload[field]
+            self._gateway(self.state.parse_guild_role_create, {'guild_id': str(self.guild_id), 'role': role})
+            return role
+        if path == '/guilds/{guild_id}/roles' and method == 'GET':
+            return list(self.roles.values())
+        if path == '/guilds/{guild_id}/roles' and method == 'PATCH':
+            # Bulk position update
+            for entry in payload:
+                self.roles[int(entry['id'])]['position'] = entry['position']
+            for role in self.roles.values():
+                self._gateway(self.state.parse_guild_role_update, {'guild_id': str(self.guild_id), 'role': role})
+            return list(self.roles.values())
+        if path == '/guilds/{guild_id}/roles/{role_id}' and method == 'PATCH':
+            role = self.roles[int(params[4])]
+            for field in ('name', 'colors', 'hoist', 'mentionable', 'position'):
+                if field in payload:
+                    role[field] = payload[field]
+            self._gateway(self.state.parse_guild_role_update, {'guild_id': str(self.guild_id), 'role': role})
+            return role
+        if path == '/guilds/{guild_id}/roles/{role_id}' and method == 'DELETE':
+            role_id = params[4]
+            del self.roles[int(role_id)]
+            for member in self.members.values():
+                if role_id in member['roles']:
+                    member['roles'] = [r for r in member['roles'] if r != role_id]
+            self._gateway(self.state.parse_guild_role_delete, {'guild_id': str(self.guild_id), 'role_id': role_id})
+            return None
+        if path == '/guilds/{guild_id}/emojis' and method == 'POST':
+            # image is a data URI: data:image/png;base64,...
+            emoji_id = self.add_emoji(payload['name'], base64.b64decode(payload['image'].split(',', 1)[1]))
+            self._gateway(self.state.parse_guild_emojis_update,
+                          {'guild_id': str(self.guild_id), 'emojis': list(self.emojis.values())})
+            return self.emojis[emoji_id]
+        if path == '/guilds/{guild_id}/members/{user_id}/roles/{role_id}':
+            member_id, role_id = int(params[4]), params[6]
+            roles = [r for r in self.members[member_id]['roles'] if r != role_id]
+            if method == 'PUT':
+                roles.append(role_id)
+            self.members[member_id]['roles'] = roles
+            self._member_event(member_id)
+            return None
+        if path == '/guilds/{guild_id}/members/{member_id}' and method == 'GET':
+            return dict(self.members[int(params[4])])
+        if path == '/guilds/{guild_id}/members/{user_id}' and method == 'PATCH':
+            member_id = int(params[4])
+            member = self.members[member_id]
+            if 'nick' in payload:
+                member['nick'] = payload['nick']
+            if 'roles' in payload:
+                member['roles'] = [str(r) for r in payload['roles']]
+            self._member_event(member_id)
+            return dict(member)
+        if path == '/users/@me/channels':
+            recipient = self.members.get(int(payload['recipient_id']), {}).get('user') or \
+                self.user_payload(payload['recipient_id'], 'user')
+            return {'id': str(self.next_id()), 'type': 1, 'recipients': [recipient], 'last_message_id': None}
+        if path == '/channels/{channel_id}/messages' and method == 'POST':
+            self.messages += 1
+            return self.message_payload(route.channel_id, payload.get('content'))
+        if path == '/channels/{channel_id}/messages/{message_id}' and method == 'PATCH':
+            return self.message_payload(route.channel_id, payload.get('content'), message_id=params[4])
+        # Reactions, deletes and anything else that answers 204
+        return None
+
+
+class FakeResponse:
+    """interaction.response stand-in: records what the bot answered with."""
+
+    def __init__(self, calls):
+        self._calls = calls
+        self._done = False
+        self.modal = None
+        self.view = None
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        self._calls['interaction send_message'] += 1
+        self._done = True
+
+    async def send_modal(self, modal):
+        self._calls['interaction send_modal'] += 1
+        self.modal = modal
+        self._done = True
+
+    async def defer(self, **kwargs):
+        self._calls['interaction defer'] += 1
+        self._done = True
+
+    async def edit_message(self, content=None, view=None, **kwargs):
+        self._calls['interaction edit_message'] += 1
+        self.view = view
+        self._done = True
+
+
+class FakeFollowup:
+    def __init__(self, calls):
+        self._calls = calls
+
+    async def send(self, content=None, **kwargs):
+        self._calls['interaction followup'] += 1
+
+
+class FakeInteraction:
+    """Just enough of discord.Interaction for component and modal callbacks."""
+
+    def __init__(self, user, guild, calls):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id if guild else None
+        self.response = FakeResponse(calls)
+        self.followup = FakeFollowup(calls)
+
+
+class FakeContext:
+    """Just enough of commands.Context to call a command's callback directly."""
+
+    def __init__(self, guild, channel, author):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class Harness:
+    """A fresh bot module wired to a fake guild, inside the running event loop."""
+
+    def __init__(self, latency=0.01, bucket_limit=10, bucket_window=1.0, global_limit=50, low_memory=False):
+        self.mod = load_bot_module()
+        self.bot = self.mod.bot
+        self.state = self.bot._connection
+        self.server = FakeGuildServer(self.state)
+        if low_memory:
+            # The module is already imported, so apply LOW_MEMORY_MODE's client options to its state
+            self.mod.LOW_MEMORY_MODE = True
+            options = self.mod.low_memory_options()
+            self.state.member_cache_flags = options['member_cache_flags']
+            self.state._chunk_guilds = options['chunk_guilds_at_startup']
+            self.server.lazy_members = True
+        self.state.chunker = self.server.chunker
+        self.http = FakeHTTP(self.server, latency=latency,
+                             limiter=RateLimiter(bucket_limit, bucket_window, global_limit),
+                             max_ratelimit_timeout=self.bot.http.max_ratelimit_timeout)
+        self.bot.http = self.http
+        self.state.http = self.http
+        self.interaction_calls = collections.Counter()
+        # Real discord.Interaction objects answer through this (FakeInteraction doesn't need it)
+        self.webhooks = FakeWebhookAdapter(self.http)
+        async_context.set(self.webhooks)
+        self._tmp = tempfile.TemporaryDirectory()
+        # Keep the bot's SQLite files out of the repo
+        self.mod.onboarding_queue.path = os.path.join(self._tmp.name, 'onboarding_queue.db')
+        self.mod.state_store.path = os.path.join(self._tmp.name, 'bot_state.db')
+        self.mod.operation_journal.path = os.path.join(self._tmp.name, 'operations.db')
+        self.guild = None
+
+    def build_guild(self, members=100, channels=20, onboarded=0.8, setup_roles=True, install=True):
+        """Populate the fake guild. onboarded is the share of members who already picked a team.
+
+        With install=False only the payloads are built; server.install() then creates the Guild.
+        """
+        server = self.server
+        role_ids = {name: server.add_role(name) for name in (BASE_ROLES if setup_roles else [])}
+        team_names = [team.name for team in self.mod.catalog.teams]
+        team_roles = [server.add_role(name) for name in team_names] if setup_roles else []
+        names = BASE_TEXT_CHANNELS[:channels]
+        names += [f'chat-{i}' for i in range(channels - len(names))]
+        for name in names:
+            server.add_channel(name)
+        server.add_channel('staff only VC', channel_type=2)
+        for i in range(members):
+            roles, nick = [], None
+            if team_roles and i < members * onboarded:
+                team = i % len(team_roles)
+                roles = [role_ids['League Member'], role_ids['Onboarded'], team_roles[team]]
+                nick = f"member{i} | {team_names[team]}"[:32]
+            server.add_member(f"member{i}", roles, nick)
+        if install:
+            self.guild = server.install()
+        return self.guild
+
+    async def start(self):
+        """Run the bot's startup hooks against the fake guild (no gateway connection)."""
+        await self.bot._async_setup_hook()
+        await self.bot.setup_hook()
+        self.bot._ready.set()
+        self._daemons = {t for t in asyncio.all_tasks() if t is not asyncio.current_task()}
+
+    async def settle(self):
+        """Wait until every dispatched event, queued onboarding job and gateway update has finished."""
+        queue = self.mod.onboarding_queue
+        idle_rounds = 0
+        while idle_rounds < 2:
+            await asyncio.sleep(0)
+            pending = [t for t in asyncio.all_tasks()
+                       if t is not asyncio.current_task() and t not in self._daemons and not t.done()]
+            if pending:
+                idle_rounds = 0
+                await asyncio.wait(pending)
+            elif queue.depth() or sum(queue._inflight.values()):
+                idle_rounds = 0
+                await asyncio.sleep(0.005)
+            else:
+                idle_rounds += 1
+        await self.mod.bot_logs.flush()
+
+    def channel(self, name):
+        return discord.utils.get(self.guild.text_channels, name=name)
+
+    def context(self, channel_name='bot-logs'):
+        author = next((m for m in self.guild.members if not m.bot), self.guild.me)
+        return FakeContext(self.guild, self.channel(channel_name), author)
+
+    def member(self, member_id):
+        """A member from the cache, or built from its payload as an interaction would carry it."""
+        return self.guild.get_member(member_id) or \
+            discord.Member(data=self.server.members[member_id], guild=self.guild, state=self.state)
+
+    def add_member(self, name, roles=()):
+        """A member who was already in the server: no join event, but cached like the rest."""
+        member_id = self.server.add_member(name, roles)
+        if not self.mod.LOW_MEMORY_MODE:
+            self.guild._add_member(self.member(member_id))
+        return member_id
+
+    def interaction(self, member):
+        return FakeInteraction(member, self.guild, self.interaction_calls)
+
+    def close(self):
+        for task in getattr(self, '_daemons', ()):
+            task.cancel()
+        self._tmp.cleanup()
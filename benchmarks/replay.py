@@ -0,0 +1,278 @@
+"""Replay a recorded traffic trace through the bot's real handlers, offline.
+
+Reads a trace written by the bot's TraceRecorder (set TRACE_FILE in ncaa_discord_bot.py) and
+feeds each member join, reaction, dropdown/button click and modal submit through the real
+handlers against the fake guild and HTTP layer from fake_discord.py, at the recorded pace, a
+multiple of it, or as fast as possible. Reports throughput, latency percentiles for every
+handler and onboarding job, and the REST calls and 429s the traffic caused, so onboarding
+changes can be compared against real traffic shapes.
+
+Users in the trace who don't join during it are added as existing members (League Members if
+their first event is a click). Every server in the trace is replayed into the one fake guild.
+
+Usage:
+    python benchmarks/replay.py trace.jsonl
+    python benchmarks/replay.py trace.jsonl --speed 10 --members 10000 --mode overwrites
+    python benchmarks/replay.py trace.jsonl --speed max --output replay_results.json
+"""
+import argparse
+import asyncio
+import collections
+import json
+import platform
+import re
+import sys
+import time
+
+import discord
+
+from fake_discord import Harness
+
+MODAL_WAIT = 5.0  # Seconds a modal submit waits for the replayed click to open its modal
+ANON_USER = re.compile(r'\buser(\d+)\b')  # How the recorder writes a member's own words
+
+
+def load_trace(path):
+    """Trace events in order, with times running on across recordings (each starts with a header).
+
+    Anonymous user and message numbers restart with each recording (session), so they are
+    prefixed with the recording's position in the file, in typed nicknames too.
+    """
+    events = []
+    offset = last = 0.0
+    recording = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'trace' in entry:
+                offset = last
+                recording += 1
+                continue
+            for field in ('user', 'message'):
+                if isinstance(entry.get(field), int):
+                    entry[field] = f"{recording}.{entry[field]}"
+            if entry['type'] == 'modal':
+                entry['values'] = [ANON_USER.sub(rf"user{recording}.\1", value) for value in entry['values']]
+            entry['t'] += offset
+            last = entry['t']
+            events.append(entry)
+    return events
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a sorted list."""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, max(0, int(round(q * len(samples))) - 1))]
+
+
+def fill_modal(component, values):
+    """A modal component as submitted: text inputs carry the next recorded value."""
+    if component.get('type') == 4:
+        return {'type': 4, 'custom_id': component['custom_id'], 'value': next(values, component.get('value') or '')}
+    component = dict(component)
+    if 'components' in component:
+        component['components'] = [fill_modal(child, values) for child in component['components']]
+    if 'component' in component:
+        component['component'] = fill_modal(component['component'], values)
+    return component
+
+
+class Replayer:
+    """Turns trace events into gateway events and interactions on the fake guild."""
+
+    def __init__(self, h):
+        self.h = h
+        self.server = h.server
+        self.users = {}  # trace user -> fake member id
+        self.messages = {}  # trace message -> fake message id
+        self.last_interaction = {}  # fake member id -> id of their latest click
+        self.rules_message = h.mod.state_store.rules_message(h.guild.id)
+        self.league_role = discord.utils.get(h.guild.roles, name=h.mod.LEAGUE_MEMBER_ROLE)
+        self.channels = {name: h.channel(name).id for name in ('rules', 'general', 'team-selection')}
+        self.skipped = collections.Counter()
+        self.tasks = set()
+
+    def member(self, user, first_event):
+        member_id = self.users.get(user)
+        if member_id is None:
+            roles = [self.league_role.id] if first_event in ('component', 'modal') and self.league_role else []
+            member_id = self.users[user] = self.h.add_member(f"user{user}", roles)
+        return member_id
+
+    def message(self, message):
+        if message == 'rules':
+            return self.rules_message
+        return self.messages.setdefault(message, self.server.next_id())
+
+    def custom_id(self, custom_id):
+        # '#<n>' stands for an anonymized id; in this bot's custom_ids that is always a server id
+        return re.sub(r'#\d+', str(self.server.guild_id), custom_id)
+
+    def feed(self, event):
+        kind = event['type']
+        if kind == 'join':
+            if event.get('bot'):
+                self.skipped['bot join'] += 1
+                return
+            member_id = self.users.get(event['user'])
+            self.users[event['user']] = self.server.member_join(f"user{event['user']}", member_id)
+        elif kind == 'reaction':
+            channel_id = self.channels['rules' if event['channel'] == 'rules' else 'general']
+            message_id = self.message(event['message'])
+            author_id = self.server.bot_user['id'] if event.get('bot_message') else self.server.next_id()
+            self.server.reaction_add(self.member(event['user'], kind), channel_id, emoji=event['emoji'],
+                                     message_id=message_id, author_id=author_id)
+        elif kind == 'component':
+            member_id = self.member(event['user'], kind)
+            data = {'custom_id': self.custom_id(event['custom_id']), 'component_type': event['component_type'],
+                    'values': event['values']}
+            channel_id = self.channels['team-selection'] if event['guild'] else None
+            self.last_interaction[member_id] = self.server.interaction_create(
+                member_id, 3, data, channel_id=channel_id, message_id=self.message(event['message']))
+        elif kind == 'modal':
+            task = asyncio.create_task(self.submit_modal(event))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def submit_modal(self, event):
+        # A member can only submit a modal once the bot has shown it
+        member_id = self.member(event['user'], 'modal')
+        deadline = time.perf_counter() + MODAL_WAIT
+        modal = None
+        while modal is None and time.perf_counter() < deadline:
+            modal = self.h.webhooks.modals.pop(self.last_interaction.get(member_id), None)
+            if modal is None:
+                await asyncio.sleep(0.005)
+        if modal is None:
+            self.skipped['modal never shown'] += 1
+            return
+        values = iter(event['values'])
+        data = {'custom_id': modal['custom_id'], 'components': [fill_modal(c, values) for c in modal['components']]}
+        channel_id = self.channels['team-selection'] if event['guild'] else None
+        self.server.interaction_create(member_id, 5, data, channel_id=channel_id)
+
+
+async def replay(events, args):
+    h = Harness(latency=args.latency, bucket_limit=args.bucket_limit, bucket_window=args.bucket_window,
+                global_limit=args.global_limit, low_memory=args.low_memory)
+    try:
+        h.mod.ONBOARDING_MODE = args.mode
+        h.build_guild(members=args.members, channels=args.channels)
+        await h.start()
+        await h.mod.on_ready()
+        await h.mod.post_rules.callback(h.context('rules'))
+        await h.settle()
+        replayer = Replayer(h)
+        h.http.reset_counters()
+
+        # Every handler and onboarding job latency, unbucketed
+        samples = collections.defaultdict(list)
+        observe = h.mod.metrics.observe
+
+        def record(name, seconds, error=False):
+            samples[name].append(seconds)
+            observe(name, seconds, error)
+        h.mod.metrics.observe = record
+
+        speed = None if args.speed == 'max' else float(args.speed)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for event in events:
+            if speed:
+                delay = start + event['t'] / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)  # Let handlers run between events, as a gateway read would
+            replayer.feed(event)
+        await h.settle()
+        wall = loop.time() - start
+
+        duration = events[-1]['t'] if events else 0.0
+        latency = {}
+        for name, values in sorted(samples.items()):
+            values.sort()
+            latency[name] = {'count': len(values), 'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                             'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+                             'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                             'max_ms': round(values[-1] * 1000, 2)}
+        return {
+            'events': len(events),
+            'event_types': dict(collections.Counter(event['type'] for event in events)),
+            'trace_duration_s': round(duration, 3),
+            'wall_s': round(wall, 3),
+            'throughput_eps': round(len(events) / wall, 1) if wall else None,
+            # How much longer than the (sped-up) trace the bot needed to finish its work
+            'behind_s': round(wall - duration / speed, 3) if speed else None,
+            'latency': latency,
+            'rest_total': sum(h.http.calls.values()),
+            'rest_calls': dict(sorted(h.http.calls.items())),
+            'rate_limited_total': sum(h.http.rate_limited.values()),
+            'rate_limited': dict(sorted(h.http.rate_limited.items())),
+            'peak_in_flight': h.http.peak_in_flight,
+            'skipped': dict(replayer.skipped),
+        }
+    finally:
+        h.close()
+
+
+def parse_speed(text):
+    if text != 'max' and float(text) <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace', help='JSONL trace written by the bot (TRACE_FILE)')
+    parser.add_argument('--speed', type=parse_speed, default='1', help="1 for the recorded pace, 10 for ten times faster, or 'max'")
+    parser.add_argument('--members', type=int, default=1000, help='members already in the fake guild')
+    parser.add_argument('--channels', type=int, default=20, help='text channels in the fake guild')
+    parser.add_argument('--mode', default='roles', choices=['roles', 'overwrites'], help='ONBOARDING_MODE to replay with')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated seconds per REST call')
+    parser.add_argument('--bucket-limit', type=int, default=10, help='requests per rate-limit bucket per window')
+    parser.add_argument('--bucket-window', type=float, default=1.0, help='rate-limit bucket window in seconds')
+    parser.add_argument('--global-limit', type=int, default=50, help='global requests per second')
+    parser.add_argument('--low-memory', action='store_true', help='run the bot with LOW_MEMORY_MODE on')
+    parser.add_argument('--output', default='replay_results.json', help='JSON file to write')
+    args = parser.parse_args(argv)
+
+    events = load_trace(args.trace)
+    result = asyncio.run(replay(events, args))
+    print(f"{result['events']} events over {result['trace_duration_s']}s replayed in {result['wall_s']}s "
+          f"at speed {args.speed}: {result['throughput_eps']} events/s, rest={result['rest_total']} "
+          f"429s={result['rate_limited_total']}")
+    for name, stats in result['latency'].items():
+        print(f"  {name:<48} n={stats['count']:<6} p50={stats['p50_ms']:>9.2f}ms p95={stats['p95_ms']:>9.2f}ms "
+              f"p99={stats['p99_ms']:>9.2f}ms max={stats['max_ms']:>9.2f}ms")
+    if result['skipped']:
+        print(f"  skipped: {result['skipped']}")
+
+    report = {
+        'meta': {
+            'trace': args.trace,
+            'python': platform.python_version(),
+            'discord.py': discord.__version__,
+            'speed': args.speed,
+            'members': args.members,
+            'channels': args.channels,
+            'mode': args.mode,
+            'low_memory': args.low_memory,
+            'latency': args.latency,
+            'bucket_limit': args.bucket_limit,
+            'bucket_window': args.bucket_window,
+            'global_limit': args.global_limit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'result': result,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,251 +1,2489 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import csv
+import functools
+import hashlib
+import io
+import itertools
+import os
+import random
+import re
+import sqlite3
+import time
+import types
+import aiohttp
 import discord
+from discord import app_commands
 from discord.ext import commands
 import json
 
-# Load NCAA teams data from JSON
-with open('NCAA_FBS_conferences.json', 'r', encoding='utf-8') as f:
-    ncaa_data = json.load(f)
-
-# Flatten teams into a list of dicts with ScrapedName and LogoURL
-teams = []
-for conference_teams in ncaa_data.values():
-    for team in conference_teams:
-        teams.append({
-            'ScrapedName': team.get('ScrapedName'),
-            'LogoURL': team.get('LogoURL')
+TEAMS_FILE = 'NCAA_FBS_conferences.json'
+TEAMS_WATCH_INTERVAL = None  # Seconds between checks for an edited TEAMS_FILE; None to reload only with !reload_teams
+# Discord dropdowns can only have 25 options max
+MAX_SELECT_OPTIONS = 25
+
+# One team from the JSON: role/display name (ScrapedName), logo (emoji code or URL), conference,
+# and the fields /team searches (School, Nickname, City, State)
+Team = collections.namedtuple('Team', ['name', 'logo', 'conference', 'school', 'nickname', 'city', 'state'])
+FOOTNOTE = re.compile(r'\[[^\]]*\]')  # Wikipedia footnote markers, e.g. 'Chestnut Hill[g]'
+
+
+def clean_field(text):
+    return FOOTNOTE.sub('', text or '').strip()
+
+
+def search_words(text):
+    """Lowercase words of text ('Texas A&M' -> ['texas', 'am'], 'Hawai\'i' -> ['hawaii'])."""
+    return re.sub(r'[^0-9a-z]+', ' ', re.sub(r"[&.'’]", '', text.lower())).split()
+
+
+class TeamSearch:
+    """Autocomplete index over each team's name, school, nickname, city and state, built once.
+
+    prefixes: word prefix -> ((team index, score), ...), best match first
+    trigrams: trigram -> frozenset of team indexes, for queries with typos that match no prefix
+    A query is answered from the prefix table alone (one lookup per word), falling back to
+    trigram overlap only when that finds nothing.
+    """
+    __slots__ = ('teams', 'prefixes', 'trigrams', 'default')
+
+    # Matching a school word beats a nickname word, which beats the city or state
+    FIELD_WEIGHTS = (('school', 8), ('nickname', 4), ('name', 2), ('city', 2), ('state', 1))
+
+    def __init__(self, teams):
+        self.teams = teams
+        prefixes = collections.defaultdict(dict)
+        trigrams = collections.defaultdict(set)
+        for index, team in enumerate(teams):
+            for field, weight in self.FIELD_WEIGHTS:
+                for position, word in enumerate(search_words(getattr(team, field) or '')):
+                    # A field's first word counts double, so 'tex' ranks Texas above UTEP's city
+                    score = weight * 2 if position == 0 else weight
+                    for end in range(1, len(word) + 1):
+                        scores = prefixes[word[:end]]
+                        scores[index] = max(scores.get(index, 0), score)
+            for gram in self._trigrams(' '.join(search_words(f"{team.school} {team.nickname} {team.city}"))):
+                trigrams[gram].add(index)
+        self.prefixes = {
+            prefix: tuple(sorted(scores.items(), key=lambda item: (-item[1], teams[item[0]].name)))
+            for prefix, scores in prefixes.items()
+        }
+        self.trigrams = {gram: frozenset(indexes) for gram, indexes in trigrams.items()}
+        self.default = tuple(sorted(teams, key=lambda team: team.name))
+
+    @staticmethod
+    def _trigrams(text):
+        text = f"  {text} "
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def search(self, query, limit=MAX_SELECT_OPTIONS):
+        """Best matching teams for query, at most limit."""
+        words = search_words(query)
+        if not words:
+            return list(self.default[:limit])
+        hits = [self.prefixes.get(word, ()) for word in words]
+        if len(hits) == 1 and hits[0]:
+            return [self.teams[index] for index, _ in hits[0][:limit]]
+        if len(hits) > 1 and all(hits):
+            # Every word must match; rank by summed score, starting from the rarest word
+            hits.sort(key=len)
+            totals = dict(hits[0])
+            for other in hits[1:]:
+                other = dict(other)
+                totals = {index: score + other[index] for index, score in totals.items() if index in other}
+            if totals:
+                ranked = sorted(totals.items(), key=lambda item: (-item[1], self.teams[item[0]].name))
+                return [self.teams[index] for index, _ in ranked[:limit]]
+        # No prefix match for some word: rank by shared trigrams instead (at least two, to skip noise)
+        overlap = collections.Counter()
+        for gram in self._trigrams(' '.join(words)):
+            overlap.update(self.trigrams.get(gram, ()))
+        ranked = sorted(((index, n) for index, n in overlap.items() if n >= 2),
+                        key=lambda item: (-item[1], self.teams[item[0]].name))
+        return [self.teams[index] for index, _ in ranked[:limit]]
+
+
+# The only keys TeamCatalog reads from each team in TEAMS_FILE
+TEAM_FIELDS = ('ScrapedName', 'LogoURL', 'School', 'Nickname', 'City', 'State', 'State[a]')
+
+
+def team_fields(obj):
+    """json object_hook that drops the team keys the bot never reads (enrollment, history, ...)."""
+    # The top-level conference mapping has none of these keys and passes through unchanged
+    fields = {key: obj[key] for key in TEAM_FIELDS if key in obj}
+    return fields or obj
+
+
+class TeamCatalog:
+    """Immutable view of the team data, built once so handlers never re-derive it.
+
+    teams: all teams in JSON order
+    names: frozenset of team role names, for membership checks
+    by_name: team name -> Team
+    conferences: conference name -> tuple of Teams
+    option_chunks: conference name -> tuple of SelectOption chunks (<= 25 options each)
+    conference_options: SelectOptions for the conference picker
+    search: TeamSearch index for /team autocomplete
+    """
+    __slots__ = ('teams', 'names', 'by_name', 'conferences', 'option_chunks', 'conference_options', 'search')
+
+    def __init__(self, data):
+        conferences = {}
+        for conference, teams_list in data.items():
+            conferences[conference] = tuple(
+                Team(team.get('ScrapedName'), team.get('LogoURL'), conference, clean_field(team.get('School')),
+                     clean_field(team.get('Nickname')), clean_field(team.get('City')),
+                     clean_field(team.get('State') or team.get('State[a]')))
+                for team in teams_list
+            )
+        self.conferences = types.MappingProxyType(conferences)
+        self.teams = tuple(team for teams_list in conferences.values() for team in teams_list)
+        self.names = frozenset(team.name for team in self.teams)
+        self.by_name = types.MappingProxyType({team.name: team for team in self.teams})
+        self.option_chunks = types.MappingProxyType({
+            conference: tuple(
+                tuple(discord.SelectOption(label=team.name, description=team.name, value=team.name)
+                      for team in teams_list[i:i + MAX_SELECT_OPTIONS])
+                for i in range(0, len(teams_list), MAX_SELECT_OPTIONS)
+            )
+            for conference, teams_list in conferences.items()
         })
+        self.conference_options = tuple(
+            discord.SelectOption(label=conference, value=conference) for conference in conferences
+        )
+        self.search = TeamSearch(self.teams)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f, object_hook=team_fields))
+
+    def team_for_member(self, member):
+        """The first team role a member holds, or None."""
+        for role in member.roles:
+            if role.name in self.names:
+                return role
+        return None
+
+    @property
+    def max_chunks(self):
+        """Largest number of team dropdowns any conference needs."""
+        return max((len(chunks) for chunks in self.option_chunks.values()), default=1)
+
+
+# Load NCAA teams data from JSON
+catalog = TeamCatalog.from_file(TEAMS_FILE)
+
+# Serve Prometheus-format metrics on http://127.0.0.1:<port>/metrics; None to disable
+METRICS_PORT = None
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram: counts per bucket, plus count, sum and max."""
+    __slots__ = ('buckets', 'count', 'total', 'max', 'errors')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # Last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (the max for the +Inf bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """In-process counters for the hot paths, cheap enough to leave on.
+
+    latency: handler name (e.g. 'command:setup_permissions', 'ui:NicknameModal.on_submit') -> Histogram
+    api_calls / api_429s: (method, route template) -> count of outbound REST requests and 429s.
+    Every HTTP attempt is counted, so retries discord.py makes after a 429 show up too.
+    parked: 429s the mutation executor parked a route for, by route kind.
+    retries: calls retried after a transient error, by error kind.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.latency = collections.defaultdict(Histogram)
+        self.api_calls = collections.Counter()
+        self.api_429s = collections.Counter()
+        self.parked = collections.Counter()  # Mutation route kind ('channel', 'roles', ...) -> parked 429s
+        self.retries = collections.Counter()  # Transient error kind ('5xx', 'timeout', ...) -> retries after it
+
+    def observe(self, name, seconds, error=False):
+        self.latency[name].observe(seconds, error)
+
+    def timed(self, kind):
+        """Decorator recording a coroutine's latency under '<kind>:<qualified function name>'."""
+        def decorator(func):
+            # Classes defined inside functions (e.g. NicknameModal) drop the enclosing '<locals>' path
+            name = f"{kind}:{func.__qualname__.rsplit('<locals>.', 1)[-1]}"
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                error = False
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    self.observe(name, time.perf_counter() - start, error)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def route_template(method, path):
+        """'PATCH /api/v10/channels/123/messages/456' -> ('PATCH', '/channels/{id}/messages/{id}')."""
+        parts = path.split('/')
+        if len(parts) > 3 and parts[1] == 'api':
+            parts = parts[3:]  # Drop '', 'api', 'v10'
+        for i, part in enumerate(parts):
+            if part.isdigit():
+                parts[i] = '{id}'
+            elif i >= 2 and parts[i - 2] in ('interactions', 'webhooks') and parts[i - 1] == '{id}':
+                parts[i] = '{token}'  # Interaction/webhook tokens would make every route unique
+            elif i >= 1 and parts[i - 1] == 'reactions':
+                parts[i] = '{emoji}'
+        return method, '/' + '/'.join(p for p in parts if p)
+
+    def trace_config(self):
+        """aiohttp TraceConfig counting every REST request and 429 the bot's HTTP client makes."""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_end(session, context, params):
+            route = self.route_template(params.method, params.url.path)
+            self.api_calls[route] += 1
+            if params.response.status == 429:
+                self.api_429s[route] += 1
+
+        async def on_request_exception(session, context, params):
+            self.api_calls[self.route_template(params.method, params.url.path)] += 1
+
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+    def prometheus(self, gauges=()):
+        """Metrics in the Prometheus text exposition format. gauges: (name, help, value) tuples."""
+        lines = [
+            "# HELP ncaa_bot_handler_seconds Latency of commands, events and UI callbacks.",
+            "# TYPE ncaa_bot_handler_seconds histogram",
+        ]
+        for name, hist in sorted(self.latency.items()):
+            kind, handler = name.split(':', 1)
+            labels = f'kind="{kind}",handler="{handler}"'
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, hist.buckets):
+                cumulative += n
+                lines.append(f'ncaa_bot_handler_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'ncaa_bot_handler_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+            lines.append(f'ncaa_bot_handler_seconds_sum{{{labels}}} {hist.total:.6f}')
+            lines.append(f'ncaa_bot_handler_seconds_count{{{labels}}} {hist.count}')
+        lines.append("# HELP ncaa_bot_handler_errors_total Handler invocations that raised.")
+        lines.append("# TYPE ncaa_bot_handler_errors_total counter")
+        for name, hist in sorted(self.latency.items()):
+            kind, handler = name.split(':', 1)
+            lines.append(f'ncaa_bot_handler_errors_total{{kind="{kind}",handler="{handler}"}} {hist.errors}')
+        for metric, help_text, counter in (
+            ('ncaa_bot_api_requests_total', 'Outbound Discord REST requests by route.', self.api_calls),
+            ('ncaa_bot_api_429_total', 'Discord REST responses with status 429 by route.', self.api_429s),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (method, route), n in sorted(counter.items()):
+                lines.append(f'{metric}{{method="{method}",route="{route}"}} {n}')
+        lines.append("# HELP ncaa_bot_mutations_parked_total 429s that parked a mutation route.")
+        lines.append("# TYPE ncaa_bot_mutations_parked_total counter")
+        for kind, n in sorted(self.parked.items()):
+            lines.append(f'ncaa_bot_mutations_parked_total{{route="{kind}"}} {n}')
+        lines.append("# HELP ncaa_bot_retries_total Discord calls retried after a transient error.")
+        lines.append("# TYPE ncaa_bot_retries_total counter")
+        for reason, n in sorted(self.retries.items()):
+            lines.append(f'ncaa_bot_retries_total{{reason="{reason}"}} {n}')
+        for metric, help_text, value in gauges:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
 
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Rate limits longer than this raise discord.RateLimited instead of sleeping inside the request,
+# so the mutation executor can park just that route and keep the others moving (minimum is 30s)
+RATE_LIMIT_PARK_AFTER = 30.0
+# True to run as an AutoShardedBot (Discord requires sharding above 2,500 servers)
+SHARDED = False
+# True for very large servers: members aren't downloaded at startup or kept in the cache.
+# Passes over every member download them without caching them, and handlers fetch the single
+# member they need from the API.
+LOW_MEMORY_MODE = False
+
+
+def low_memory_options():
+    """Client options for LOW_MEMORY_MODE."""
+    # Not even members who join are cached: with joined set, discord.py caches every chunk request
+    return {'member_cache_flags': discord.MemberCacheFlags.none(), 'chunk_guilds_at_startup': False}
+
+
+bot_class = commands.AutoShardedBot if SHARDED else commands.Bot
+bot = bot_class(command_prefix='!', intents=intents, max_ratelimit_timeout=RATE_LIMIT_PARK_AFTER,
+                http_trace=metrics.trace_config(), **(low_memory_options() if LOW_MEMORY_MODE else {}))
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.metrics_started = time.perf_counter()
+
+
+@bot.after_invoke
+async def record_command_latency(ctx):
+    # after_invoke runs whether or not the command raised
+    started = getattr(ctx, 'metrics_started', None)
+    if started is not None:
+        metrics.observe(f"command:{ctx.command.qualified_name}", time.perf_counter() - started,
+                        error=ctx.command_failed)
 
 WELCOME_CHANNEL = 'welcome'  # Change to your actual channel name
 RULES_CHANNEL = 'rules'      # Change to your actual channel name
 TEAM_SELECTION_CHANNEL = 'team-selection'  # Change to your actual channel name
 BOT_LOGS_CHANNEL = 'bot-logs'  # New bot logs channel
+SUPPORT_CHANNEL = 'support'  # Support tickets are opened as private threads in this channel
+TICKET_MERGE_WINDOW = 300  # Seconds in which repeats of the same error are merged into one ticket update
 LEAGUE_MEMBER_ROLE = 'League Member'
 ADMIN_ROLE = 'Admin'  # Change to your actual admin role name
 MEDIA_ROLE= "Media Team"
+UNVERIFIED_ROLE = 'Unverified'  # New members before accepting the rules
+ONBOARDED_ROLE = 'Onboarded'  # League Members who have picked a team and nickname
+
+# 'roles': move members between the stage roles below (one API call per step);
+# their channel access comes from role overwrites set once by !setup_permissions.
+# 'overwrites': legacy mode, writes per-member overwrites on every channel.
+ONBOARDING_MODE = 'roles'
+# Onboarding stages in order; each stage lists the stage roles a member holds
+STAGE_ROLES = [UNVERIFIED_ROLE, LEAGUE_MEMBER_ROLE, ONBOARDED_ROLE]
+STAGE_ROLE_SETS = {
+    UNVERIFIED_ROLE: {UNVERIFIED_ROLE},
+    LEAGUE_MEMBER_ROLE: {LEAGUE_MEMBER_ROLE},
+    ONBOARDED_ROLE: {LEAGUE_MEMBER_ROLE, ONBOARDED_ROLE},
+}
+
+# Onboarding job queue: handlers only enqueue, a pool of workers does the API work
+ONBOARDING_DB = 'onboarding_queue.db'  # SQLite file, so queued work survives a restart
+ONBOARDING_WORKERS = 4
+ONBOARDING_PER_GUILD_CONCURRENCY = 2  # Jobs for one guild processed at the same time
+ONBOARDING_PER_GUILD_LIMIT = 5000  # Jobs queued per guild before new ones are rejected
+
+STATE_DB = 'bot_state.db'  # SQLite file for team picks, nicknames, onboarding stage, tickets and rules posts
+# Repeats of a member's rules reaction or change-team click within this many seconds of the
+# last one being handled are ignored, so one member can't spend the server's rate limits
+ONBOARDING_DEBOUNCE = 60
+OPERATIONS_DB = 'operations.db'  # SQLite journal of team and nickname changes, so none is left half-applied
+
+# Discord calls that fail with a 5xx, a timeout or a dropped connection are retried with
+# "full jitter" backoff: a random wait of up to RETRY_BASE_DELAY * 2**attempt seconds, capped
+RETRY_ATTEMPTS = 4  # Tries per call, including the first
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+OPERATION_RESUME_DELAY = 60.0  # Seconds before a change that kept hitting transient errors is tried again
+OPERATION_MAX_RESUMES = 10  # Times such a change is tried again before it is undone and a ticket opened
+# Seconds a nickname stays reserved for a member whose edit hasn't landed. Every try of the
+# change renews it, so it only has to outlast the wait between tries (resume delay plus a park)
+NICKNAME_RESERVATION_TTL = 3 * OPERATION_RESUME_DELAY
+
+MEDIA_CHANNELS = ["trophy-room", "pre-season-all-americans", "247sports-recruits-crystal-ball"]
+STAFF_VC_CHANNEL = "staff only VC"
+RULES_URL = "https://docs.google.com/document/d/1O7-63eLjAuyNGR3VeqJu36Y-rFt6gT1FndROiMtSnn8/edit?usp=sharing"
+
+# Per-server settings for running one bot in several league servers. The channel names, rules
+# link and teams file above are the defaults; GUILD_CONFIG_FILE (optional) overrides them per
+# server: {"<guild id>": {"rules_channel": "league-rules", "teams_file": "fcs_teams.json", ...}}
+GUILD_CONFIG_FILE = 'guild_config.json'
+GuildConfig = collections.namedtuple('GuildConfig', [
+    'welcome_channel', 'rules_channel', 'team_selection_channel', 'bot_logs_channel',
+    'media_channels', 'staff_vc_channel', 'rules_url', 'teams_file', 'support_channel',
+])
+DEFAULT_CONFIG = GuildConfig(WELCOME_CHANNEL, RULES_CHANNEL, TEAM_SELECTION_CHANNEL, BOT_LOGS_CHANNEL,
+                             tuple(MEDIA_CHANNELS), STAFF_VC_CHANNEL, RULES_URL, TEAMS_FILE, SUPPORT_CHANNEL)
+
+
+def load_guild_configs(path):
+    """guild id -> GuildConfig from GUILD_CONFIG_FILE, or {} if there is no such file."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    configs = {}
+    for guild_id, overrides in data.items():
+        unknown = set(overrides) - set(GuildConfig._fields)
+        if unknown:
+            raise ValueError(f"{path}: unknown settings for guild {guild_id}: {', '.join(sorted(unknown))}")
+        if 'media_channels' in overrides:
+            overrides['media_channels'] = tuple(overrides['media_channels'])
+        configs[int(guild_id)] = DEFAULT_CONFIG._replace(**overrides)
+    return configs
+
+
+guild_configs = load_guild_configs(GUILD_CONFIG_FILE)
+# One catalog per teams file; servers using the same file share it
+catalogs = {TEAMS_FILE: catalog}
+for _config in guild_configs.values():
+    if _config.teams_file not in catalogs:
+        catalogs[_config.teams_file] = TeamCatalog.from_file(_config.teams_file)
+
+
+def guild_config(guild):
+    """GuildConfig for a guild (or guild id)."""
+    return guild_configs.get(getattr(guild, 'id', guild), DEFAULT_CONFIG)
+
+
+def catalog_for(guild):
+    """Team catalog for a guild (or guild id)."""
+    return catalogs[guild_config(guild).teams_file]
+
+
+async def guild_members(guild):
+    """Every member of a guild: the cache once it is complete, otherwise downloaded without caching."""
+    if guild.chunked:
+        return guild.members
+    return await guild.chunk(cache=False)
+
+
+async def fetch_member(guild, member_id):
+    """A member from the cache, or from the API when LOW_MEMORY_MODE didn't cache them. None if they left."""
+    member = guild.get_member(member_id)
+    if member is None and not guild.chunked:
+        try:
+            member = await guild.fetch_member(member_id)
+        except discord.NotFound:
+            return None
+    return member
+
+# Desired role overwrites for each kind of channel, applied by !setup_permissions.
+# Keys are role names ('@everyone' is the default role), values are PermissionOverwrite settings.
+# Roles missing from the guild are skipped; overwrites for other roles and members are left alone.
+READ_ONLY = dict(view_channel=True, read_messages=True, send_messages=False)
+POSTING = dict(view_channel=True, read_messages=True, send_messages=True)
+HIDDEN = dict(view_channel=False)
+PERMISSION_POLICY = {
+    # welcome, rules and bot-logs: everyone can view and read, only admin can send
+    'read_only': {
+        '@everyone': READ_ONLY, LEAGUE_MEMBER_ROLE: READ_ONLY, MEDIA_ROLE: READ_ONLY,
+        ADMIN_ROLE: POSTING, UNVERIFIED_ROLE: READ_ONLY, ONBOARDED_ROLE: READ_ONLY,
+    },
+    # team-selection: read-only once the rules are accepted, only admin can send
+    'team_selection': {
+        '@everyone': READ_ONLY, LEAGUE_MEMBER_ROLE: READ_ONLY, MEDIA_ROLE: READ_ONLY,
+        ADMIN_ROLE: POSTING, UNVERIFIED_ROLE: HIDDEN, ONBOARDED_ROLE: READ_ONLY,
+    },
+    # Media channels: Media Team and Admin can post, read-only once the nickname is set
+    'media': {
+        '@everyone': HIDDEN, LEAGUE_MEMBER_ROLE: HIDDEN, ADMIN_ROLE: POSTING, MEDIA_ROLE: POSTING,
+        UNVERIFIED_ROLE: HIDDEN, ONBOARDED_ROLE: READ_ONLY,
+    },
+    # Any channel with "admin" in the name: only admins can view/send
+    'admin': {
+        '@everyone': HIDDEN, LEAGUE_MEMBER_ROLE: HIDDEN, MEDIA_ROLE: HIDDEN, ONBOARDED_ROLE: HIDDEN,
+        ADMIN_ROLE: dict(view_channel=True, send_messages=True), UNVERIFIED_ROLE: HIDDEN,
+    },
+    # All other text channels: hidden until the nickname is set
+    'other': {
+        '@everyone': HIDDEN, LEAGUE_MEMBER_ROLE: HIDDEN, ADMIN_ROLE: HIDDEN,
+        ONBOARDED_ROLE: dict(view_channel=True, send_messages=True), UNVERIFIED_ROLE: HIDDEN,
+    },
+    # support: members can only see and reply in the private ticket threads they're added to
+    'support': {
+        '@everyone': dict(view_channel=True, read_messages=True, send_messages=False, send_messages_in_threads=True,
+                          create_public_threads=False, create_private_threads=False),
+        ADMIN_ROLE: dict(view_channel=True, send_messages=True, manage_threads=True),
+    },
+    # staff only VC: only Admins can view/connect
+    'staff_vc': {
+        '@everyone': dict(view_channel=False, connect=False), ADMIN_ROLE: dict(view_channel=True, connect=True),
+        ONBOARDED_ROLE: dict(view_channel=False, connect=False),
+    },
+}
+
+
+def channel_policy(channel):
+    """Name of the PERMISSION_POLICY entry for a channel, or None if setup_permissions leaves it alone."""
+    config = guild_config(channel.guild)
+    if isinstance(channel, discord.VoiceChannel):
+        return 'staff_vc' if channel.name == config.staff_vc_channel else None
+    if channel.name.startswith("ticket-"):
+        return None  # Ticket channels from before ticket threads keep the overwrites they were created with
+    if channel.name == config.support_channel:
+        return 'support'
+    if channel.name in [config.welcome_channel, config.rules_channel, config.bot_logs_channel]:
+        return 'read_only'
+    if channel.name == config.team_selection_channel:
+        return 'team_selection'
+    if channel.name in config.media_channels:
+        return 'media'
+    if 'admin' in channel.name:
+        return 'admin'
+    return 'other'
+
+
+def plan_channel_overwrites(channel, roles_by_name):
+    """Compare a channel's overwrites with PERMISSION_POLICY.
+
+    Returns (overwrites, changes): the full overwrite mapping to apply with one channel.edit,
+    or None if the channel is already correct, and a list of human-readable changes.
+    """
+    policy = PERMISSION_POLICY.get(channel_policy(channel))
+    if not policy:
+        return None, []
+    current = channel.overwrites
+    overwrites = dict(current)
+    changes = []
+    for role_name, settings in policy.items():
+        role = roles_by_name.get(role_name)
+        if role is None:
+            continue
+        desired = discord.PermissionOverwrite(**settings)
+        existing = current.get(role)
+        if existing != desired:
+            overwrites[role] = desired
+            allowed = ', '.join(p for p, v in desired if v is True) or '-'
+            denied = ', '.join(p for p, v in desired if v is False) or '-'
+            changes.append(f"{role_name}: {'set' if existing is None else 'update'} allow [{allowed}] deny [{denied}]")
+    if not changes:
+        return None, []
+    return overwrites, changes
+
+
+# Discord messages must be <= 2000 characters
+MAX_MESSAGE_LENGTH = 2000
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Split text into pieces of at most limit characters, preferring line and comma boundaries."""
+    pieces = []
+    while len(text) > limit:
+        cut = max(text.rfind("\n", 0, limit), text.rfind(", ", 0, limit - 1))
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+        if text.startswith(", "):
+            text = text[2:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def pack_lines(lines, header=""):
+    """Merge lines into as few messages of at most 2000 characters as possible."""
+    messages = []
+    msg = header
+    for line in lines:
+        for piece in split_message(line):
+            if msg and len(msg) + len(piece) + 1 > MAX_MESSAGE_LENGTH:
+                messages.append(msg)
+                msg = ""
+            msg = f"{msg}\n{piece}" if msg else piece
+    if msg:
+        messages.append(msg)
+    return messages
+
+
+async def send_chunked(destination, lines, header=""):
+    """Send lines to a channel in as few messages as possible."""
+    for msg in pack_lines(lines, header):
+        await destination.send(msg)
+
+
+class BotLogWriter:
+    """Background writer for #bot-logs.
+
+    bot_log() queues an entry and returns at once, so producers never wait on Discord.
+    Entries are merged per guild into messages of at most 2000 characters and sent when a
+    message is full or flush_interval seconds after the oldest pending entry. Severe entries
+    are sent straight away, together with anything queued before them.
+    """
+
+    def __init__(self, flush_interval=2.0, max_queue=10000):
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue = None
+        self._task = None
+        self._pending = {}  # guild id -> [guild, lines, length, first queued at]
+
+    def start(self):
+        """Start the writer task (needs a running event loop)."""
+        if self._task is None or self._task.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(self.max_queue)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def log(self, guild, text, severe=False):
+        if guild is None:
+            return
+        if self._task is None:
+            try:
+                self.start()
+            except RuntimeError:
+                return  # No event loop running yet
+        try:
+            self._queue.put_nowait((guild, str(text), severe))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def flush(self):
+        """Send everything queued so far."""
+        while self._queue is not None and not self._queue.empty():
+            guild, text, _ = self._queue.get_nowait()
+            await self._add(guild, text)
+        for guild_id in list(self._pending):
+            await self._flush(guild_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = None
+            if self._pending:
+                oldest = min(entry[3] for entry in self._pending.values())
+                timeout = max(0.0, oldest + self.flush_interval - loop.time())
+            try:
+                guild, text, severe = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                guild = None
+            try:
+                if guild is not None:
+                    await self._add(guild, text)
+                    if severe:
+                        await self._flush(guild.id)
+                now = loop.time()
+                for guild_id, entry in list(self._pending.items()):
+                    if now - entry[3] >= self.flush_interval:
+                        await self._flush(guild_id)
+            except Exception:
+                pass  # Logging must never take the writer down
+
+    async def _add(self, guild, text):
+        if self.dropped:
+            text = f"({self.dropped} log entries dropped)\n{text}"
+            self.dropped = 0
+        for piece in split_message(text):
+            entry = self._pending.get(guild.id)
+            if entry and entry[2] + len(piece) + 1 > MAX_MESSAGE_LENGTH:
+                await self._flush(guild.id)
+                entry = None
+            if entry is None:
+                entry = self._pending[guild.id] = [guild, [], 0, asyncio.get_running_loop().time()]
+            entry[1].append(piece)
+            entry[2] += len(piece) + (1 if len(entry[1]) > 1 else 0)
+
+    async def _flush(self, guild_id):
+        entry = self._pending.pop(guild_id, None)
+        if not entry:
+            return
+        guild, lines = entry[0], entry[1]
+        channel = get_text_channel(guild, guild_config(guild).bot_logs_channel)
+        if channel:
+            try:
+                await channel.send("\n".join(lines))
+            except Exception:
+                pass
+
+
+bot_logs = BotLogWriter()
+
+
+class AsyncSQLite:
+    """sqlite3 connection whose queries all run on one background thread, off the event loop."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def run(self, func, *args):
+        """Run func(connection, *args) on the database thread and commit."""
+        def call():
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            result = func(self._conn, *args)
+            self._conn.commit()
+            return result
+        return await asyncio.get_running_loop().run_in_executor(self._thread, call)
+
+    async def execute(self, sql, params=()):
+        await self.run(lambda conn: conn.execute(sql, params))
+
+    async def executemany(self, sql, rows):
+        await self.run(lambda conn: conn.executemany(sql, rows))
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+
+OnboardingJob = collections.namedtuple('OnboardingJob', ['guild_id', 'member_id', 'kind', 'enqueued_at'])
+
+
+class OnboardingQueue:
+    """Durable onboarding job queue with a worker pool.
+
+    Jobs are (guild, member, kind). A job already queued or running for the same key is not
+    added again, and each guild has its own concurrency and queue-size limits so one busy
+    guild can't starve the rest. A member's jobs run one at a time, in the order they were
+    queued, so a join can't undo the rules step it raced with. Jobs are written to SQLite before they're queued and deleted
+    once processed, so anything in flight during a crash runs again on the next start.
+    """
+
+    def __init__(self, path, workers=4, per_guild_concurrency=2, per_guild_limit=5000):
+        self.path = path
+        self.workers = workers
+        self.per_guild_concurrency = per_guild_concurrency
+        self.per_guild_limit = per_guild_limit
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_lag = 0.0  # Seconds the most recent job waited before a worker picked it up
+        self._handlers = {}
+        self._pending = {}  # guild id -> deque of jobs
+        self._guild_order = collections.deque()
+        self._keys = set()  # (guild id, member id, kind) queued or running
+        self._busy = set()  # (guild id, member id) with a job running
+        self._inflight = collections.Counter()
+        self._cond = None
+        self._tasks = []
+        self._db = None
+
+    def handler(self, kind):
+        """Register the coroutine that processes jobs of this kind: handler(member)."""
+        def register(func):
+            self._handlers[kind] = func
+            return func
+        return register
+
+    async def start(self):
+        """Load jobs left over from the last run and start the workers."""
+        if self._tasks:
+            return
+        self._cond = asyncio.Condition()
+        self._db = AsyncSQLite(self.path)
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (guild_id INTEGER, member_id INTEGER, kind TEXT, "
+            "enqueued_at REAL, PRIMARY KEY (guild_id, member_id, kind))"
+        )
+        rows = await self._db.fetchall("SELECT guild_id, member_id, kind, enqueued_at FROM jobs ORDER BY enqueued_at")
+        for row in rows:
+            self._push(OnboardingJob(*row))
+        self._tasks = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.workers)]
+
+    def _push(self, job):
+        key = job[:3]
+        self._keys.add(key)
+        if job.guild_id not in self._pending:
+            self._pending[job.guild_id] = collections.deque()
+            self._guild_order.append(job.guild_id)
+        self._pending[job.guild_id].append(job)
+
+    async def enqueue(self, guild_id, member_id, kind):
+        """Queue a job. Returns False if the guild's queue is full, True if queued or already queued."""
+        key = (guild_id, member_id, kind)
+        if key in self._keys:
+            return True
+        if len(self._pending.get(guild_id, ())) >= self.per_guild_limit:
+            self.rejected += 1
+            return False
+        job = OnboardingJob(guild_id, member_id, kind, time.time())
+        self._keys.add(key)  # Claim the key before the await so a duplicate can't slip in
+        try:
+            await self._db.execute("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?)", job)
+        except Exception:
+            self._keys.discard(key)
+            raise
+        async with self._cond:
+            self._push(job)
+            self._cond.notify()
+        return True
+
+    def depth(self, guild_id=None):
+        """Jobs waiting (not yet running), for one guild or all guilds."""
+        if guild_id is not None:
+            return len(self._pending.get(guild_id, ()))
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def lag(self, guild_id=None):
+        """Seconds the oldest waiting job has been queued."""
+        queues = [self._pending.get(guild_id, ())] if guild_id is not None else self._pending.values()
+        oldest = [jobs[0].enqueued_at for jobs in queues if jobs]
+        return time.time() - min(oldest) if oldest else 0.0
+
+    def _next_job(self):
+        # Round-robin over guilds that have work and a free concurrency slot
+        for _ in range(len(self._guild_order)):
+            guild_id = self._guild_order[0]
+            self._guild_order.rotate(-1)
+            jobs = self._pending.get(guild_id)
+            if not jobs or self._inflight[guild_id] >= self.per_guild_concurrency:
+                continue
+            # The oldest job of a member with nothing running; only a few members are ever busy
+            index = next((i for i, job in enumerate(jobs) if job[:2] not in self._busy), None)
+            if index is None:
+                continue
+            job = jobs[index]
+            del jobs[index]
+            if not jobs:
+                del self._pending[guild_id]
+                self._guild_order.remove(guild_id)
+            return job
+        return None
+
+    async def _worker(self):
+        await bot.wait_until_ready()
+        while True:
+            async with self._cond:
+                job = self._next_job()
+                while job is None:
+                    await self._cond.wait()
+                    job = self._next_job()
+                self._inflight[job.guild_id] += 1
+                self._busy.add(job[:2])
+            self.last_lag = time.time() - job.enqueued_at
+            guild = bot.get_guild(job.guild_id)
+            error = False
+            try:
+                member = await fetch_member(guild, job.member_id) if guild else None
+                # Members who left before their job ran are simply dropped
+                if member is not None:
+                    await self._handlers[job.kind](member)
+                self.processed += 1
+            except Exception as e:
+                error = True
+                self.failed += 1
+                bot_log(guild, f"Onboarding step '{job.kind}' failed for <@{job.member_id}>: {e}")
+            finally:
+                # From the event that queued the job to the job being done
+                metrics.observe(f"onboarding:{job.kind}", time.time() - job.enqueued_at, error)
+                try:
+                    await self._db.execute("DELETE FROM jobs WHERE guild_id = ? AND member_id = ? AND kind = ?", job[:3])
+                except Exception:
+                    pass
+                async with self._cond:
+                    self._inflight[job.guild_id] -= 1
+                    self._busy.discard(job[:2])
+                    self._keys.discard(job[:3])
+                    self._cond.notify_all()
+
+
+class MemberState:
+    """What the bot knows about one member: team role name, nickname and onboarding stage role."""
+    __slots__ = ('team', 'nickname', 'stage')
+
+    def __init__(self, team=None, nickname=None, stage=None):
+        self.team = team
+        self.nickname = nickname
+        self.stage = stage
+
+    def as_tuple(self):
+        return (self.team, self.nickname, self.stage)
+
+
+class StateStore:
+    """The bot's own record of members, tickets and rules posts, in SQLite with an in-memory copy.
+
+    Everything is loaded into memory once (load) and reconciled against each guild in a
+    single pass (reconcile), so lookups never touch the database or scan Discord objects.
+    Writes update memory immediately and are persisted on the database thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self.loaded = False
+        self.members = {}  # (guild id, member id) -> MemberState
+        self.team_members = {}  # (guild id, team name) -> set of member ids
+        self.tickets = {}  # (guild id, member id) -> ticket channel id
+        self.rules_messages = {}  # guild id -> id of the !post_rules message
+        self.former_teams = {}  # guild id -> team names dropped from its team list
+
+    async def load(self):
+        self._db = AsyncSQLite(self.path)
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS members (guild_id INTEGER, member_id INTEGER, team TEXT, "
+            "nickname TEXT, stage TEXT, PRIMARY KEY (guild_id, member_id))"
+        )
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tickets (guild_id INTEGER, member_id INTEGER, channel_id INTEGER, "
+            "PRIMARY KEY (guild_id, member_id))"
+        )
+        await self._db.execute("CREATE TABLE IF NOT EXISTS rules_messages (guild_id INTEGER PRIMARY KEY, message_id INTEGER)")
+        await self._db.execute("CREATE TABLE IF NOT EXISTS former_teams (guild_id INTEGER, name TEXT, PRIMARY KEY (guild_id, name))")
+        for guild_id, member_id, team, nickname, stage in await self._db.fetchall("SELECT * FROM members"):
+            self._remember((guild_id, member_id), MemberState(team, nickname, stage))
+        for guild_id, member_id, channel_id in await self._db.fetchall("SELECT * FROM tickets"):
+            self.tickets[(guild_id, member_id)] = channel_id
+        self.rules_messages.update(await self._db.fetchall("SELECT * FROM rules_messages"))
+        for guild_id, name in await self._db.fetchall("SELECT * FROM former_teams"):
+            self.former_teams.setdefault(guild_id, set()).add(name)
+        self.loaded = True
+
+    def _remember(self, key, state):
+        old = self.members.get(key)
+        if old and old.team:
+            self.team_members.get((key[0], old.team), set()).discard(key[1])
+        self.members[key] = state
+        if state.team:
+            self.team_members.setdefault((key[0], state.team), set()).add(key[1])
+
+    def _forget(self, key):
+        old = self.members.pop(key, None)
+        if old and old.team:
+            self.team_members.get((key[0], old.team), set()).discard(key[1])
+
+    @staticmethod
+    def state_of(member):
+        """MemberState as seen on the live member object."""
+        team_role = catalog_for(member.guild).team_for_member(member)
+        stage = None
+        role_names = {role.name for role in member.roles}
+        for name in STAGE_ROLES:  # Later stages win
+            if name in role_names:
+                stage = name
+        return MemberState(team_role.name if team_role else None, member.nick, stage)
+
+    # Lookups (memory only)
+
+    def team_of(self, guild_id, member_id):
+        state = self.members.get((guild_id, member_id))
+        return state.team if state else None
+
+    def stage_of(self, guild_id, member_id):
+        state = self.members.get((guild_id, member_id))
+        return state.stage if state else None
+
+    def members_with_team(self, guild_id, team):
+        return self.team_members.get((guild_id, team), set())
+
+    def ticket_channel(self, guild_id, member_id):
+        return self.tickets.get((guild_id, member_id))
+
+    def rules_message(self, guild_id):
+        return self.rules_messages.get(guild_id)
+
+    def former_teams_of(self, guild_id):
+        """Names known to have been teams in a guild that its team list no longer has."""
+        names = catalog_for(guild_id).names
+        recorded = {team for (key, team), ids in self.team_members.items() if key == guild_id and ids}
+        return (self.former_teams.get(guild_id, set()) | recorded) - names
+
+    # Updates
+
+    async def observe_member(self, member):
+        """Record a member's current team, nickname and stage if they changed."""
+        if member.bot or not self.loaded:
+            return  # Before load, reconcile picks the change up
+        key = (member.guild.id, member.id)
+        state = self.state_of(member)
+        old = self.members.get(key)
+        if old and old.as_tuple() == state.as_tuple():
+            return
+        if old and old.team and old.team not in catalog_for(member.guild).names:
+            await self.retire_teams(member.guild.id, [old.team])
+        self._remember(key, state)
+        await self._db.execute("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)", key + state.as_tuple())
+
+    async def forget_member(self, guild_id, member_id):
+        if self.loaded and (guild_id, member_id) in self.members:
+            self._forget((guild_id, member_id))
+            await self._db.execute("DELETE FROM members WHERE guild_id = ? AND member_id = ?", (guild_id, member_id))
+
+    async def set_ticket(self, guild_id, member_id, channel_id):
+        if not self.loaded:
+            return  # reconcile adopts ticket channels by name
+        if channel_id is None:
+            if self.tickets.pop((guild_id, member_id), None) is not None:
+                await self._db.execute("DELETE FROM tickets WHERE guild_id = ? AND member_id = ?", (guild_id, member_id))
+            return
+        self.tickets[(guild_id, member_id)] = channel_id
+        await self._db.execute("INSERT OR REPLACE INTO tickets VALUES (?, ?, ?)", (guild_id, member_id, channel_id))
+
+    async def set_rules_message(self, guild_id, message_id):
+        if not self.loaded or self.rules_messages.get(guild_id) == message_id:
+            return
+        self.rules_messages[guild_id] = message_id
+        await self._db.execute("INSERT OR REPLACE INTO rules_messages VALUES (?, ?)", (guild_id, message_id))
+
+    async def retire_teams(self, guild_id, names):
+        """Remember teams dropped from a guild's team list; !audit_teams --fix may delete their roles."""
+        names = set(names) - self.former_teams.get(guild_id, set())
+        if not self.loaded or not names:
+            return
+        self.former_teams.setdefault(guild_id, set()).update(names)
+        await self._db.run(lambda conn: conn.executemany(
+            "INSERT OR IGNORE INTO former_teams VALUES (?, ?)", [(guild_id, name) for name in names]))
+
+    async def reconcile(self, guild, members=None):
+        """Bring the stored state for a guild in line with Discord in one pass over its members."""
+        if members is None:
+            members = await guild_members(guild)
+        # Teams members were recorded with that the team list has since dropped
+        await self.retire_teams(guild.id, self.former_teams_of(guild.id))
+        changed = []
+        seen = set()
+        for member in members:
+            if member.bot:
+                continue
+            key = (guild.id, member.id)
+            seen.add(key)
+            state = self.state_of(member)
+            old = self.members.get(key)
+            if not old or old.as_tuple() != state.as_tuple():
+                self._remember(key, state)
+                changed.append(key + state.as_tuple())
+        gone = [key for key in self.members if key[0] == guild.id and key not in seen]
+        for key in gone:
+            self._forget(key)
+        # Adopt open ticket threads (and older ticket channels) that predate the store, and drop
+        # ones that were archived or deleted; archived threads leave the cache
+        for channel in guild.text_channels + list(guild.threads):
+            if channel.name.startswith("ticket-") and channel.name[7:].isdigit():
+                if not getattr(channel, 'archived', False):
+                    self.tickets.setdefault((guild.id, int(channel.name[7:])), channel.id)
+        stale = [key for key, channel_id in self.tickets.items()
+                 if key[0] == guild.id and guild.get_channel_or_thread(channel_id) is None]
+        for key in stale:
+            del self.tickets[key]
+        tickets = [key + (channel_id,) for key, channel_id in self.tickets.items() if key[0] == guild.id]
+
+        def write(conn):
+            conn.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)", changed)
+            conn.executemany("DELETE FROM members WHERE guild_id = ? AND member_id = ?", gone)
+            conn.executemany("DELETE FROM tickets WHERE guild_id = ? AND member_id = ?", stale)
+            conn.executemany("INSERT OR REPLACE INTO tickets VALUES (?, ?, ?)", tickets)
+        await self._db.run(write)
+        return len(changed), len(gone)
+
+
+state_store = StateStore(STATE_DB)
+
+
+onboarding_queue = OnboardingQueue(ONBOARDING_DB, workers=ONBOARDING_WORKERS,
+                                   per_guild_concurrency=ONBOARDING_PER_GUILD_CONCURRENCY,
+                                   per_guild_limit=ONBOARDING_PER_GUILD_LIMIT)
+
+
+def bot_log(guild, text, severe=False):
+    """Queue a message for the guild's #bot-logs channel (never blocks)."""
+    bot_logs.log(guild, text, severe)
+
+
+class GuildIndex:
+    """Name -> text channel / voice channel / role lookups for one guild.
+
+    Each map is built on first use and dropped by the channel/role events, so lookups are
+    O(1) and stay correct as channels and roles are created, renamed or deleted.
+    When several share a name the first in guild order wins, like discord.utils.get.
+    """
+
+    def __init__(self, guild):
+        self.guild = guild
+        self._text_channels = None
+        self._voice_channels = None
+        self._roles = None
+
+    @staticmethod
+    def _by_name(items):
+        index = {}
+        for item in items:
+            index.setdefault(item.name, item)
+        return index
+
+    @property
+    def text_channels(self):
+        if self._text_channels is None:
+            self._text_channels = self._by_name(self.guild.text_channels)
+        return self._text_channels
+
+    @property
+    def voice_channels(self):
+        if self._voice_channels is None:
+            self._voice_channels = self._by_name(self.guild.voice_channels)
+        return self._voice_channels
+
+    @property
+    def roles(self):
+        if self._roles is None:
+            self._roles = self._by_name(self.guild.roles)
+        return self._roles
+
+    def invalidate_channels(self):
+        self._text_channels = None
+        self._voice_channels = None
+
+    def invalidate_roles(self):
+        self._roles = None
+
+
+guild_indexes = {}
+
+
+def guild_index(guild):
+    index = guild_indexes.get(guild.id)
+    if index is None or index.guild is not guild:
+        index = guild_indexes[guild.id] = GuildIndex(guild)
+    return index
+
+
+def get_text_channel(guild, name):
+    return guild_index(guild).text_channels.get(name)
+
+
+def get_voice_channel(guild, name):
+    return guild_index(guild).voice_channels.get(name)
+
+
+def get_role(guild, name):
+    return guild_index(guild).roles.get(name)
+
+
+def use_stage_roles(guild):
+    """True if onboarding should use stage roles for this guild (all stage roles must exist)."""
+    if ONBOARDING_MODE != 'roles':
+        return False
+    return all(get_role(guild, name) for name in STAGE_ROLES)
+
+
+def stage_role_changes(member, stage):
+    """(roles to add, roles to remove) that move a member to an onboarding stage.
+
+    Stage roles only move forward: roles of earlier stages are removed, later ones are kept,
+    and a member already at a later stage gets no changes (at this stage, only missing roles).
+    """
+    guild = member.guild
+    stage_index = STAGE_ROLES.index(stage)
+    held = {role.name for role in member.roles}
+    if any(name in held for name in STAGE_ROLES[stage_index + 1:]):
+        return [], []
+    wanted = [get_role(guild, name) for name in STAGE_ROLE_SETS[stage]]
+    earlier = [get_role(guild, name) for name in STAGE_ROLES[:stage_index]]
+    to_add = [r for r in wanted if r and r not in member.roles]
+    to_remove = [r for r in earlier if r and r in member.roles and r not in wanted]
+    return to_add, to_remove
+
+
+async def set_onboarding_stage(member, stage, **edit_kwargs):
+    """Move a member to an onboarding stage with a single API call (see stage_role_changes).
+
+    Extra keyword arguments (e.g. nick) are sent in the same member edit.
+    Returns True if an API call was made.
+    """
+    to_add, to_remove = stage_role_changes(member, stage)
+    if not to_add and not to_remove:
+        if edit_kwargs:
+            await member.edit(**edit_kwargs)
+            return True
+        return False
+    if not edit_kwargs and len(to_add) + len(to_remove) == 1:
+        if to_add:
+            await member.add_roles(to_add[0])
+        else:
+            await member.remove_roles(to_remove[0])
+        return True
+    # Several role changes (or a nickname as well): swap the whole role list in one PATCH
+    new_roles = [r for r in member.roles if not r.is_default() and r not in to_remove] + to_add
+    await member.edit(roles=new_roles, **edit_kwargs)
+    return True
+
+
+class NicknameIndex:
+    """Case-folded nickname -> member ids for one guild, kept current from member events.
+
+    Lookups are O(1). reserve() claims a nickname for a member until their edit lands (or
+    the reservation expires), so two members submitting the same nickname can't both win.
+    """
+
+    def __init__(self, reservation_ttl=NICKNAME_RESERVATION_TTL):
+        self.reservation_ttl = reservation_ttl
+        self._owners = {}  # folded nickname -> set of member ids
+        self._nick_of = {}  # member id -> folded nickname
+        self._reserved = {}  # folded nickname -> (member id, expires at)
+
+    @classmethod
+    def from_guild(cls, guild, members=None):
+        index = cls()
+        for member in guild.members if members is None else members:
+            index.set(member.id, member.nick)
+        return index
+
+    def set(self, member_id, nick):
+        """Record a member's current nickname (None if they have none)."""
+        self.remove(member_id)
+        if nick:
+            key = nick.casefold()
+            self._owners.setdefault(key, set()).add(member_id)
+            self._nick_of[member_id] = key
+            reservation = self._reserved.get(key)
+            if reservation and reservation[0] == member_id:
+                del self._reserved[key]
+
+    def remove(self, member_id):
+        key = self._nick_of.pop(member_id, None)
+        if key is not None:
+            owners = self._owners.get(key)
+            if owners:
+                owners.discard(member_id)
+                if not owners:
+                    del self._owners[key]
+
+    def is_taken(self, nick, member_id):
+        """True if another member has or has reserved this nickname."""
+        key = nick.casefold()
+        if any(owner != member_id for owner in self._owners.get(key, ())):
+            return True
+        reservation = self._reserved.get(key)
+        if reservation and reservation[0] != member_id:
+            if reservation[1] > time.monotonic():
+                return True
+            del self._reserved[key]
+        return False
+
+    def reserve(self, nick, member_id):
+        """Claim a nickname for a member. Returns False if another member has or holds it."""
+        if self.is_taken(nick, member_id):
+            return False
+        self._reserved[nick.casefold()] = (member_id, time.monotonic() + self.reservation_ttl)
+        return True
+
+    def release(self, nick, member_id):
+        """Drop a member's reservation (e.g. when their nickname edit failed)."""
+        key = nick.casefold()
+        reservation = self._reserved.get(key)
+        if reservation and reservation[0] == member_id:
+            del self._reserved[key]
+
+    def take_over(self, older):
+        """Keep what an index this one replaces learned while this one was built: the nicknames
+        it was told about and its reservations (LOW_MEMORY_MODE starts from an empty index)."""
+        for member_id, key in older._nick_of.items():
+            self.set(member_id, key)
+        now = time.monotonic()
+        for key, (member_id, expires) in older._reserved.items():
+            if expires > now and not self.is_taken(key, member_id):
+                self._reserved[key] = (member_id, expires)
+
+
+class HomeGuildIndex:
+    """user id -> ids of the bot's servers they are in, most recently joined or onboarded last.
+
+    Tells DM interactions (pickers sent before their custom_id carried a server id, /team in
+    DMs) which server they belong to without scanning bot.guilds.
+    """
+
+    def __init__(self):
+        self._guilds = {}
+
+    def add(self, user_id, guild_id):
+        ids = self._guilds.setdefault(user_id, [])
+        if guild_id in ids:
+            ids.remove(guild_id)
+        ids.append(guild_id)
+
+    def add_guild(self, guild, members=None):
+        for member in guild.members if members is None else members:
+            if not member.bot and guild.id not in self._guilds.get(member.id, ()):
+                self.add(member.id, guild.id)
+
+    def remove(self, user_id, guild_id):
+        ids = self._guilds.get(user_id)
+        if ids and guild_id in ids:
+            ids.remove(guild_id)
+            if not ids:
+                del self._guilds[user_id]
+
+    def remove_guild(self, guild):
+        # Scan the index rather than guild.members, which LOW_MEMORY_MODE doesn't keep
+        for user_id in [user_id for user_id, ids in self._guilds.items() if guild.id in ids]:
+            self.remove(user_id, guild.id)
+
+    def resolve(self, user_id):
+        """The user's home server id, or None."""
+        ids = self._guilds.get(user_id)
+        return ids[-1] if ids else None
+
+
+home_guilds = HomeGuildIndex()
+
+
+async def interaction_guild(interaction, guild_id=None):
+    """(guild, member) an interaction acts on: its server, else guild_id (from the custom_id), else
+    the user's home server. (None, None) if the user isn't in that server."""
+    guild = interaction.guild
+    if guild is not None and isinstance(interaction.user, discord.Member):
+        # Interactions in a server carry the member, so LOW_MEMORY_MODE needn't fetch them
+        return guild, interaction.user
+    if guild is None:
+        guild = bot.get_guild(guild_id or home_guilds.resolve(interaction.user.id) or 0)
+    member = await fetch_member(guild, interaction.user.id) if guild else None
+    return (guild, member) if member else (None, None)
+
+
+# Per-guild nickname indexes, built in on_ready
+nickname_indexes = {}
+
+
+def nickname_index(guild):
+    """The guild's NicknameIndex, built from the member cache on first use (index_guild replaces
+    it with one built from the full member list, keeping its reservations)."""
+    index = nickname_indexes.get(guild.id)
+    if index is None:
+        index = nickname_indexes[guild.id] = NicknameIndex.from_guild(guild)
+    return index
+
+
+# A single Discord mutation: label for reports, route key for rate-limit bucketing,
+# and a zero-argument callable returning a fresh coroutine (so it can be retried)
+Mutation = collections.namedtuple('Mutation', ['label', 'route', 'call'])
+
+
+def permission_mutation(channel, target, **perms):
+    """Mutation for channel.set_permissions(target, **perms)."""
+    return Mutation(f"#{channel.name} -> {target.name}", ('channel', channel.id),
+                    lambda: channel.set_permissions(target, **perms))
+
+
+def is_transient(error):
+    """True for errors a retry can fix: 5xx responses, 429s, timeouts and dropped connections."""
+    if isinstance(error, (discord.RateLimited, asyncio.TimeoutError, aiohttp.ClientError, ConnectionError)):
+        return True
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return False
+
+
+def retry_reason(error):
+    """Label for metrics.retries."""
+    if isinstance(error, discord.RateLimited) or getattr(error, 'status', None) == 429:
+        return '429'
+    if isinstance(error, discord.HTTPException):
+        return '5xx'
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    return 'connection'
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def with_retries(call, attempts=RETRY_ATTEMPTS):
+    """Await call() (a zero-argument coroutine function), retrying transient errors with backoff.
+
+    discord.RateLimited (a rate limit longer than RATE_LIMIT_PARK_AFTER) is raised straight away
+    rather than waited out, so an interaction isn't held up by it.
+    """
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt + 1 == attempts or not is_transient(e) or isinstance(e, discord.RateLimited):
+                raise
+            metrics.retries[retry_reason(e)] += 1
+            await asyncio.sleep(backoff_delay(attempt))
+
+
+class MutationSummary:
+    """Per-operation results of an executor run."""
+
+    def __init__(self, total):
+        self.total = total
+        self.succeeded = []
+        self.failed = []  # (label, error)
+        self.elapsed = 0.0
+
+    @property
+    def done(self):
+        return len(self.succeeded) + len(self.failed)
+
+    def describe(self, max_failures=10):
+        text = f"{len(self.succeeded)}/{self.total} succeeded in {self.elapsed:.1f}s"
+        if self.failed:
+            text += f", {len(self.failed)} failed:"
+            for label, error in self.failed[:max_failures]:
+                text += f"\n- {label}: {error}"
+            if len(self.failed) > max_failures:
+                text += f"\n- ...and {len(self.failed) - max_failures} more"
+        return text
+
+
+class MutationExecutor:
+    """Shared executor for permission and role mutations.
+
+    Mutations run concurrently, at most max_concurrency at a time across all commands.
+    Mutations on the same route (e.g. one channel's overwrites, a guild's roles) run one at a
+    time, matching Discord's per-route buckets; discord.py's HTTP client applies the
+    X-RateLimit headers within each bucket. A long 429 parks only its route until
+    retry_after has passed, so other routes keep going.
+    """
+
+    def __init__(self, max_concurrency=8, max_retries=3):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._semaphore = None  # Created on first use, inside the bot's event loop
+        self._route_locks = {}
+        self._route_blocked_until = {}
+
+    async def run(self, mutations, progress=None):
+        """Run mutations and return a MutationSummary. progress(summary) is awaited after each one."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        mutations = list(mutations)
+        summary = MutationSummary(len(mutations))
+        start = time.monotonic()
+
+        async def run_and_record(mutation):
+            error = await self._run_one(mutation)
+            if error is None:
+                summary.succeeded.append(mutation.label)
+            else:
+                summary.failed.append((mutation.label, error))
+            if progress:
+                try:
+                    await progress(summary)
+                except Exception:
+                    pass  # Progress reporting must never fail the run
+
+        await asyncio.gather(*(run_and_record(m) for m in mutations))
+        summary.elapsed = time.monotonic() - start
+        return summary
+
+    async def _run_one(self, mutation):
+        loop = asyncio.get_running_loop()
+        lock = self._route_locks.setdefault(mutation.route, asyncio.Lock())
+        error = None
+        for attempt in range(self.max_retries + 1):
+            backoff = 0
+            async with lock:
+                # Wait out a parked route without holding a concurrency slot
+                wait = self._route_blocked_until.get(mutation.route, 0) - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                async with self._semaphore:
+                    try:
+                        await mutation.call()
+                        return None
+                    except discord.RateLimited as e:
+                        metrics.parked[mutation.route[0]] += 1
+                        self._route_blocked_until[mutation.route] = loop.time() + e.retry_after
+                        error = e
+                    except Exception as e:
+                        if getattr(e, 'status', None) == 429:
+                            metrics.parked[mutation.route[0]] += 1
+                            self._route_blocked_until[mutation.route] = loop.time() + 1.0
+                        elif is_transient(e):
+                            metrics.retries[retry_reason(e)] += 1
+                            backoff = backoff_delay(attempt)
+                        else:
+                            return e
+                        error = e
+            # Back off from 5xx and timeouts outside the route lock
+            if backoff:
+                await asyncio.sleep(backoff)
+        return error
+
+
+mutation_executor = MutationExecutor()
+
+
+def progress_message(ctx, title, interval=2.0, message=None):
+    """Progress callback for MutationExecutor.run that edits one status message in ctx (throttled).
+
+    Pass message to keep editing a status message that is already posted.
+    """
+    state = {'message': message, 'last': 0.0, 'lock': asyncio.Lock()}
+
+    async def report(summary):
+        finished = summary.done == summary.total
+        if not finished and time.monotonic() - state['last'] < interval:
+            return
+        async with state['lock']:
+            state['last'] = time.monotonic()
+            text = f"{title}: {summary.done}/{summary.total} done, {len(summary.failed)} failed"
+            if state['message'] is None:
+                state['message'] = await ctx.send(text)
+            else:
+                await state['message'].edit(content=text)
+
+    return report
+
+
+class OperationJournal:
+    """SQLite journal of multi-step member changes (team role; nickname and channel access).
+
+    An operation's steps are planned from the member's current state, so each step is a real
+    change and remembers what it replaces. The operation is written down before anything runs,
+    and every step checks the member first, so running one again is harmless. Outcomes:
+    - every step applied: the operation is deleted (DONE)
+    - a permanent error: the steps that were applied are undone, newest first, and the
+      operation deleted, so nothing is left half-applied (ROLLED_BACK); the caller opens a ticket
+    - transient errors that outlast the retries: the operation stays in the journal and runs
+      again after resume_delay seconds, and on the next startup (PENDING). After max_resumes
+      such runs it is rolled back like a permanent error, and a ticket opened
+
+    Steps are JSON lists: ['team_role', name], ['nick', new, old],
+    ['stage', stage, nick, old nick, added role ids, removed role ids] and
+    ['overwrite', channel id, allow, deny, old [allow, deny] or None]. Overwrite steps run
+    last, concurrently through mutation_executor.
+    """
+    DONE, PENDING, ROLLED_BACK = 'done', 'pending', 'rolled back'
+
+    def __init__(self, path, resume_delay=OPERATION_RESUME_DELAY, max_resumes=OPERATION_MAX_RESUMES):
+        self.path = path
+        self.resume_delay = resume_delay
+        self.max_resumes = max_resumes
+        self._db = None
+        self._running = set()  # Operation ids being applied
+        self._tasks = set()
+        self._resumed = False
+
+    async def _open(self):
+        if self._db is None:
+            self._db = AsyncSQLite(self.path)
+            await self._db.execute(
+                "CREATE TABLE IF NOT EXISTS operations (id INTEGER PRIMARY KEY, guild_id INTEGER, "
+                "member_id INTEGER, kind TEXT, steps TEXT, created_at REAL, resumes INTEGER DEFAULT 0, "
+                "applied TEXT DEFAULT '[]')"
+            )
+
+    async def run(self, member, kind, steps, attempts=RETRY_ATTEMPTS):
+        """Journal and apply an operation. Returns (status, error); error is None when DONE."""
+        if not steps:
+            return self.DONE, None
+        await self._open()
+        row = (member.guild.id, member.id, kind, json.dumps(steps), time.time())
+        op_id = await self._db.run(lambda conn: conn.execute(
+            "INSERT INTO operations (guild_id, member_id, kind, steps, created_at) VALUES (?, ?, ?, ?, ?)", row
+        ).lastrowid)
+        return await self._apply(op_id, member, steps, attempts)
+
+    async def _apply(self, op_id, member, steps, attempts, final=False, applied=()):
+        # final: the last run allowed, so even a transient error rolls the operation back.
+        # applied: indexes of the steps earlier runs applied
+        self._running.add(op_id)
+        try:
+            applied = set(applied)
+            error = await self._do_all(member, steps, attempts, applied)
+            if error is not None and is_transient(error) and not final:
+                await self._db.execute("UPDATE operations SET applied = ? WHERE id = ?",
+                                       (json.dumps(sorted(applied)), op_id))
+                self._spawn(self._resume_later(op_id))
+                return self.PENDING, error
+            if error is not None:
+                # Only what was applied is undone; steps that never ran have nothing to reverse
+                failed = []
+                for index in sorted(applied, reverse=True):
+                    try:
+                        await with_retries(lambda s=steps[index]: self._undo(member, s))
+                    except Exception as e:
+                        failed.append(f"{steps[index][0]} ({e})")
+                if failed:
+                    bot_log(member.guild, f"Could not undo for {member.mention}: {', '.join(failed)}", severe=True)
+            await self._db.execute("DELETE FROM operations WHERE id = ?", (op_id,))
+            return (self.DONE, None) if error is None else (self.ROLLED_BACK, error)
+        finally:
+            self._running.discard(op_id)
+
+    async def _do_all(self, member, steps, attempts, applied):
+        """Apply steps in order, overwrites last, adding the index of each one that lands to applied.
+        Returns None, or the error that stopped them (a permanent one if there was any)."""
+        for index, step in enumerate(steps):
+            if step[0] != 'overwrite':
+                try:
+                    await with_retries(lambda s=step: self._do(member, s), attempts)
+                except Exception as e:
+                    return e
+                applied.add(index)
+
+        def overwrite(index, step):
+            async def call():
+                await self._do(member, step)
+                applied.add(index)
+            return Mutation(f"#{step[1]} -> {member}", ('channel', step[1]), call)
+        summary = await mutation_executor.run(overwrite(index, step) for index, step in enumerate(steps)
+                                              if step[0] == 'overwrite')
+        errors = [error for _, error in summary.failed]
+        return next((e for e in errors if not is_transient(e)), errors[0] if errors else None)
+
+    async def _do(self, member, step):
+        guild = member.guild
+        kind = step[0]
+        if kind == 'team_role':
+            role = get_role(guild, step[1]) or await guild.create_role(name=step[1])
+            if role not in member.roles:
+                await member.add_roles(role)
+        elif kind == 'nick':
+            claim_nickname(guild, member, step[1])
+            if member.nick != step[1]:
+                await member.edit(nick=step[1])
+            nickname_index(guild).set(member.id, step[1])
+        elif kind == 'stage':
+            claim_nickname(guild, member, step[2])
+            await set_onboarding_stage(member, step[1], **({'nick': step[2]} if member.nick != step[2] else {}))
+            nickname_index(guild).set(member.id, step[2])
+        elif kind == 'overwrite':
+            channel = guild.get_channel(step[1])
+            if channel is not None and channel.overwrites_for(member).pair() != overwrite_pair(step[2], step[3]):
+                await channel.set_permissions(member, overwrite=discord.PermissionOverwrite.from_pair(
+                    discord.Permissions(step[2]), discord.Permissions(step[3])))
+
+    async def _undo(self, member, step):
+        guild = member.guild
+        kind = step[0]
+        if kind == 'team_role':
+            role = get_role(guild, step[1])
+            if role:
+                await member.remove_roles(role)  # The role itself stays; other members may hold it
+        elif kind == 'nick':
+            await member.edit(nick=step[2])
+            nickname_index(guild).set(member.id, step[2])
+            nickname_index(guild).release(step[1], member.id)
+        elif kind == 'stage':
+            # Only reverse this step's own role changes, keeping any made since
+            added = set(step[4])
+            roles = [role for role in member.roles if not role.is_default() and role.id not in added]
+            roles += [discord.Object(role_id) for role_id in step[5] if member.get_role(role_id) is None]
+            await member.edit(roles=roles, nick=step[3])
+            nickname_index(guild).set(member.id, step[3])
+            nickname_index(guild).release(step[2], member.id)
+        elif kind == 'overwrite':
+            channel = guild.get_channel(step[1])
+            if channel is not None:
+                old = step[4]
+                await channel.set_permissions(member, overwrite=None if old is None else discord.PermissionOverwrite.from_pair(
+                    discord.Permissions(old[0]), discord.Permissions(old[1])))
+
+    def start(self):
+        """Resume the operations left by the last run, in the background."""
+        self._spawn(self.resume_all())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resume_later(self, op_id):
+        await asyncio.sleep(self.resume_delay)
+        for row in await self._db.fetchall(
+                "SELECT id, guild_id, member_id, kind, steps, resumes, applied FROM operations WHERE id = ?", (op_id,)):
+            await self._resume(*row)
+
+    async def resume_all(self):
+        """Finish (or undo) the operations left in the journal by the last run. Runs once per process."""
+        if self._resumed:
+            return
+        self._resumed = True
+        await self._open()
+        for row in await self._db.fetchall(
+                "SELECT id, guild_id, member_id, kind, steps, resumes, applied FROM operations ORDER BY id"):
+            await self._resume(*row)
+
+    async def _resume(self, op_id, guild_id, member_id, kind, steps, resumes, applied):
+        if op_id in self._running:
+            return
+        resumes += 1
+        final = resumes >= self.max_resumes
+        await self._db.execute("UPDATE operations SET resumes = ? WHERE id = ?", (resumes, op_id))
+        guild = bot.get_guild(guild_id)
+        try:
+            member = await fetch_member(guild, member_id) if guild else None
+        except discord.HTTPException as e:
+            if not final:
+                self._spawn(self._resume_later(op_id))
+                return
+            # Nothing to undo with or open a ticket for without the member
+            bot_log(guild, f"Gave up on the {kind} change for <@{member_id}> after {resumes} tries: {e}", severe=True)
+            member = None
+        if member is None:
+            # The member (or the bot) left the server; there is nothing left to finish
+            await self._db.execute("DELETE FROM operations WHERE id = ?", (op_id,))
+            return
+        steps = json.loads(steps)
+        status, error = await self._apply(op_id, member, steps, RETRY_ATTEMPTS, final, json.loads(applied))
+        if status == self.DONE:
+            bot_log(guild, f"Finished the {kind} change for {member.mention} after Discord errors.")
+        elif status == self.ROLLED_BACK:
+            tries = f" after {resumes} tries" if is_transient(error) else ""
+            message = f"Could not finish the {kind} change for {member.mention}{tries}, so it was undone: {error}"
+            bot_log(guild, message, severe=True)
+            team = next((step[1] for step in steps if step[0] == 'team_role'), None)
+            await create_ticket(guild, member, message, error_signature(kind, team, error))
+
+
+operation_journal = OperationJournal(OPERATIONS_DB)
+
+
+def claim_nickname(guild, member, nick):
+    """Renew a member's reservation before each try of their nickname edit (a resumed change may
+    have outlived it, or a restart dropped it); a nickname someone else took meanwhile fails it."""
+    if nick and not nickname_index(guild).reserve(nick, member.id):
+        raise ValueError(f"the nickname {nick} was taken by another member in the meantime")
+
+
+def overwrite_pair(allow, deny):
+    """(allow, deny) Permissions, comparable with PermissionOverwrite.pair()."""
+    return discord.Permissions(allow), discord.Permissions(deny)
+
+
+def team_role_steps(member, team_name):
+    role = get_role(member.guild, team_name)
+    return [] if role and role in member.roles else [['team_role', team_name]]
+
+
+def league_channel_access(member):
+    """(channel, permissions) a member gets on every channel once their nickname is set, without stage roles."""
+    guild = member.guild
+    config = guild_config(guild)
+    read_only_channels = [config.welcome_channel, config.rules_channel,
+                          config.bot_logs_channel, config.team_selection_channel]
+    access = []
+    for ch in guild.text_channels:
+        # welcome, rules, bot-logs, team-selection: always read-only
+        if ch.name in read_only_channels:
+            access.append((ch, dict(view_channel=True, send_messages=False)))
+        # Media channels: view/read, only Admin/Media Team can send
+        elif ch.name in config.media_channels:
+            access.append((ch, dict(view_channel=True, send_messages=False)))
+        # Any channel with "admin" in name: hidden
+        elif "admin" in ch.name:
+            access.append((ch, dict(view_channel=False)))
+        # All other channels: view/send
+        else:
+            access.append((ch, dict(view_channel=True, send_messages=True)))
+    # staff only VC: only Admins can view/connect
+    staff_vc = get_voice_channel(guild, config.staff_vc_channel)
+    if staff_vc:
+        access.append((staff_vc, dict(view_channel=False, connect=False)))
+    return access
+
+
+def nickname_steps(member, new_nick):
+    """Journal steps that set a member's nickname and give them access to the league channels."""
+    if use_stage_roles(member.guild):
+        # Nickname and Onboarded role in one call; the role's overwrites grant channel access
+        to_add, to_remove = stage_role_changes(member, ONBOARDED_ROLE)
+        return [['stage', ONBOARDED_ROLE, new_nick, member.nick,
+                 [role.id for role in to_add], [role.id for role in to_remove]]]
+    steps = [['nick', new_nick, member.nick]] if member.nick != new_nick else []
+    for channel, perms in league_channel_access(member):
+        allow, deny = discord.PermissionOverwrite(**perms).pair()
+        current = channel.overwrites_for(member)
+        if current.pair() != (allow, deny):
+            old = None if current.is_empty() else [p.value for p in current.pair()]
+            steps.append(['overwrite', channel.id, allow.value, deny.value, old])
+    return steps
+
+
 @bot.event
+@metrics.timed('event')
+async def on_ready():
+    global guild_indexing
+    for guild in bot.guilds:
+        bot.add_view(TeamPickerView.persistent(guild.id))
+    # Rehydrate stored state, then index and reconcile each guild against it
+    if not state_store.loaded:
+        await state_store.load()
+    # Changes interrupted by the last shutdown or by a Discord outage
+    operation_journal.start()
+    if not LOW_MEMORY_MODE:
+        for guild in bot.guilds:
+            await index_guild(guild)
+    elif guild_indexing is None or guild_indexing.done():
+        # Members are downloaded guild by guild in the background, so startup doesn't wait on them
+        guild_indexing = asyncio.create_task(index_guilds(list(bot.guilds)))
+
+
+# Background task indexing guilds in LOW_MEMORY_MODE
+guild_indexing = None
+
+
+@metrics.timed('startup')
+async def index_guild(guild):
+    """Build a guild's nickname and home-server indexes and reconcile its stored state, from one member list."""
+    members = await guild_members(guild)
+    index = NicknameIndex.from_guild(guild, members)
+    if guild.id in nickname_indexes:
+        index.take_over(nickname_indexes[guild.id])
+    nickname_indexes[guild.id] = index
+    home_guilds.add_guild(guild, members)
+    if state_store.loaded:
+        await state_store.reconcile(guild, members)
+
+
+async def index_guilds(guilds):
+    for guild in guilds:
+        try:
+            await index_guild(guild)
+        except Exception as e:
+            bot_log(guild, f"Indexing members failed: {e}")
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_channel_create(channel):
+    guild_index(channel.guild).invalidate_channels()
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_channel_delete(channel):
+    guild_index(channel.guild).invalidate_channels()
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_channel_update(before, after):
+    if before.name != after.name or before.position != after.position:
+        guild_index(after.guild).invalidate_channels()
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_role_create(role):
+    guild_index(role.guild).invalidate_roles()
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_role_delete(role):
+    guild_index(role.guild).invalidate_roles()
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_role_update(before, after):
+    if before.name != after.name or before.position != after.position:
+        guild_index(after.guild).invalidate_roles()
+
+
+@bot.event
+@metrics.timed('event')
+async def on_member_update(before, after):
+    if before.nick != after.nick:
+        nickname_index(after.guild).set(after.id, after.nick)
+    if before.nick != after.nick or before.roles != after.roles:
+        await state_store.observe_member(after)
+
+
+def watch_uncached_member_updates(state):
+    """Dispatch uncached_member_update for members outside the cache (call before the gateway connects).
+
+    discord.py drops GUILD_MEMBER_UPDATE for members it hasn't cached, which in LOW_MEMORY_MODE
+    is nearly all of them, so the state's parser is wrapped (as TraceRecorder does) to build
+    the member from the raw payload instead.
+    """
+    parser = state.parsers['GUILD_MEMBER_UPDATE']
+
+    def parse(data):
+        try:
+            guild = bot.get_guild(int(data['guild_id']))
+            if guild is not None and guild.get_member(int(data['user']['id'])) is None:
+                bot.dispatch('uncached_member_update', discord.Member(data=data, guild=guild, state=state))
+        except Exception:
+            pass  # Never get in the way of discord.py's own handling
+        parser(data)
+    state.parsers['GUILD_MEMBER_UPDATE'] = parse
+
+
+@bot.event
+@metrics.timed('event')
+async def on_uncached_member_update(member):
+    # No before state: the index and the store skip what they already have
+    nickname_index(member.guild).set(member.id, member.nick)
+    await state_store.observe_member(member)
+
+
+@bot.event
+@metrics.timed('event')
+async def on_raw_member_remove(payload):
+    # The raw event also fires for members LOW_MEMORY_MODE never cached
+    guild = bot.get_guild(payload.guild_id)
+    if guild is not None:
+        nickname_index(guild).remove(payload.user.id)
+    home_guilds.remove(payload.user.id, payload.guild_id)
+    await state_store.forget_member(payload.guild_id, payload.user.id)
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_join(guild):
+    bot.add_view(TeamPickerView.persistent(guild.id))
+    await index_guild(guild)
+
+
+@bot.event
+@metrics.timed('event')
+async def on_guild_remove(guild):
+    home_guilds.remove_guild(guild)
+    nickname_indexes.pop(guild.id, None)
+    guild_indexes.pop(guild.id, None)
+
+
+@bot.event
+@metrics.timed('event')
 async def on_member_join(member):
+    guild = member.guild
+    nickname_index(guild).set(member.id, member.nick)
+    if not member.bot:
+        home_guilds.add(member.id, guild.id)
+    await state_store.observe_member(member)
+    if not await onboarding_queue.enqueue(guild.id, member.id, 'join'):
+        bot_log(guild, f"Onboarding queue is full, could not process {member.mention} joining.", severe=True)
+
+
+@onboarding_queue.handler('join')
+async def onboard_new_member(member):
     # Send welcome message
     guild = member.guild
-    bot_logs_channel = discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL)
-    # On join, only allow welcome, rules, and bot-logs channels to be visible
-    allowed_channels = [WELCOME_CHANNEL, RULES_CHANNEL, BOT_LOGS_CHANNEL]
-    for ch in guild.text_channels:
-        if ch.name in allowed_channels:
-            await ch.set_permissions(member, view_channel=True, send_messages=False)
-        else:
-            await ch.set_permissions(member, view_channel=False)
-    if bot_logs_channel:
-        await bot_logs_channel.send(f"{member.mention} joined the server. Welcome message sent.")
+    league_role = get_role(guild, LEAGUE_MEMBER_ROLE)
+    if league_role and league_role in member.roles:
+        return  # Already accepted the rules (e.g. a join job replayed after a restart)
+    if use_stage_roles(guild):
+        # Unverified role only sees welcome, rules and bot-logs
+        await set_onboarding_stage(member, UNVERIFIED_ROLE)
+    else:
+        # On join, only allow welcome, rules, and bot-logs channels to be visible
+        config = guild_config(guild)
+        allowed_channels = [config.welcome_channel, config.rules_channel, config.bot_logs_channel]
+        mutations = []
+        for ch in guild.text_channels:
+            if ch.name in allowed_channels:
+                mutations.append(permission_mutation(ch, member, view_channel=True, send_messages=False))
+            else:
+                mutations.append(permission_mutation(ch, member, view_channel=False))
+        await mutation_executor.run(mutations)
+    bot_log(guild, f"{member.mention} joined the server. Welcome message sent.")
 
 @bot.command()
 async def post_rules(ctx):
     """Post the rules message and add reaction for role assignment."""
-    if ctx.channel.name != RULES_CHANNEL:
-        await ctx.send(f"Please use this command in #{RULES_CHANNEL}.")
+    config = guild_config(ctx.guild)
+    if ctx.channel.name != config.rules_channel:
+        await ctx.send(f"Please use this command in #{config.rules_channel}.")
         return
-    msg = await ctx.send("Please read the rules and react with ✅ to get access to the league channels.\nFull rules: https://docs.google.com/document/d/1O7-63eLjAuyNGR3VeqJu36Y-rFt6gT1FndROiMtSnn8/edit?usp=sharing")
+    msg = await ctx.send(f"Please read the rules and react with ✅ to get access to the league channels.\nFull rules: {config.rules_url}")
+    # Only reactions on this message start onboarding
+    await state_store.set_rules_message(ctx.guild.id, msg.id)
     await msg.add_reaction("✅")
 
+
+class ActionGuard:
+    """Debounce for actions members can trigger over and over, keyed by (guild id, member id, action).
+
+    begin() claims an action and refuses it while it is running or for window seconds after it
+    last finished; mark() records an action as just done without claiming it first.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._running = set()
+        self._done = {}  # key -> monotonic time it last finished, oldest first
+
+    def recent(self, key):
+        finished = self._done.get(key)
+        return finished is not None and time.monotonic() - finished < self.window
+
+    def begin(self, key):
+        if key in self._running or self.recent(key):
+            return False
+        self._running.add(key)
+        return True
+
+    def finish(self, key, done=True):
+        """Release a claimed action; done=False (it failed) lets it be retried straight away."""
+        self._running.discard(key)
+        if done:
+            self.mark(key)
+
+    def mark(self, key):
+        now = time.monotonic()
+        self._done.pop(key, None)
+        self._done[key] = now
+        # Entries are in finish order, so expired ones are at the front
+        for old in list(itertools.islice(self._done, 64)):
+            if now - self._done[old] < self.window:
+                break
+            del self._done[old]
+
+
+action_guard = ActionGuard(ONBOARDING_DEBOUNCE)
+
+
+def is_rules_message(guild, payload):
+    """True if a reaction is on the server's rules post."""
+    channel = guild.get_channel(payload.channel_id)
+    if channel is None or channel.name != guild_config(guild).rules_channel:
+        return False
+    message_id = state_store.rules_message(guild.id)
+    if message_id is not None:
+        return payload.message_id == message_id
+    # Rules posted before their id was recorded: the bot's own message in the channel
+    return payload.message_author_id == bot.user.id
+
+
+async def deliver_team_picker(guild, member):
+    """DM the team picker unless it was sent to the member in the last ONBOARDING_DEBOUNCE seconds.
+
+    Returns 'sent', 'recent' if it was sent recently and not again, or None if the DM failed.
+    """
+    key = (guild.id, member.id, 'picker')
+    if not action_guard.begin(key):
+        return 'recent'
+    home_guilds.add(member.id, guild.id)
+    try:
+        # One message; its custom_ids name this server
+        await member.send(TEAM_PICKER_PROMPT, view=TeamPickerView(guild.id))
+    except Exception as e:
+        action_guard.finish(key, done=False)
+        bot_log(guild, f"Failed to send team selection dropdown to {member.mention}'s DM: {e}")
+        return None
+    action_guard.finish(key)
+    bot_log(guild, f"Sent team selection dropdown to {member.mention}'s DM.")
+    return 'sent'
+
+
 @bot.event
+@metrics.timed('event')
 async def on_raw_reaction_add(payload):
     if payload.emoji.name != "✅":
         return
     guild = bot.get_guild(payload.guild_id)
-    member = guild.get_member(payload.user_id)
-    channel = guild.get_channel(payload.channel_id)
-    bot_logs_channel = discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL)
-    if channel.name == RULES_CHANNEL:
-        role = discord.utils.get(guild.roles, name=LEAGUE_MEMBER_ROLE)
-        if role and member:
+    if guild is None or payload.user_id == bot.user.id:
+        return
+    if not is_rules_message(guild, payload):
+        return
+    await state_store.set_rules_message(guild.id, payload.message_id)
+    # Un-react/re-react repeats, and members who already accepted and picked a team, need no work
+    if action_guard.recent((guild.id, payload.user_id, 'rules')):
+        return
+    if state_store.team_of(guild.id, payload.user_id) and \
+            state_store.stage_of(guild.id, payload.user_id) in (LEAGUE_MEMBER_ROLE, ONBOARDED_ROLE):
+        return
+    if not await onboarding_queue.enqueue(guild.id, payload.user_id, 'rules'):
+        bot_log(guild, f"Onboarding queue is full, could not process <@{payload.user_id}> accepting the rules.", severe=True)
+
+
+@onboarding_queue.handler('rules')
+async def onboard_rules_accepted(member):
+    guild = member.guild
+    config = guild_config(guild)
+    role = get_role(guild, LEAGUE_MEMBER_ROLE)
+    if role and role in member.roles:
+        # Accepted before: only a member who never got (or lost) the team picker needs it again
+        if not catalog_for(guild).team_for_member(member):
+            await deliver_team_picker(guild, member)
+        action_guard.mark((guild.id, member.id, 'rules'))
+    elif role:
+        if use_stage_roles(guild):
+            # League Member role unlocks #team-selection (read-only except admin)
+            await set_onboarding_stage(member, LEAGUE_MEMBER_ROLE)
+        else:
             await member.add_roles(role)
             # Only unlock #team-selection for the user (read-only except admin)
+            mutations = []
             for ch in guild.text_channels:
-                if ch.name == TEAM_SELECTION_CHANNEL:
-                    await ch.set_permissions(member, view_channel=True, send_messages=False)
-                elif ch.name not in [WELCOME_CHANNEL, RULES_CHANNEL, BOT_LOGS_CHANNEL]:
-                    await ch.set_permissions(member, view_channel=False)
-            if bot_logs_channel:
-                await bot_logs_channel.send(f"{member.mention} has accepted the rules and can now select a team in #{TEAM_SELECTION_CHANNEL}!")
-
-            # Send team selection dropdown to user's DM
-            try:
-                # Group teams by conference
-                conference_teams = {}
-                for conference, teams_list in ncaa_data.items():
-                    conference_teams[conference] = teams_list
-
-                max_options = 25
-                for conference, teams_list in conference_teams.items():
-                    for i in range(0, len(teams_list), max_options):
-                        options = []
-                        for team in teams_list[i:i+max_options]:
-                            options.append(discord.SelectOption(label=team['ScrapedName'], description=team['ScrapedName'], value=team['ScrapedName']))
-                        view = discord.ui.View(timeout=None)
-                        view.add_item(TeamDropdown(options))
-                        await member.send(f"Choose your {conference} conference team:", view=view)
-                if bot_logs_channel:
-                    await bot_logs_channel.send(f"Sent team selection dropdown to {member.mention}'s DM.")
-            except Exception as e:
-                if bot_logs_channel:
-                    await bot_logs_channel.send(f"Failed to send team selection dropdown to {member.mention}'s DM: {e}")
+                if ch.name == config.team_selection_channel:
+                    mutations.append(permission_mutation(ch, member, view_channel=True, send_messages=False))
+                elif ch.name not in [config.welcome_channel, config.rules_channel, config.bot_logs_channel]:
+                    mutations.append(permission_mutation(ch, member, view_channel=False))
+            await mutation_executor.run(mutations)
+        bot_log(guild, f"{member.mention} has accepted the rules and can now select a team in #{config.team_selection_channel}!")
+        await deliver_team_picker(guild, member)
+        action_guard.mark((guild.id, member.id, 'rules'))
+
+
+# Interactive team selection using discord.ui.Select
+
+
+def nickname_matches_team(nick, team_name):
+    """Nicknames must include at least one word of the team name."""
+    return not set(team_name.lower().split()).isdisjoint(nick.lower().split())
+
+
+def default_nickname(member, team_name):
+    """'name | Team' within Discord's 32 characters, shortening the name rather than the team."""
+    suffix = f" | {team_name}"
+    if len(suffix) > 31:
+        return team_name[:32]  # Keeps the team's first words
+    return member.name[:32 - len(suffix)] + suffix
+
+
+async def handle_team_selection(interaction, team_name, guild_id=None):
+    """Give the member their team role, then ask for a nickname (shared by every team picker).
+
+    guild_id: the server a DM picker was sent for; ignored for interactions inside a server.
+    """
+    guild, member = await interaction_guild(interaction, guild_id)
+    if guild is None:
+        await interaction.response.send_message("Could not find your server membership. Please use this in the server.", ephemeral=True)
+        return
+    # Two tries at most: the interaction has to be answered within 3 seconds
+    status, error = await operation_journal.run(member, 'team', team_role_steps(member, team_name), attempts=2)
+    if status == OperationJournal.ROLLED_BACK:
+        error_msg = f"Failed to give role '{team_name}' to user {member} (ID: {member.id}): {error}"
+        bot_log(guild, error_msg, severe=True)
+        await create_ticket(guild, member, error_msg, error_signature('team', team_name, error))
+        await interaction.response.send_message(
+            f"Sorry, I couldn't assign the role '{team_name}' to you. A support ticket has been opened.", ephemeral=True)
+        return
+    if status == OperationJournal.PENDING:
+        # Carry on with the nickname; the journal adds the role once Discord recovers
+        bot_log(guild, f"Giving {member.mention} the '{team_name}' role hit a Discord error ({error}); retrying shortly.")
+
+    class NicknameModal(discord.ui.Modal, title="Set Your Nickname"):
+        # Within 32 characters, keeping the team name whole
+        default_nick = default_nickname(member, team_name)
+        nickname = discord.ui.TextInput(
+            label="Nickname (must include team name)",
+            default=default_nick,
+            min_length=3,
+            max_length=32
+        )
+
+        @metrics.timed('ui')
+        async def on_submit(self, modal_interaction: discord.Interaction):
+            new_nick = self.nickname.value.strip()
+            if not nickname_matches_team(new_nick, team_name):
+                await modal_interaction.response.send_message(f"Your nickname must include at least one word from '{team_name}'. Please try again.", ephemeral=True)
+                return
+            # Reserving checks and claims the nickname in one step, no member scan
+            nicknames = nickname_index(guild)
+            if not nicknames.reserve(new_nick, member.id):
+                await modal_interaction.response.send_message("This nickname is already taken by another member. Please choose a different one.", ephemeral=True)
+                return
+            await modal_interaction.response.defer(ephemeral=True)
+            # Nickname plus channel access as one journaled operation: applied completely or not at all
+            status, error = await operation_journal.run(member, 'nickname', nickname_steps(member, new_nick))
+            if status == OperationJournal.ROLLED_BACK:
+                nicknames.release(new_nick, member.id)
+                error_message = f"Failed to set nickname and channel access (nothing was changed): {error}"
+                bot_log(guild, f"{member.mention} {error_message}", severe=True)
+                await create_ticket(guild, member, error_message, error_signature('nickname', None, error))
+                await modal_interaction.followup.send(f"There was an error setting your nickname. A support ticket has been opened.", ephemeral=True)
+            elif status == OperationJournal.PENDING:
+                bot_log(guild, f"Setting {member.mention}'s nickname to {new_nick} hit a Discord error ({error}); retrying shortly.")
+                await modal_interaction.followup.send("Discord is having trouble right now. Your nickname and channel access will be finished automatically in a minute or two.", ephemeral=True)
+            else:
+                bot_log(guild, f"{member.mention} nickname set to: {new_nick}. Access granted to all league channels.")
+                await modal_interaction.followup.send(f"Your nickname has been set to: {new_nick}. You now have access to all league channels!", ephemeral=True)
+
+    await interaction.response.send_modal(NicknameModal())
+
+
+# Single-message team picker: choosing a conference swaps the team dropdown in place.
+# Every component has a stable custom_id ending in the server id, and one view per server
+# is registered with bot.add_view, so pickers sent before a restart (even by DM) keep
+# working and know which server they belong to. Pickers sent before custom_ids carried
+# the server id are registered without it and resolved through home_guilds.
+TEAM_PICKER_PROMPT = "Choose your conference, then your team:"
+PICKER_CONFERENCE_ID = "team_picker:conference"
+PICKER_TEAM_ID = "team_picker:team:{}"
+
+
+def picker_custom_id(base, guild_id):
+    return f"{base}:{guild_id}" if guild_id else base
+
+
+class ConferencePickerSelect(discord.ui.Select):
+    def __init__(self, guild_id=None, conference=None):
+        self.guild_id = guild_id
+        placeholder = f"Conference: {conference}" if conference else "Choose your conference..."
+        super().__init__(placeholder=placeholder, min_values=1, max_values=1,
+                         options=list(catalog_for(guild_id).conference_options),
+                         custom_id=picker_custom_id(PICKER_CONFERENCE_ID, guild_id))
+
+    @metrics.timed('ui')
+    async def callback(self, interaction: discord.Interaction):
+        conference = self.values[0]
+        guild_id = interaction.guild_id or self.guild_id or home_guilds.resolve(interaction.user.id)
+        if conference not in catalog_for(guild_id).option_chunks:
+            await interaction.response.send_message("That conference no longer exists. Please pick again.", ephemeral=True)
+            return
+        await interaction.response.edit_message(view=TeamPickerView(guild_id, conference))
+
+
+class TeamPickerSelect(discord.ui.Select):
+    def __init__(self, guild_id, index, options, disabled=False, placeholder="Choose your NCAA team..."):
+        self.guild_id = guild_id
+        super().__init__(placeholder=placeholder, min_values=1, max_values=1, options=options,
+                         disabled=disabled, custom_id=picker_custom_id(PICKER_TEAM_ID.format(index), guild_id))
+
+    @metrics.timed('ui')
+    async def callback(self, interaction: discord.Interaction):
+        await handle_team_selection(interaction, self.values[0], self.guild_id)
 
 
-# Interactive team selection using discord.ui.Select
+class TeamPickerView(discord.ui.View):
+    """Conference dropdown plus the team dropdown(s) for the chosen conference, for one server."""
 
-# Discord dropdowns can only have 25 options max
-class TeamSelect(discord.ui.View):
-    def __init__(self, teams):
+    def __init__(self, guild_id=None, conference=None):
         super().__init__(timeout=None)
-        max_options = 25
-        for i in range(0, len(teams), max_options):
-            options = []
-            for team in teams[i:i+max_options]:
-                options.append(discord.SelectOption(label=team['ScrapedName'], description=team['ScrapedName'], value=team['ScrapedName']))
-            self.add_item(TeamDropdown(options))
+        self.add_item(ConferencePickerSelect(guild_id, conference))
+        if conference is None:
+            # Discord needs at least one option, so show a disabled placeholder until a conference is picked
+            waiting = [discord.SelectOption(label="Pick a conference first", value="-")]
+            self.add_item(TeamPickerSelect(guild_id, 0, waiting, disabled=True, placeholder="Pick a conference first"))
+        else:
+            for index, options in enumerate(catalog_for(guild_id).option_chunks[conference]):
+                self.add_item(TeamPickerSelect(guild_id, index, list(options)))
 
-class TeamDropdown(discord.ui.Select):
-    def __init__(self, options):
-        super().__init__(placeholder="Choose your NCAA team...", min_values=1, max_values=1, options=options)
+    @classmethod
+    def persistent(cls, guild_id=None):
+        """View registered with bot.add_view: holds every custom_id a sent picker can contain."""
+        view = cls(guild_id)
+        waiting = [discord.SelectOption(label="-", value="-")]
+        for index in range(1, catalog_for(guild_id).max_chunks):
+            view.add_item(TeamPickerSelect(guild_id, index, waiting))
+        return view
 
-    async def callback(self, interaction: discord.Interaction):
-        team_name = self.values[0]
-        member = interaction.user
-        guild = interaction.guild
-        # If used in DM, interaction.guild is None
-        if guild is None:
-            # Try to find the guild from mutual guilds
-            # You may want to restrict to your bot's main guild if you have multiple
-            if hasattr(member, 'mutual_guilds'):
-                # discord.Member has mutual_guilds, discord.User does not
-                possible_guilds = member.mutual_guilds
-            else:
-                possible_guilds = [g for g in bot.guilds if g.get_member(member.id)]
-            if possible_guilds:
-                guild = possible_guilds[0]
-                member = guild.get_member(member.id)
-            else:
-                await interaction.response.send_message("Could not find your server membership. Please use this in the server.", ephemeral=True)
-                return
+
+def resident_memory():
+    """The process's resident memory in bytes, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
 
 
+def metric_gauges():
+    gauges = [
+        ('ncaa_bot_onboarding_queue_depth', 'Onboarding jobs waiting or running.', onboarding_queue.depth()),
+        ('ncaa_bot_onboarding_queue_lag_seconds', 'Age of the oldest queued onboarding job.',
+         round(onboarding_queue.lag(), 3)),
+        ('ncaa_bot_gateway_latency_seconds', 'Gateway heartbeat latency.',
+         round(bot.latency, 4) if bot.latency == bot.latency else 0),  # NaN before the first heartbeat
+    ]
+    rss = resident_memory()
+    if rss is not None:
+        gauges.append(('ncaa_bot_resident_memory_bytes', 'Resident memory of the bot process.', rss))
+    return gauges
 
-        # Always get bot_logs_channel before any try/except
-        bot_logs_channel = discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL)
 
-        role = discord.utils.get(guild.roles, name=team_name)
-        if not role:
+async def start_metrics_server(port):
+    """Serve metrics.prometheus() on http://127.0.0.1:<port>/metrics (localhost only)."""
+    from aiohttp import web
+
+    async def handle(request):
+        body = metrics.prometheus(metric_gauges())
+        return web.Response(body=body.encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+# Set to a file path to record member joins, reactions, and dropdown/button/modal submits as
+# they arrive, for replaying offline with benchmarks/replay.py; None to disable
+TRACE_FILE = None
+TRACE_FLUSH_INTERVAL = 5.0  # Seconds between writes of the trace buffer to disk
+
+
+class TraceRecorder:
+    """Writes incoming gateway traffic to a compact, anonymized JSONL trace.
+
+    The connection state's parsers for the recorded events are wrapped, so events are written
+    as they arrive, before any handler runs. Each line is one event with its time in seconds
+    since recording started; a header line with a random session id starts each recording.
+    Ids are replaced by numbers in order of first appearance within the recording (the mapping
+    is never written, and numbers restart with each session), names are dropped, and only
+    the team-name words of typed nicknames are kept, so a trace keeps the shape of the traffic
+    but not who sent it. Slash commands are not recorded.
+    """
+
+    EVENTS = ('GUILD_MEMBER_ADD', 'MESSAGE_REACTION_ADD', 'INTERACTION_CREATE')
+    SNOWFLAKE = re.compile(r'\d{15,21}')
+
+    def __init__(self, path, flush_interval=TRACE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._ids = {}  # Discord id -> anonymous id
+        self._team_words = {}  # teams file -> lowercase words of its team names
+        self._file = None
+        self._start = None
+        self._task = None
+
+    def install(self, state):
+        """Start recording the events state parses (call before the gateway connects)."""
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._start = time.monotonic()
+        self._write({'trace': 1, 'session': os.urandom(4).hex(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        for event in self.EVENTS:
+            state.parsers[event] = self._wrap(event, state.parsers[event])
+        self._task = asyncio.create_task(self._flush())
+
+    def _wrap(self, event, parser):
+        def parse(data):
             try:
-                role = await guild.create_role(name=team_name)
-            except Exception as e:
-                error_msg = f"Failed to create role '{team_name}' for user {member} (ID: {member.id}): {e}"
-                if bot_logs_channel:
-                    await bot_logs_channel.send(error_msg)
-                await create_ticket(guild, member, error_msg)
-                await interaction.response.send_message(
-                    f"Sorry, I couldn't create the role for '{team_name}'. A support ticket has been opened.", ephemeral=True)
-                return
-        try:
-            await member.add_roles(role)
-        except Exception as e:
-            error_msg = f"Failed to add role '{team_name}' to user {member} (ID: {member.id}): {e}"
-            if bot_logs_channel:
-                await bot_logs_channel.send(error_msg)
-            await create_ticket(guild, member, error_msg)
-            await interaction.response.send_message(
-                f"Sorry, I couldn't assign the role '{team_name}' to you. A support ticket has been opened.", ephemeral=True)
-            return
+                entry = self.entry(event, data)
+                if entry:
+                    self._write({'t': round(time.monotonic() - self._start, 3), **entry})
+            except Exception:
+                pass  # Recording must never get in the way of handling the event
+            parser(data)
+        return parse
 
-        bot_logs_channel = discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL)
-        class NicknameModal(discord.ui.Modal, title="Set Your Nickname"):
-            # Truncate default value to 32 characters
-            default_nick = f"{member.name} | {team_name}"
-            if len(default_nick) > 32:
-                default_nick = default_nick[:32]
-            nickname = discord.ui.TextInput(
-                label="Nickname (must include team name)",
-                default=default_nick,
-                min_length=3,
-                max_length=32
-            )
+    def anon(self, snowflake):
+        if snowflake is None:
+            return None
+        return self._ids.setdefault(int(snowflake), len(self._ids) + 1)
 
-            async def on_submit(self, modal_interaction: discord.Interaction):
-                new_nick = self.nickname.value.strip()
-                team_words = set(team_name.lower().split())
-                nick_words = set(new_nick.lower().split())
-                if not team_words.intersection(nick_words):
-                    await modal_interaction.response.send_message(f"Your nickname must include at least one word from '{team_name}'. Please try again.", ephemeral=True)
-                    return
-                for m in guild.members:
-                    if m.nick and m.nick.lower() == new_nick.lower() and m.id != member.id:
-                        await modal_interaction.response.send_message("This nickname is already taken by another member. Please choose a different one.", ephemeral=True)
-                        return
-                await modal_interaction.response.defer(ephemeral=True)
-                error_message = None
-                try:
-                    await member.edit(nick=new_nick)
-                    # Channel permission rules after nickname set
-                    media_channels = ["247sports-recruits-crystal-ball", "pre-season-all-americans", "trophy-room"]
-                    read_only_channels = [WELCOME_CHANNEL, RULES_CHANNEL, BOT_LOGS_CHANNEL, TEAM_SELECTION_CHANNEL]
-                    for ch in guild.text_channels:
-                        # welcome, rules, bot-logs, team-selection: always read-only
-                        if ch.name in read_only_channels:
-                            await ch.set_permissions(member, view_channel=True, send_messages=False)
-                        # Media channels: view/read, only Admin/Media Team can send
-                        elif ch.name in media_channels:
-                            await ch.set_permissions(member, view_channel=True, send_messages=False)
-                        # Any channel with "admin" in name: hidden
-                        elif "admin" in ch.name:
-                            await ch.set_permissions(member, view_channel=False)
-                        # All other channels: view/send
-                        else:
-                            await ch.set_permissions(member, view_channel=True, send_messages=True)
-                    # staff only VC: only Admins can view/connect
-                    staff_vc = discord.utils.get(guild.voice_channels, name="staff only VC")
-                    if staff_vc:
-                        await staff_vc.set_permissions(member, view_channel=False, connect=False)
-                except Exception as e:
-                    error_message = f"Failed to set nickname: {e}"
-                if error_message:
-                    if bot_logs_channel:
-                        await bot_logs_channel.send(f"{member.mention} {error_message}")
-                    await create_ticket(guild, member, error_message)
-                    await modal_interaction.followup.send(f"There was an error setting your nickname. A support ticket has been opened.", ephemeral=True)
-                else:
-                    if bot_logs_channel:
-                        await bot_logs_channel.send(f"{member.mention} nickname set to: {new_nick}. Access granted to all league channels.")
-                    await modal_interaction.followup.send(f"Your nickname has been set to: {new_nick}. You now have access to all league channels!", ephemeral=True)
-
-        await interaction.response.send_modal(NicknameModal())
+    def scrub(self, text, user, guild_id):
+        """Typed text with every word that isn't part of a team name replaced by 'user<n>'."""
+        teams_file = guild_config(guild_id).teams_file if guild_id else TEAMS_FILE
+        words = self._team_words.get(teams_file)
+        if words is None:
+            words = self._team_words[teams_file] = {word for team in catalogs[teams_file].teams
+                                                    for word in team.name.lower().split()}
+        out = []
+        for word in text.split():
+            if word.lower() in words or word == '|':
+                out.append(word)
+            elif not out or out[-1] != f"user{user}":
+                out.append(f"user{user}")
+        return " ".join(out)
+
+    def entry(self, event, data):
+        """The trace line for one gateway event, or None to skip it."""
+        guild_id = int(data['guild_id']) if data.get('guild_id') else None
+        if event == 'GUILD_MEMBER_ADD':
+            entry = {'type': 'join', 'guild': self.anon(guild_id), 'user': self.anon(data['user']['id'])}
+            if data['user'].get('bot'):
+                entry['bot'] = True
+            return entry
+        if event == 'MESSAGE_REACTION_ADD':
+            guild = bot.get_guild(guild_id) if guild_id else None
+            channel = guild.get_channel(int(data['channel_id'])) if guild else None
+            message_id = int(data['message_id'])
+            return {
+                'type': 'reaction', 'guild': self.anon(guild_id), 'user': self.anon(data['user_id']),
+                'channel': 'rules' if channel and channel.name == guild_config(guild).rules_channel else 'other',
+                'message': 'rules' if guild and message_id == state_store.rules_message(guild.id) else self.anon(message_id),
+                'bot_message': data.get('message_author_id') == str(bot.user.id),
+                'emoji': data['emoji'].get('name') if not data['emoji'].get('id') else 'custom',
+            }
+        # INTERACTION_CREATE
+        user = self.anon((data.get('member') or {}).get('user', data.get('user', {})).get('id'))
+        inner = data.get('data') or {}
+        if data['type'] == 3:
+            return {
+                'type': 'component', 'guild': self.anon(guild_id), 'user': user,
+                'message': self.anon((data.get('message') or {}).get('id')),
+                'custom_id': self.SNOWFLAKE.sub(lambda m: f"#{self.anon(m.group())}", inner['custom_id']),
+                'component_type': inner['component_type'], 'values': inner.get('values', []),
+            }
+        if data['type'] == 5:
+            values = []
+            pending = list(inner.get('components', []))
+            while pending:
+                component = pending.pop(0)
+                if 'value' in component:
+                    values.append(self.scrub(component['value'], user, guild_id))
+                pending[:0] = component.get('components', []) + ([component['component']] if 'component' in component else [])
+            return {'type': 'modal', 'guild': self.anon(guild_id), 'user': user, 'values': values}
+        return None
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(',', ':'), ensure_ascii=False) + '\n')
+        self.recorded += 1
+
+    async def _flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._file.flush()
+
+
+@bot.event
+@metrics.timed('event')
+async def setup_hook():
+    bot_logs.start()
+    await onboarding_queue.start()
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
+    if TRACE_FILE:
+        TraceRecorder(TRACE_FILE).install(bot._connection)
+    if LOW_MEMORY_MODE:
+        watch_uncached_member_updates(bot._connection)
+    # Re-attach callbacks to pickers and buttons sent before a restart (on_ready adds each server's picker)
+    bot.add_view(TeamPickerView.persistent())
+    bot.add_view(ChangeNicknameView())
+    catalog_reloader.start()
 
 @bot.command()
 async def post_team_selection(ctx):
     """Post interactive team selection dropdown in #team-selection."""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    if ctx.channel.name != TEAM_SELECTION_CHANNEL:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"{ctx.author.mention} tried to post team selection in wrong channel.")
+    if ctx.channel.name != guild_config(ctx.guild).team_selection_channel:
+        bot_log(ctx.guild, f"{ctx.author.mention} tried to post team selection in wrong channel.")
+        return
+    await ctx.send(TEAM_PICKER_PROMPT, view=TeamPickerView(ctx.guild.id))
+
+@metrics.timed('ui')
+async def team_autocomplete(interaction: discord.Interaction, current: str):
+    teams = catalog_for(interaction.guild_id or home_guilds.resolve(interaction.user.id))
+    return [app_commands.Choice(name=f"{team.name} ({team.city}, {team.state})"[:100], value=team.name)
+            for team in teams.search.search(current)]
+
+
+@bot.tree.command(name="team", description="Pick your NCAA team")
+@app_commands.describe(team="Start typing a school, nickname, city or state")
+@app_commands.autocomplete(team=team_autocomplete)
+@metrics.timed('command')
+async def team_command(interaction: discord.Interaction, team: str):
+    """Slash-command alternative to the team picker dropdowns."""
+    teams = catalog_for(interaction.guild_id or home_guilds.resolve(interaction.user.id))
+    if team not in teams.names:
+        suggestions = ", ".join(t.name for t in teams.search.search(team, limit=3))
+        hint = f" Did you mean: {suggestions}?" if suggestions else ""
+        await interaction.response.send_message(
+            f"'{team}' isn't a team. Pick one of the suggestions while typing.{hint}", ephemeral=True)
         return
-    # Group teams by conference
-    conference_teams = {}
-    for conference, teams_list in ncaa_data.items():
-        conference_teams[conference] = teams_list
-
-    max_options = 25
-    for conference, teams_list in conference_teams.items():
-        # Split teams into chunks of 25 for Discord dropdown limit
-        for i in range(0, len(teams_list), max_options):
-            options = []
-            for team in teams_list[i:i+max_options]:
-                options.append(discord.SelectOption(label=team['ScrapedName'], description=team['ScrapedName'], value=team['ScrapedName']))
-            view = discord.ui.View(timeout=None)
-            view.add_item(TeamDropdown(options))
-            await ctx.send(f"Choose your {conference} conference team:", view=view)
+    await handle_team_selection(interaction, team)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def sync_commands(ctx):
+    """Register the bot's slash commands (/team) in this server."""
+    bot.tree.copy_global_to(guild=ctx.guild)
+    synced = await bot.tree.sync(guild=ctx.guild)
+    bot_log(ctx.guild, f"Synced {len(synced)} slash commands: {', '.join('/' + c.name for c in synced)}")
 
 # Example handler for team selection (to be expanded with discord.ui)
 class ChangeNicknameView(discord.ui.View):
@@ -255,67 +2493,51 @@ class ChangeNicknameView(discord.ui.View):
 
 class ChangeNicknameButton(discord.ui.Button):
     def __init__(self):
-        super().__init__(label="Change/Reset Nickname & Team", style=discord.ButtonStyle.primary)
+        super().__init__(label="Change/Reset Nickname & Team", style=discord.ButtonStyle.primary,
+                         custom_id="change_nickname")
 
+    @metrics.timed('ui')
     async def callback(self, interaction: discord.Interaction):
         import discord.errors
         try:
             await interaction.response.defer(ephemeral=True)
         except Exception:
             pass
-        member = interaction.user
-        guild = interaction.guild or None
+        guild, member = await interaction_guild(interaction)
         if guild is None:
-            # Try to find the guild from mutual guilds
-            if hasattr(member, 'mutual_guilds'):
-                possible_guilds = member.mutual_guilds
-            else:
-                possible_guilds = [g for g in bot.guilds if g.get_member(member.id)]
-            if possible_guilds:
-                guild = possible_guilds[0]
-                member = guild.get_member(member.id)
-            else:
-                return
-        bot_logs_channel = discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL)
-        # Remove old team role if present
-        old_team_role = None
-        for role in member.roles:
-            if role.name in [team['ScrapedName'] for team in teams]:
-                old_team_role = role
-                break
-        if old_team_role:
-            await member.remove_roles(old_team_role)
-        # Send team selection dropdown to DM
+            return
+        key = (guild.id, member.id, 'change_team')
+        if not action_guard.begin(key):
+            await interaction.followup.send("A team picker is already in your DMs.", ephemeral=True)
+            return
         try:
-            conference_teams = {}
-            for conference, teams_list in ncaa_data.items():
-                conference_teams[conference] = teams_list
-            max_options = 25
-            for conference, teams_list in conference_teams.items():
-                for i in range(0, len(teams_list), max_options):
-                    options = []
-                    for team in teams_list[i:i+max_options]:
-                        options.append(discord.SelectOption(label=team['ScrapedName'], description=team['ScrapedName'], value=team['ScrapedName']))
-                    view = discord.ui.View(timeout=None)
-                    view.add_item(TeamDropdown(options))
-                    await member.send(f"Choose your {conference} conference team:", view=view)
-            if bot_logs_channel:
-                await bot_logs_channel.send(f"Sent team selection dropdown to {member.mention}'s DM.")
-        except Exception as e:
-            if bot_logs_channel:
-                await bot_logs_channel.send(f"Failed to send team selection dropdown to {member.mention}'s DM: {e}")
+            sent = await deliver_team_picker(guild, member)
+            if sent == 'sent':
+                # Remove old team role if present, only now that there is a picker to choose a new one
+                # Answer from the state store; fall back to the member's roles if it has no record yet
+                old_team = state_store.team_of(guild.id, member.id)
+                old_team_role = get_role(guild, old_team) if old_team else catalog_for(guild).team_for_member(member)
+                if old_team_role and old_team_role in member.roles:
+                    await member.remove_roles(old_team_role)
+            elif sent == 'recent':
+                await interaction.followup.send("A team picker is already in your DMs.", ephemeral=True)
+        except Exception:
+            action_guard.finish(key, done=False)
+            raise
+        action_guard.finish(key, done=sent is not None)
 
 @bot.command()
 async def change_nickname(ctx):
     """Post a button in #team-selection to let users change/reset their nickname and team."""
-    if ctx.channel.name != TEAM_SELECTION_CHANNEL:
-        await ctx.send(f"Please use this command in #{TEAM_SELECTION_CHANNEL}.")
+    channel_name = guild_config(ctx.guild).team_selection_channel
+    if ctx.channel.name != channel_name:
+        await ctx.send(f"Please use this command in #{channel_name}.")
         return
     view = ChangeNicknameView()
     await ctx.send("Want to change your team or nickname? Click below!", view=view)
 async def assign_team_role(member, team_name):
     guild = member.guild
-    role = discord.utils.get(guild.roles, name=team_name)
+    role = get_role(guild, team_name)
     if not role:
         # Create role if it doesn't exist
         role = await guild.create_role(name=team_name)
@@ -324,299 +2546,1199 @@ async def assign_team_role(member, team_name):
     await member.edit(nick=f"{team_name}")
 
 
+# How each staff role reads in log messages: (membership, group)
+STAFF_ROLES = {
+    ADMIN_ROLE: ("an Admin", "Admins"),
+    MEDIA_ROLE: ("in the Media Team", "the Media Team"),
+}
+# Short names accepted by !bulk_roles, besides the full role names
+STAFF_ROLE_ALIASES = {'admin': ADMIN_ROLE, 'media': MEDIA_ROLE}
+MEMBER_REFERENCE = re.compile(r'<@!?(\d+)>|(\d+)')
+
+
+def staff_role_problem(guild, member, action, role_name):
+    """Why adding/removing a staff role for member can't or needn't be done, or None."""
+    role = get_role(guild, role_name)
+    membership = STAFF_ROLES[role_name][0]
+    if action == 'add':
+        if role_name == MEDIA_ROLE:
+            league_role = get_role(guild, LEAGUE_MEMBER_ROLE)
+            if not role or not league_role:
+                return "Required roles do not exist. Run !setup_basic_roles first."
+            if league_role not in member.roles:
+                return f"{member.mention} is not a League Member."
+        elif not role:
+            return f"{role_name} role does not exist. Run !setup_basic_roles first."
+        if role in member.roles:
+            return f"{member.mention} is already {membership}."
+    else:
+        if not role:
+            return f"{role_name} role does not exist."
+        if role not in member.roles:
+            return f"{member.mention} is not {membership}."
+    return None
+
+
+def staff_role_mutation(member, action, role):
+    """Mutation adding or removing role for member (member role changes share the guild's route)."""
+    call = member.add_roles if action == 'add' else member.remove_roles
+    return Mutation(f"{member} {action} {role.name}", ('members', member.guild.id), lambda: call(role))
+
+
+def staff_channel_mutations(guild, member, action, role_name):
+    """The per-member channel overwrites that go with adding/removing a staff role."""
+    mutations = []
+    if role_name == MEDIA_ROLE:
+        # Full access to media channels; removing only revokes posting
+        perms = dict(view_channel=True, send_messages=True) if action == 'add' else dict(send_messages=False)
+        for ch_name in guild_config(guild).media_channels:
+            ch = get_text_channel(guild, ch_name)
+            if ch:
+                mutations.append(permission_mutation(ch, member, **perms))
+        return mutations
+    granted = action == 'add'
+    # Admin channels and the staff only VC
+    for ch in guild.text_channels:
+        if "admin" in ch.name:
+            mutations.append(permission_mutation(ch, member, view_channel=granted, send_messages=granted))
+    staff_vc = get_voice_channel(guild, guild_config(guild).staff_vc_channel)
+    if staff_vc:
+        mutations.append(permission_mutation(staff_vc, member, view_channel=granted, connect=granted))
+    return mutations
+
+
+async def change_staff_role(ctx, member, action, role_name):
+    """Add ('add') or remove ('remove') Admin/Media Team for one member, with its channel access."""
+    problem = staff_role_problem(ctx.guild, member, action, role_name)
+    if problem:
+        bot_log(ctx.guild, problem)
+        return
+    role = get_role(ctx.guild, role_name)
+    if action == 'add':
+        await member.add_roles(role)
+    else:
+        await member.remove_roles(role)
+    summary = await mutation_executor.run(staff_channel_mutations(ctx.guild, member, action, role_name))
+    done = "added to" if action == 'add' else "removed from"
+    bot_log(ctx.guild, f"{member.mention} has been {done} {STAFF_ROLES[role_name][1]}. "
+                       f"Channel access: {summary.describe()}")
+
+
+def plan_bulk_staff_roles(guild, rows, members):
+    """Validate !bulk_roles rows of (label, [member, action, role]).
+
+    members maps every member id the rows reference to its Member (None if not in the server).
+    Returns (changes, skipped, errors): changes are (member, action, role_name) to apply,
+    skipped and errors are (label, reason). Any error means nothing should be applied.
+    """
+    changes, skipped, errors = [], [], []
+    seen = {}  # (member id, role name) -> action
+    for label, fields in rows:
+        if len(fields) != 3:
+            errors.append((label, "expected member, action, role"))
+            continue
+        member_text, action, role_text = fields
+        match = MEMBER_REFERENCE.fullmatch(member_text)
+        member = members.get(int(match.group(1) or match.group(2))) if match else None
+        action = action.lower()
+        role_name = STAFF_ROLE_ALIASES.get(role_text.lower())
+        if role_name is None:
+            role_name = next((name for name in STAFF_ROLES if name.lower() == role_text.lower()), None)
+        if member is None:
+            errors.append((label, f"unknown member '{member_text}'"))
+        elif action not in ('add', 'remove'):
+            errors.append((label, f"unknown action '{action}' (use add or remove)"))
+        elif role_name is None:
+            errors.append((label, f"unknown role '{role_text}' (use admin or media)"))
+        elif seen.get((member.id, role_name), action) != action:
+            errors.append((label, f"{member} is both added to and removed from {role_name}"))
+        elif (member.id, role_name) not in seen:
+            seen[member.id, role_name] = action
+            required = [role_name] + ([LEAGUE_MEMBER_ROLE] if (action, role_name) == ('add', MEDIA_ROLE) else [])
+            missing = [name for name in required if not get_role(guild, name)]
+            problem = staff_role_problem(guild, member, action, role_name)
+            if missing:
+                errors.append((label, f"{', '.join(missing)} role does not exist. Run !setup_basic_roles first."))
+            elif problem:
+                skipped.append((label, problem))
+            else:
+                changes.append((member, action, role_name))
+    return changes, skipped, errors
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def assign_admin_role(ctx, member: discord.Member):
     """Assign Admin role to a user. Usage: !assign_admin_role @user"""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    admin_role = discord.utils.get(ctx.guild.roles, name=ADMIN_ROLE)
-    if not admin_role:
-        if bot_logs_channel:
-            await bot_logs_channel.send("Admin role does not exist. Run !setup_basic_roles first.")
-        return
-    if admin_role in member.roles:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"{member.mention} is already an Admin.")
-        return
-    await member.add_roles(admin_role)
-    # Grant full access to media channels
-    media_channels = ["247sports-recruits-crystal-ball", "pre-season-all-americans", "trophy-room"]
-    for ch_name in media_channels:
-        ch = discord.utils.get(ctx.guild.text_channels, name=ch_name)
-        if ch:
-            await ch.set_permissions(member, view_channel=True, send_messages=True)
-    # Grant access to all admin channels
-    for ch in ctx.guild.text_channels:
-        if "admin" in ch.name:
-            await ch.set_permissions(member, view_channel=True, send_messages=True)
-    # Grant access to staff only VC
-    staff_vc = discord.utils.get(ctx.guild.voice_channels, name="staff only VC")
-    if staff_vc:
-        await staff_vc.set_permissions(member, view_channel=True, connect=True)
-    if bot_logs_channel:
-        await bot_logs_channel.send(f"{member.mention} has been added to Admins.")
+    await change_staff_role(ctx, member, 'add', ADMIN_ROLE)
 
 
-# Command to create League Member and Admin roles
+# Command to create League Member, Admin, Media Team and onboarding stage roles
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def setup_basic_roles(ctx):
-    """Create League Member and Admin roles if they don't exist."""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    created = []
-    for role_name in [LEAGUE_MEMBER_ROLE, ADMIN_ROLE, MEDIA_ROLE]:
-        if not discord.utils.get(ctx.guild.roles, name=role_name):
-            await ctx.guild.create_role(name=role_name)
-            created.append(role_name)
+    """Create League Member, Admin, Media Team, Unverified and Onboarded roles if they don't exist."""
+    mutations = []
+    for role_name in [LEAGUE_MEMBER_ROLE, ADMIN_ROLE, MEDIA_ROLE, UNVERIFIED_ROLE, ONBOARDED_ROLE]:
+        if not get_role(ctx.guild, role_name):
+            mutations.append(Mutation(role_name, ('roles', ctx.guild.id),
+                                      lambda name=role_name: ctx.guild.create_role(name=name)))
+    summary = await mutation_executor.run(mutations)
+    created = summary.succeeded
+    if summary.failed:
+        bot_log(ctx.guild, f"Role setup: {summary.describe()}")
     if created:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"Created roles: {', '.join(created)}")
+        bot_log(ctx.guild, f"Created roles: {', '.join(created)}")
     else:
-        if bot_logs_channel:
-            await bot_logs_channel.send("League Member and Admin roles already exist.")
+        bot_log(ctx.guild, "League Member and Admin roles already exist.")
+
+# Team role colours for !setup_team_roles --colors; conferences not listed keep the default colour
+CONFERENCE_COLORS = {
+    'ACC': 0x013CA6,
+    'American': 0xC8102E,
+    'Big 12': 0xC41230,
+    'Big Ten': 0x0088CE,
+    'Conference USA': 0x00205B,
+    'FBS Independents': 0x7F7F7F,
+    'Mid-American': 0x00843D,
+    'Mountain West': 0x5C2D91,
+    'Pac-12': 0x004B91,
+    'SEC': 0xFFC72C,
+    'Sun Belt': 0xF7A800,
+}
+
+
+def team_role_positions(roles, teams, bot_role_ids):
+    """{role: position} that puts the team roles in catalog (conference) order; {} if they already are.
+
+    roles is the server's role list. The team roles swap the positions they already hold among
+    themselves, so no other role moves (and !audit_teams still sees other roles between them).
+    Roles the bot can't move (at or above its top role) are left alone.
+    """
+    by_name = {role.name: role for role in roles}
+    top = max((role.position for role in roles if role.id in bot_role_ids), default=0)
+    ordered = [by_name[team.name] for team in teams.teams if team.name in by_name]
+    ordered = [role for role in ordered if role.position < top]
+    slots = sorted((role.position for role in ordered), reverse=True)
+    return {role: slot for role, slot in zip(ordered, slots) if role.position != slot}
+
 
 # Command to create all team roles automatically
 @bot.command()
 @commands.has_permissions(administrator=True)
-async def setup_team_roles(ctx):
-    """Create all team roles using ScrapedName from the JSON data."""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    created = []
-    for team in teams:
-        role_name = team['ScrapedName']
-        if not discord.utils.get(ctx.guild.roles, name=role_name):
-            await ctx.guild.create_role(name=role_name)
-            created.append(role_name)
+async def setup_team_roles(ctx, *flags):
+    """Create the missing team roles and list them in conference order.
+
+    Usage: !setup_team_roles [--colors]
+    With --colors, team roles also get their conference's colour from CONFERENCE_COLORS.
+    """
+    guild = ctx.guild
+    teams = catalog_for(guild)
+    colors = '--colors' in flags
+    status = await ctx.send("Setting up team roles...")
+
+    # One pass over the role list; everything else is set and dict lookups
+    existing = {role.name: role for role in guild.roles}
+    missing_names = teams.names - existing.keys()
+    missing = [team for team in teams.teams if team.name in missing_names]
+    mutations = []
+    for team in missing:
+        color = discord.Colour(CONFERENCE_COLORS.get(team.conference, 0)) if colors else discord.Colour.default()
+        mutations.append(Mutation(team.name, ('roles', guild.id),
+                                  lambda name=team.name, color=color: guild.create_role(name=name, colour=color)))
+    recolored = 0
+    if colors:
+        for team in teams.teams:
+            role = existing.get(team.name)
+            color = CONFERENCE_COLORS.get(team.conference)
+            if role and color is not None and role.colour.value != color:
+                recolored += 1
+                mutations.append(Mutation(f"{team.name} (colour)", ('roles', guild.id),
+                                          lambda role=role, color=color: role.edit(colour=discord.Colour(color))))
+    # The role routes share one per-server bucket; the executor sends them back to back and parks
+    # the route on a 429 instead of failing
+    summary = await mutation_executor.run(mutations, progress=progress_message(ctx, "Creating team roles", message=status))
+
+    # Created roles reach the cache through gateway events, so read the current positions from the API
+    created = [label for label in summary.succeeded if label in teams.names]
+    roles = await with_retries(guild.fetch_roles) if created else guild.roles
+    positions = team_role_positions(roles, teams, {role.id for role in guild.me.roles})
+    order = MutationSummary(0)
+    if positions:
+        order = await mutation_executor.run(
+            [Mutation("team role order", ('roles', guild.id),
+                      lambda: guild.edit_role_positions(positions, reason="!setup_team_roles"))],
+            progress=progress_message(ctx, "Ordering team roles", message=status))
+
+    lines = [f"Team roles: {len(created)} created, {len(teams.teams) - len(missing)} already existed"
+             + (f", {recolored} recoloured" if colors else "")
+             + (f", {len(positions)} moved into conference order" if positions and not order.failed else "") + "."]
+    if summary.failed or order.failed:
+        lines.append(f"Failed: {len(summary.failed) + len(order.failed)} (see #{guild_config(guild).bot_logs_channel})")
+    await status.edit(content="\n".join(lines))
+    if summary.failed:
+        bot_log(guild, f"Team role setup: {summary.describe()}")
+    if order.failed:
+        bot_log(guild, f"Ordering team roles: {order.describe()}")
     if created:
-        # Discord messages must be <= 2000 characters
-        msg = "Created roles: "
-        chunk = []
-        total_len = len(msg)
-        for role_name in created:
-            if total_len + len(role_name) + 2 > 2000:
-                if bot_logs_channel:
-                    await bot_logs_channel.send(msg + ", ".join(chunk))
-                chunk = []
-                total_len = len(msg)
-            chunk.append(role_name)
-            total_len += len(role_name) + 2
-        if chunk:
-            if bot_logs_channel:
-                await bot_logs_channel.send(msg + ", ".join(chunk))
-    else:
-        if bot_logs_channel:
-            await bot_logs_channel.send("All team roles already exist.")
+        # The log writer splits this into <= 2000 character messages
+        bot_log(guild, "Created roles: " + ", ".join(created))
+
+
+class CatalogDiff:
+    """What changed between two TeamCatalogs. Renames are matched by School."""
+
+    def __init__(self, old, new):
+        added = [team for team in new.teams if team.name not in old.names]
+        removed = [team for team in old.teams if team.name not in new.names]
+        removed_by_school = {team.school: team for team in removed if team.school}
+        self.renamed = []  # (old Team, new Team)
+        self.added = []
+        for team in added:
+            before = removed_by_school.pop(team.school, None) if team.school else None
+            if before:
+                self.renamed.append((before, team))
+            else:
+                self.added.append(team)
+        renamed_old = {before.name for before, _ in self.renamed}
+        self.removed = [team for team in removed if team.name not in renamed_old]
+        self.moved = []  # (old Team, new Team) with a different conference
+        self.logos = []  # new Teams whose logo changed
+        for team in new.teams:
+            before = old.by_name.get(team.name)
+            if before is None:
+                continue
+            if before.conference != team.conference:
+                self.moved.append((before, team))
+            if before.logo != team.logo:
+                self.logos.append(team)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.renamed or self.moved or self.logos)
+
+    def describe(self):
+        lines = []
+        if self.added:
+            lines.append("Added: " + ", ".join(team.name for team in self.added))
+        if self.removed:
+            lines.append("Removed (roles kept, see !audit_teams): " + ", ".join(team.name for team in self.removed))
+        if self.renamed:
+            lines.append("Renamed: " + ", ".join(f"{old.name} -> {new.name}" for old, new in self.renamed))
+        if self.moved:
+            lines.append("Moved: " + ", ".join(f"{new.name} ({old.conference} -> {new.conference})"
+                                               for old, new in self.moved))
+        if self.logos:
+            lines.append("New logos: " + ", ".join(team.name for team in self.logos))
+        return lines or ["No changes."]
+
+
+def catalog_role_mutations(guild, old, diff):
+    """Create added team roles and rename renamed ones, in guilds that have team roles set up."""
+    if not any(get_role(guild, name) for name in old.names):
+        return []  # !setup_team_roles hasn't been run here
+    mutations = []
+    for before, team in diff.renamed:
+        role = get_role(guild, before.name)
+        if role and not get_role(guild, team.name):
+            mutations.append(Mutation(f"{before.name} -> {team.name}", ('roles', guild.id),
+                                      lambda role=role, name=team.name: role.edit(name=name)))
+        elif not role and not get_role(guild, team.name):
+            mutations.append(Mutation(team.name, ('roles', guild.id),
+                                      lambda name=team.name: guild.create_role(name=name)))
+    for team in diff.added:
+        if not get_role(guild, team.name):
+            mutations.append(Mutation(team.name, ('roles', guild.id),
+                                      lambda name=team.name: guild.create_role(name=name)))
+    return mutations
+
+
+class CatalogReloader:
+    """Re-reads teams files on demand (!reload_teams) or when their mtime changes (watch).
+
+    A file is parsed off the event loop and its catalog replaced in one assignment, so
+    handlers see either the old or the new catalog, never a mix. Only the servers whose
+    teams_file it is are touched.
+    """
+
+    def __init__(self, watch_interval=None):
+        self.watch_interval = watch_interval
+        self._lock = None  # Created on first use, inside the bot's event loop
+        self._mtimes = {}
+        self._task = None
+
+    def start(self):
+        for path in catalogs:
+            try:
+                self._mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                pass
+        if self.watch_interval and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            for path in list(catalogs):
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if mtime == self._mtimes.get(path):
+                    continue
+                try:
+                    await self.reload(path)
+                except Exception as e:
+                    self._mtimes[path] = mtime  # Don't retry (and re-log) until the file changes again
+                    for guild in bot.guilds:
+                        if guild_config(guild).teams_file == path:
+                            bot_log(guild, f"Reloading {path} failed: {e}", severe=True)
+
+    async def reload(self, path=TEAMS_FILE):
+        """Load a teams file and swap in the new catalog. Returns (CatalogDiff, {guild: MutationSummary})."""
+        global catalog
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            mtime = os.stat(path).st_mtime
+            new = await asyncio.to_thread(TeamCatalog.from_file, path)
+            self._mtimes[path] = mtime
+            old = catalogs[path]
+            diff = CatalogDiff(old, new)
+            if not diff:
+                return diff, {}
+            catalogs[path] = new
+            if path == TEAMS_FILE:
+                catalog = new
+                bot.add_view(TeamPickerView.persistent())
+            summaries = {}
+            for guild in bot.guilds:
+                if guild_config(guild).teams_file != path:
+                    continue
+                # Pickers sent earlier may need more team dropdowns for the new catalog
+                bot.add_view(TeamPickerView.persistent(guild.id))
+                summary = await mutation_executor.run(catalog_role_mutations(guild, old, diff))
+                summaries[guild] = summary
+                await state_store.retire_teams(guild.id, [team.name for team in diff.removed])
+                bot_log(guild, "\n".join([f"Reloaded teams from {path}:"] + diff.describe() +
+                                         ([f"Team roles: {summary.describe()}"] if summary.total else [])))
+                if state_store.loaded:
+                    await state_store.reconcile(guild)
+            return diff, summaries
+
+
+catalog_reloader = CatalogReloader(watch_interval=TEAMS_WATCH_INTERVAL)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def reload_teams(ctx):
+    """Reload this server's teams JSON without restarting, creating or renaming only the affected team roles."""
+    path = guild_config(ctx.guild).teams_file
+    try:
+        diff, summaries = await catalog_reloader.reload(path)
+    except Exception as e:
+        await ctx.send(f"Could not reload {path}, keeping the current teams: {e}")
+        return
+    summary = summaries.get(ctx.guild)
+    lines = diff.describe()
+    if summary and summary.total:
+        lines.append(f"Team roles: {summary.describe()}")
+    teams = catalog_for(ctx.guild)
+    await send_chunked(ctx, lines, header=f"Teams reloaded: {len(teams.teams)} teams in {len(teams.conferences)} conferences.")
+
+
+# !sync_team_emojis: team logos are fetched, resized and uploaded as custom emojis, and the emoji
+# codes written into the teams JSON. Processed logos are stored in EMOJI_CACHE_DIR under their
+# SHA-256, so a logo is only fetched and resized once per URL and only uploaded if no emoji in
+# the server already has the same image.
+EMOJI_CACHE_DIR = 'emoji_cache'
+LOGO_URLS_FILE = 'team_logo_urls.json'  # Optional {"<team name>": "<logo url>"} for teams with no URL in the JSON
+LOGO_FETCH_CONCURRENCY = 8
+EMOJI_SIZE = 128  # Logos are resized to fit in EMOJI_SIZE x EMOJI_SIZE pixels
+EMOJI_MAX_BYTES = 256 * 1024  # Discord's size limit for emoji images
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+
+
+def process_logo(data):
+    """Logo image bytes -> PNG that fits EMOJI_SIZE and EMOJI_MAX_BYTES. Blocking; run it in a thread."""
+    try:
+        from PIL import Image
+    except ImportError:
+        # Pillow is optional: without it, logos that are already small PNG/JPEG/GIF files are used as they are
+        if data.startswith(IMAGE_SIGNATURES) and len(data) <= EMOJI_MAX_BYTES:
+            return data
+        raise ValueError("logo is too large or not a PNG/JPEG/GIF; install Pillow to convert and resize it")
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert('RGBA')
+        image.thumbnail((EMOJI_SIZE, EMOJI_SIZE), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format='PNG', optimize=True)
+    if out.tell() > EMOJI_MAX_BYTES:
+        raise ValueError(f"logo is still over {EMOJI_MAX_BYTES // 1024}KB after resizing")
+    return out.getvalue()
+
+
+def write_json_atomic(path, data):
+    """Write JSON to a temporary file and rename it over path, so readers never see half a file.
+
+    Keeps the file's line endings (the teams JSON uses CRLF) and doesn't touch it if the content
+    is the same. Returns True if the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            old = f.read()
+    except FileNotFoundError:
+        old = None
+    newline = '\r\n' if old and b'\r\n' in old else '\n'
+    new = json.dumps(data, indent=2, ensure_ascii=False).replace('\n', newline).encode('utf-8')
+    if new == old:
+        return False
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(new)
+    os.replace(tmp, path)
+    return True
+
+
+class EmojiCache:
+    """Content-addressed store of processed team logos.
+
+    <path>/<sha256>.png holds each processed image. <path>/index.json maps logo URLs and emoji
+    ids to those hashes, so a URL is fetched once and an existing emoji's image is downloaded at
+    most once to learn its hash. Blocking file access; call it from a thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.urls = {}  # logo url -> hash
+        self.emojis = {}  # emoji id (str) -> hash
+        try:
+            with open(os.path.join(path, 'index.json'), encoding='utf-8') as f:
+                index = json.load(f)
+            self.urls, self.emojis = index.get('urls', {}), index.get('emojis', {})
+        except (OSError, ValueError):
+            pass
+
+    def _file(self, digest):
+        return os.path.join(self.path, f"{digest}.png")
+
+    def has_url(self, url):
+        digest = self.urls.get(url)
+        return digest is not None and os.path.exists(self._file(digest))
+
+    def store_logo(self, data):
+        """Process a fetched logo and store it. Returns its hash."""
+        image = process_logo(data)
+        digest = hashlib.sha256(image).hexdigest()
+        if not os.path.exists(self._file(digest)):
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file(digest) + '.tmp', 'wb') as f:
+                f.write(image)
+            os.replace(self._file(digest) + '.tmp', self._file(digest))
+        return digest
+
+    def read(self, digest):
+        with open(self._file(digest), 'rb') as f:
+            return f.read()
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        write_json_atomic(os.path.join(self.path, 'index.json'), {'urls': self.urls, 'emojis': self.emojis})
+
+
+async def fetch_logos(urls, cache):
+    """Fetch, process and cache the logos the cache doesn't have yet, concurrently. Returns {url: error}."""
+    semaphore = asyncio.Semaphore(LOGO_FETCH_CONCURRENCY)
+    errors = {}
+
+    async def fetch(session, url):
+        async with semaphore:
+            try:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+                # Resizing and hashing happen off the event loop
+                cache.urls[url] = await asyncio.to_thread(cache.store_logo, data)
+            except Exception as e:
+                errors[url] = e
+
+    missing = [url for url in urls if not cache.has_url(url)]
+    if missing:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+            await asyncio.gather(*(fetch(session, url) for url in missing))
+    return errors
+
+
+async def guild_emoji_hashes(guild, cache):
+    """Image hash -> Emoji for the server's static emojis (images the cache hasn't seen are downloaded once)."""
+    async def digest_of(emoji):
+        digest = cache.emojis.get(str(emoji.id))
+        if digest is None:
+            try:
+                digest = hashlib.sha256(await emoji.read()).hexdigest()
+            except discord.HTTPException:
+                return None
+            cache.emojis[str(emoji.id)] = digest
+        return digest
+
+    emojis = [emoji for emoji in guild.emojis if not emoji.animated]
+    digests = await asyncio.gather(*(digest_of(emoji) for emoji in emojis))
+    by_hash = {}
+    for emoji, digest in zip(emojis, digests):
+        if digest:
+            by_hash.setdefault(digest, emoji)
+    return by_hash
+
+
+def logo_sources(data, extra):
+    """Team name -> logo URL, from each team's LogoSource, a URL in LogoURL, or LOGO_URLS_FILE."""
+    sources = {}
+    for teams_list in data.values():
+        for entry in teams_list:
+            name = entry.get('ScrapedName')
+            url = entry.get('LogoSource') or entry.get('LogoURL') or ''
+            if not url.startswith(('http://', 'https://')):
+                url = extra.get(name)
+            if url:
+                sources[name] = url
+    return sources
+
+
+def emoji_name(team, taken):
+    """Emoji name for a team (e.g. 'notredame'), not already in taken."""
+    base = re.sub(r'[^a-z0-9]', '', (team.school or team.name).lower())[:30] or 'team'
+    name, n = base, 2
+    while name in taken or len(name) < 2:
+        name, n = f"{base}{n}", n + 1
+    return name
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def sync_team_emojis(ctx):
+    """Upload team logos as custom emojis and write their codes into the teams JSON.
+
+    Only logos with no matching emoji in the server are uploaded, as far as the server's emoji slots allow.
+    """
+    guild = ctx.guild
+    path = guild_config(guild).teams_file
+    teams = catalog_for(guild)
+
+    def read_sources():
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        try:
+            with open(LOGO_URLS_FILE, 'r', encoding='utf-8') as f:
+                extra = json.load(f)
+        except FileNotFoundError:
+            extra = {}
+        return data, logo_sources(data, extra)
+
+    data, sources = await asyncio.to_thread(read_sources)
+    cache = await asyncio.to_thread(EmojiCache, EMOJI_CACHE_DIR)
+    fetch_errors = await fetch_logos(set(sources.values()), cache)
+    existing = await guild_emoji_hashes(guild, cache)
+
+    codes = {}  # team name -> emoji code
+    to_upload = {}  # image hash -> teams with that logo
+    for team in teams.teams:
+        digest = cache.urls.get(sources.get(team.name))
+        if digest is None:
+            continue
+        if digest in existing:
+            codes[team.name] = str(existing[digest])
+        else:
+            to_upload.setdefault(digest, []).append(team)
+    reused = len(codes)
+    free = max(0, guild.emoji_limit - sum(1 for emoji in guild.emojis if not emoji.animated))
+    no_slot = [team for digest in list(to_upload)[free:] for team in to_upload.pop(digest)]
+
+    taken = {emoji.name for emoji in guild.emojis}
+    mutations = []
+    for digest, digest_teams in to_upload.items():
+        name = emoji_name(digest_teams[0], taken)
+        taken.add(name)
+
+        async def upload(digest=digest, digest_teams=digest_teams, name=name):
+            image = await asyncio.to_thread(cache.read, digest)
+            emoji = await guild.create_custom_emoji(name=name, image=image, reason="!sync_team_emojis")
+            cache.emojis[str(emoji.id)] = digest
+            for team in digest_teams:
+                codes[team.name] = str(emoji)
+
+        # One route for the server's emojis: uploads go out one at a time and a 429 parks only them
+        mutations.append(Mutation(f":{name}: ({digest_teams[0].name})", ('emojis', guild.id), upload))
+    summary = await mutation_executor.run(mutations, progress=progress_message(ctx, "Uploading team emojis"))
+    await asyncio.to_thread(cache.save)
+
+    # Write the codes back, keeping the logo URL in LogoSource so the next sync can find it again
+    updated = 0
+    for teams_list in data.values():
+        for entry in teams_list:
+            name = entry.get('ScrapedName')
+            code = codes.get(name)
+            if code and entry.get('LogoURL') != code:
+                entry.setdefault('LogoSource', sources[name])
+                entry['LogoURL'] = code
+                updated += 1
+    if updated and await asyncio.to_thread(write_json_atomic, path, data):
+        await catalog_reloader.reload(path)
+
+    lines = []
+    no_source = [team.name for team in teams.teams if team.name not in sources]
+    if no_source:
+        lines.append(f"No logo URL for {len(no_source)} teams (set LogoSource in {path} or add them to {LOGO_URLS_FILE}): "
+                     + ", ".join(no_source[:AUDIT_LIST_LIMIT]))
+    for url, error in fetch_errors.items():
+        lines.append(f"- Could not fetch {url}: {error}")
+    if no_slot:
+        lines.append(f"No emoji slots left for {len(no_slot)} teams: " + ", ".join(team.name for team in no_slot))
+    if summary.failed:
+        lines.append(f"Uploads: {summary.describe()}")
+    await send_chunked(ctx, lines, header=(
+        f"Team emojis: {len(summary.succeeded)} uploaded, {reused} teams already had one in the server, "
+        f"{updated} codes written to {path}."))
 
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def assign_media_role(ctx, member: discord.Member):
     """Assign Media Team role to a League Member. Usage: !assign_media_role @user"""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    league_role = discord.utils.get(ctx.guild.roles, name=LEAGUE_MEMBER_ROLE)
-    media_role = discord.utils.get(ctx.guild.roles, name=MEDIA_ROLE)
-    if not league_role or not media_role:
-        if bot_logs_channel:
-            await bot_logs_channel.send("Required roles do not exist. Run !setup_basic_roles first.")
-        return
-    if league_role not in member.roles:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"{member.mention} is not a League Member.")
-        return
-    if media_role in member.roles:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"{member.mention} is already in the Media Team.")
-        return
-    await member.add_roles(media_role)
-    # Grant full access to media channels
-    media_channels = ["247sports-recruits-crystal-ball", "pre-season-all-americans", "trophy-room"]
-    for ch_name in media_channels:
-        ch = discord.utils.get(ctx.guild.text_channels, name=ch_name)
-        if ch:
-            await ch.set_permissions(member, view_channel=True, send_messages=True)
-    if bot_logs_channel:
-        await bot_logs_channel.send(f"{member.mention} has been added to the Media Team.")
+    await change_staff_role(ctx, member, 'add', MEDIA_ROLE)
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def remove_media_role(ctx, member: discord.Member):
     """Remove Media Team role from a user and revoke media channel access."""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    media_role = discord.utils.get(ctx.guild.roles, name=MEDIA_ROLE)
-    if not media_role:
-        if bot_logs_channel:
-            await bot_logs_channel.send("Media Team role does not exist.")
-        return
-    if media_role not in member.roles:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"{member.mention} is not in the Media Team.")
-        return
-    await member.remove_roles(media_role)
-    # Revoke send access to media channels
-    media_channels = ["247sports-recruits-crystal-ball", "pre-season-all-americans", "trophy-room"]
-    for ch_name in media_channels:
-        ch = discord.utils.get(ctx.guild.text_channels, name=ch_name)
-        if ch:
-            await ch.set_permissions(member, send_messages=False)
-    if bot_logs_channel:
-        await bot_logs_channel.send(f"{member.mention} has been removed from the Media Team.")
+    await change_staff_role(ctx, member, 'remove', MEDIA_ROLE)
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def remove_admin_role(ctx, member: discord.Member):
     """Remove Admin role from a user and revoke admin channel and staff only VC access."""
-    bot_logs_channel = discord.utils.get(ctx.guild.text_channels, name=BOT_LOGS_CHANNEL)
-    admin_role = discord.utils.get(ctx.guild.roles, name=ADMIN_ROLE)
-    if not admin_role:
-        if bot_logs_channel:
-            await bot_logs_channel.send("Admin role does not exist.")
+    await change_staff_role(ctx, member, 'remove', ADMIN_ROLE)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def bulk_roles(ctx, *args):
+    """Add or remove Admin/Media Team for many members at once.
+
+    Usage: !bulk_roles <add|remove> <admin|media> @user1 @user2 ...
+    or attach a CSV with one "member id,action,role" row per member.
+    """
+    rows = []
+    if ctx.message.attachments:
+        data = await ctx.message.attachments[0].read()
+        try:
+            text = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            await ctx.send("The attached CSV must be UTF-8 text.")
+            return
+        for line_no, fields in enumerate(csv.reader(io.StringIO(text)), start=1):
+            fields = [field.strip() for field in fields]
+            if not any(fields):
+                continue
+            if line_no == 1 and not MEMBER_REFERENCE.fullmatch(fields[0]):
+                continue  # Header row
+            rows.append((f"line {line_no}", fields))
+    elif len(args) >= 3:
+        action, role_text = args[0], args[1]
+        rows = [(arg, [arg, action, role_text]) for arg in args[2:]]
+    if not rows:
+        await ctx.send("Usage: `!bulk_roles <add|remove> <admin|media> @user ...` "
+                       "or attach a CSV of member id,action,role rows.")
         return
-    if admin_role not in member.roles:
-        if bot_logs_channel:
-            await bot_logs_channel.send(f"{member.mention} is not an Admin.")
+
+    # Look the members up before validating, since LOW_MEMORY_MODE fetches them from the API
+    members = {}
+    for _, fields in rows:
+        match = MEMBER_REFERENCE.fullmatch(fields[0]) if fields else None
+        member_id = int(match.group(1) or match.group(2)) if match else None
+        if member_id is not None and member_id not in members:
+            members[member_id] = await fetch_member(ctx.guild, member_id)
+    changes, skipped, errors = plan_bulk_staff_roles(ctx.guild, rows, members)
+    if errors:
+        lines = [f"- {label}: {reason}" for label, reason in errors]
+        await send_chunked(ctx, lines, header=f"Nothing was changed; {len(errors)} invalid rows:")
         return
-    await member.remove_roles(admin_role)
-    # Revoke access to admin channels
-    for ch in ctx.guild.text_channels:
-        if "admin" in ch.name:
-            await ch.set_permissions(member, view_channel=False, send_messages=False)
-    # Revoke access to staff only VC
-    staff_vc = discord.utils.get(ctx.guild.voice_channels, name="staff only VC")
-    if staff_vc:
-        await staff_vc.set_permissions(member, view_channel=False, connect=False)
-    if bot_logs_channel:
-        await bot_logs_channel.send(f"{member.mention} has been removed from Admins.")
+
+    # Role changes first; channel access only for members whose role change went through
+    progress = progress_message(ctx, "Bulk role changes")
+    role_mutations = {}
+    for member, action, role_name in changes:
+        mutation = staff_role_mutation(member, action, get_role(ctx.guild, role_name))
+        role_mutations[mutation.label] = (mutation, member, action, role_name)
+    role_summary = await mutation_executor.run([m for m, *_ in role_mutations.values()], progress=progress)
+    channel_mutations = []
+    for label in role_summary.succeeded:
+        _, member, action, role_name = role_mutations[label]
+        channel_mutations.extend(staff_channel_mutations(ctx.guild, member, action, role_name))
+    channel_summary = await mutation_executor.run(channel_mutations, progress=progress_message(ctx, "Channel access"))
+
+    header = (f"Bulk roles: {len(role_summary.succeeded)} applied, {len(skipped)} skipped, "
+              f"{len(role_summary.failed)} failed; channel access {len(channel_summary.succeeded)}/"
+              f"{channel_summary.total} in {role_summary.elapsed + channel_summary.elapsed:.1f}s.")
+    lines = [f"- failed: {label}: {error}" for label, error in role_summary.failed + channel_summary.failed]
+    lines += [f"- skipped: {label}: {reason}" for label, reason in skipped]
+    await send_chunked(ctx, lines, header=header)
+    bot_log(ctx.guild, f"{ctx.author.mention} ran !bulk_roles. {header}")
 
 # Command to set channel permissions
 @bot.command()
 @commands.has_permissions(administrator=True)
-async def setup_permissions(ctx):
+async def setup_permissions(ctx, *flags):
+    """Set channel permissions from PERMISSION_POLICY, changing only what differs.
+
+    Usage: !setup_permissions [--dry-run]
+    """
     guild = ctx.guild
-    # Create 'staff only VC' voice channel if it doesn't exist
-    staff_vc_name = "staff only VC"
-    if not discord.utils.get(guild.voice_channels, name=staff_vc_name):
-        await guild.create_voice_channel(staff_vc_name)
-
-    """Set channel permissions for welcome, rules, league, and admin-only channels."""
-    everyone = guild.default_role
-    league_member = discord.utils.get(guild.roles, name=LEAGUE_MEMBER_ROLE)
-    admin = discord.utils.get(guild.roles, name=ADMIN_ROLE)
+    dry_run = '--dry-run' in flags
+    league_member = get_role(guild, LEAGUE_MEMBER_ROLE)
+    admin = get_role(guild, ADMIN_ROLE)
     if not league_member or not admin:
-        if bot_logs_channel:
-            await bot_logs_channel.send("Please run !setup_basic_roles first.")
+        bot_log(guild, "Please run !setup_basic_roles first.")
         return
-    changed = []
-    # Create special media channels if they don't exist
-    media_channels = [
-        "trophy-room",
-        "pre-season-all-americans",
-        "247sports-recruits-crystal-ball"
-    ]
-    bot_logs_channel = discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL)
-    for ch_name in media_channels:
-        if not discord.utils.get(guild.text_channels, name=ch_name):
-            await guild.create_text_channel(ch_name)
-    # Ensure bot-logs channel exists
-    if not discord.utils.get(guild.text_channels, name=BOT_LOGS_CHANNEL):
-        await guild.create_text_channel(BOT_LOGS_CHANNEL)
-
-    for channel in guild.text_channels:
-        # Welcome and rules: everyone can view and read
-        if channel.name in [WELCOME_CHANNEL, RULES_CHANNEL]:
-            await channel.set_permissions(everyone, view_channel=True, read_messages=True, send_messages=False)
-            await channel.set_permissions(league_member, view_channel=True, read_messages=True, send_messages=False)
-            media_role = discord.utils.get(guild.roles, name=MEDIA_ROLE)
-            if media_role:
-                await channel.set_permissions(media_role, view_channel=True, read_messages=True, send_messages=False)
-            await channel.set_permissions(admin, view_channel=True, read_messages=True, send_messages=True)
-            changed.append(channel.name)
-        # bot-logs: everyone can view and read, only admin can send
-        elif channel.name == BOT_LOGS_CHANNEL:
-            await channel.set_permissions(everyone, view_channel=True, read_messages=True, send_messages=False)
-            await channel.set_permissions(league_member, view_channel=True, read_messages=True, send_messages=False)
-            media_role = discord.utils.get(guild.roles, name=MEDIA_ROLE)
-            if media_role:
-                await channel.set_permissions(media_role, view_channel=True, read_messages=True, send_messages=False)
-            await channel.set_permissions(admin, view_channel=True, read_messages=True, send_messages=True)
-            changed.append(channel.name)
-        # team-selection: everyone can view and read, only admin can send
-        elif channel.name == TEAM_SELECTION_CHANNEL:
-            await channel.set_permissions(everyone, view_channel=True, read_messages=True, send_messages=False)
-            await channel.set_permissions(league_member, view_channel=True, read_messages=True, send_messages=False)
-            media_role = discord.utils.get(guild.roles, name=MEDIA_ROLE)
-            if media_role:
-                await channel.set_permissions(media_role, view_channel=True, read_messages=True, send_messages=False)
-            await channel.set_permissions(admin, view_channel=True, read_messages=True, send_messages=True)
-            changed.append(channel.name)
-        # Media channels: hidden from League Members by default, only Media Team and Admin can view/post
-        elif channel.name in media_channels:
-            await channel.set_permissions(everyone, view_channel=False)
-            await channel.set_permissions(league_member, view_channel=False)  # Hide from League Members until nickname is set
-            await channel.set_permissions(admin, view_channel=True, read_messages=True, send_messages=True)
-            media_role = discord.utils.get(guild.roles, name=MEDIA_ROLE)
-            if media_role:
-                await channel.set_permissions(media_role, view_channel=True, read_messages=True, send_messages=True)
-            changed.append(channel.name)
+    plan = []
+    # Create special media channels, bot-logs, support and 'staff only VC' if they don't exist
+    config = guild_config(guild)
+    missing_text = [name for name in config.media_channels + (config.bot_logs_channel, config.support_channel)
+                    if not get_text_channel(guild, name)]
+    missing_vc = not get_voice_channel(guild, config.staff_vc_channel)
+    if dry_run:
+        plan += [f"create #{name}" for name in missing_text]
+        if missing_vc:
+            plan.append(f"create voice channel {config.staff_vc_channel}")
+    else:
+        for name in missing_text:
+            await guild.create_text_channel(name)
+        if missing_vc:
+            await guild.create_voice_channel(config.staff_vc_channel)
+
+    # One name -> role lookup for the whole run
+    roles_by_name = dict(guild_index(guild).roles)
+    roles_by_name['@everyone'] = guild.default_role
+    mutations = []
+    for channel in guild.text_channels + guild.voice_channels:
+        overwrites, changes = plan_channel_overwrites(channel, roles_by_name)
+        if overwrites is None:
+            continue
+        plan += [f"#{channel.name} {change}" for change in changes]
+        mutations.append(Mutation(f"#{channel.name}", ('channel', channel.id),
+                                  lambda ch=channel, ow=overwrites: ch.edit(overwrites=ow)))
+
+    if dry_run:
+        if plan:
+            await send_chunked(ctx, plan, header=f"Permission plan ({len(mutations)} channels to edit):")
         else:
-            # All other channels hidden from @everyone by default
-            await channel.set_permissions(everyone, view_channel=False)
-            # Admin-only channels: only admins can view/send
-            if 'admin' in channel.name:
-                await channel.set_permissions(league_member, view_channel=False)
-                media_role = discord.utils.get(guild.roles, name=MEDIA_ROLE)
-                if media_role:
-                    await channel.set_permissions(media_role, view_channel=False)
-                await channel.set_permissions(admin, view_channel=True, send_messages=True)
-            # #team-selection: only League Members and Admins
-            elif channel.name == TEAM_SELECTION_CHANNEL:
-                await channel.set_permissions(league_member, view_channel=True, send_messages=True)
-                await channel.set_permissions(admin, view_channel=True, send_messages=True)
-            # Other channels: only League Members and Admins
-            else:
-                await channel.set_permissions(league_member, view_channel=False)
-                await channel.set_permissions(admin, view_channel=False)
-            changed.append(channel.name)
+            await ctx.send("Permissions are already up to date. Nothing to change.")
+        return
+    if not mutations:
+        return  # Not even a log post, so a correct server sees no writes at all (--dry-run reports it)
+    summary = await mutation_executor.run(mutations, progress=progress_message(ctx, "Setting permissions"))
+    bot_log(guild, f"Permissions set for channels: {', '.join(summary.succeeded)}")
+    if summary.failed:
+        bot_log(guild, f"Permission changes: {summary.describe()}")
 
-    # Set permissions for 'staff only VC' voice channel
-    staff_vc = discord.utils.get(guild.voice_channels, name=staff_vc_name)
-    if staff_vc:
-        await staff_vc.set_permissions(everyone, view_channel=False, connect=False)
-        await staff_vc.set_permissions(admin, view_channel=True, connect=True)
-        changed.append(staff_vc.name)
-    if bot_logs_channel:
-        await bot_logs_channel.send(f"Permissions set for channels: {', '.join(changed)}")
+# Admin command to move from per-member overwrites to onboarding stage roles
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def migrate_member_overwrites(ctx):
+    """Give members their onboarding stage role and remove per-member channel overwrites in bulk."""
+    guild = ctx.guild
+    if not all(get_role(guild, name) for name in STAGE_ROLES):
+        await ctx.send("Onboarding stage roles do not exist. Run !setup_basic_roles and !setup_permissions first.")
+        return
+    # Assign stage roles first so nobody loses access while their overwrites are removed
+    league_role = get_role(guild, LEAGUE_MEMBER_ROLE)
+    stage_role_names = set(STAGE_ROLES)
+    team_names = catalog_for(guild).names
+    member_mutations = []
+    for member in await guild_members(guild):
+        if member.bot:
+            continue
+        role_names = {r.name for r in member.roles}
+        stage = None
+        if league_role in member.roles:
+            # League Members who already picked a team have finished onboarding
+            if role_names & team_names and ONBOARDED_ROLE not in role_names:
+                stage = ONBOARDED_ROLE
+        elif not role_names & stage_role_names:
+            stage = UNVERIFIED_ROLE
+        if stage:
+            member_mutations.append(Mutation(f"{member} -> {stage}", ('members', guild.id),
+                                             lambda m=member, st=stage: set_onboarding_stage(m, st)))
+    member_summary = await mutation_executor.run(member_mutations, progress=progress_message(ctx, "Assigning stage roles"))
+    # One edit per channel keeps every role overwrite and drops all member overwrites
+    channel_mutations = []
+    removed = 0
+    for channel in guild.text_channels + guild.voice_channels:
+        if channel.name.startswith("ticket-"):
+            continue  # Ticket channels rely on the member's own overwrite
+        overwrites = channel.overwrites
+        kept = {
+            target: overwrite for target, overwrite in overwrites.items()
+            if isinstance(target, discord.Role) or getattr(target, 'type', None) is discord.Role
+        }
+        if len(kept) != len(overwrites):
+            channel_mutations.append(Mutation(f"#{channel.name}", ('channel', channel.id),
+                                              lambda ch=channel, ow=kept: ch.edit(overwrites=ow)))
+            removed += len(overwrites) - len(kept)
+    channel_summary = await mutation_executor.run(channel_mutations, progress=progress_message(ctx, "Removing member overwrites"))
+    summary = (f"Migration complete: {len(member_summary.succeeded)} members given a stage role, "
+               f"{removed} member overwrites removed from {len(channel_summary.succeeded)} channels.")
+    if member_summary.failed:
+        summary += f"\nStage roles: {member_summary.describe()}"
+    if channel_summary.failed:
+        summary += f"\nChannels: {channel_summary.describe()}"
+    await ctx.send(summary[:2000])
+    bot_log(guild, summary)
+
+AUDIT_LIST_LIMIT = 50  # Entries listed per finding in the !audit_teams report
+
+
+class TeamAudit:
+    """Findings of audit_guild_teams for one guild."""
+
+    def __init__(self):
+        self.conference_counts = collections.Counter()  # conference -> members with a team there
+        self.multiple_teams = []  # (member, team role to keep, extra team roles)
+        self.stale_roles = []  # (role, number of holders) of teams dropped from the team list
+        self.unknown_roles = []  # (role, number of holders) among the team roles but never a team
+        self.nickname_mismatch = []  # (member, team role)
+        self.no_team = []  # League Members without a team role
+        self.members = 0
+        self.elapsed = 0.0
+
+    @property
+    def problems(self):
+        return len(self.multiple_teams) + len(self.stale_roles) + len(self.nickname_mismatch) + len(self.no_team)
+
+
+def audit_guild_teams(guild, members):
+    """Check every member's team roles against the catalog in a single pass over members.
+
+    Stale roles are roles named after teams the bot knows were dropped from the team list (a
+    team members were recorded with, or a removal seen by !reload_teams). Other roles sitting
+    inside the block of team roles are only reported, since admins' roles can land there too.
+    The bot's own roles are never either.
+    """
+    start = time.perf_counter()
+    audit = TeamAudit()
+    teams = catalog_for(guild)
+    team_roles = {role.id: role for role in guild.roles if role.name in teams.names}
+    own_roles = {LEAGUE_MEMBER_ROLE, ADMIN_ROLE, MEDIA_ROLE, *STAGE_ROLES}
+    candidates = [role for role in guild.roles if role.id not in team_roles and role.name not in own_roles
+                  and not role.managed and not role.is_default()]
+    former = state_store.former_teams_of(guild.id)
+    stale_ids = {role.id for role in candidates if role.name in former}
+    unknown_ids = set()
+    if team_roles:
+        low = min(role.position for role in team_roles.values())
+        high = max(role.position for role in team_roles.values())
+        unknown_ids = {role.id for role in candidates
+                       if low < role.position < high and role.id not in stale_ids}
+    league_ids = {role.id for role in (get_role(guild, LEAGUE_MEMBER_ROLE), get_role(guild, ONBOARDED_ROLE)) if role}
+    stale_holders = collections.Counter()
+
+    for member in members:
+        if member.bot:
+            continue
+        audit.members += 1
+        role_ids = {role.id for role in member.roles}
+        held = role_ids & team_roles.keys()
+        for role_id in role_ids & (stale_ids | unknown_ids):
+            stale_holders[role_id] += 1
+        if not held:
+            if role_ids & league_ids:
+                audit.no_team.append(member)
+            continue
+        nick = member.nick or member.name
+        if len(held) > 1:
+            roles = sorted((team_roles[role_id] for role_id in held), key=lambda role: role.position)
+            # Keep the team the nickname names, else the one the bot recorded, else the highest
+            recorded = state_store.team_of(guild.id, member.id)
+            matching = [role for role in roles if nickname_matches_team(nick, role.name)]
+            keep = (matching[0] if len(matching) == 1
+                    else next((role for role in roles if role.name == recorded), roles[-1]))
+            audit.multiple_teams.append((member, keep, [role for role in roles if role is not keep]))
+        else:
+            keep = team_roles[held.pop()]
+        audit.conference_counts[teams.by_name[keep.name].conference] += 1
+        if not nickname_matches_team(nick, keep.name):
+            audit.nickname_mismatch.append((member, keep))
+
+    audit.stale_roles = sorted(((guild.get_role(role_id), stale_holders[role_id]) for role_id in stale_ids),
+                               key=lambda item: item[0].name)
+    audit.unknown_roles = sorted(((guild.get_role(role_id), stale_holders[role_id]) for role_id in unknown_ids),
+                                 key=lambda item: item[0].name)
+    audit.elapsed = time.perf_counter() - start
+    return audit
+
+
+def team_audit_fixes(guild, audit):
+    """Mutations repairing an audit: drop extra team roles, reset mismatched nicknames, delete stale roles.
+
+    Unknown roles among the team roles are never deleted.
+    """
+    mutations = []
+    nicknames = nickname_index(guild)
+    for member, keep, extra in audit.multiple_teams:
+        mutations.append(Mutation(f"{member}: remove {', '.join(role.name for role in extra)}",
+                                  ('members', guild.id), lambda m=member, r=extra: m.remove_roles(*r)))
+    for member, team_role in audit.nickname_mismatch:
+        # Same default the nickname modal offers
+        nick = default_nickname(member, team_role.name)
+        if not nicknames.reserve(nick, member.id):
+            continue
+
+        async def set_nick(m=member, nick=nick):
+            try:
+                await m.edit(nick=nick)
+            except Exception:
+                nicknames.release(nick, m.id)
+                raise
+            nicknames.set(m.id, nick)
+        mutations.append(Mutation(f"{member}: nickname -> {nick}", ('members', guild.id), set_nick))
+    for role, _ in audit.stale_roles:
+        mutations.append(Mutation(f"delete role {role.name}", ('roles', guild.id), role.delete))
+    return mutations
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def audit_teams(ctx, *flags):
+    """Check team roles, nicknames and team picks in one pass; --fix repairs what it finds.
+
+    Usage: !audit_teams [--fix]
+    """
+    fix = '--fix' in flags
+    audit = audit_guild_teams(ctx.guild, await guild_members(ctx.guild))
+
+    def listed(lines, items):
+        lines += items[:AUDIT_LIST_LIMIT]
+        if len(items) > AUDIT_LIST_LIMIT:
+            lines.append(f"- ...and {len(items) - AUDIT_LIST_LIMIT} more")
+
+    lines = [f"{conference}: {audit.conference_counts[conference]}" for conference in catalog_for(ctx.guild).conferences]
+    lines.append(f"**Members with more than one team ({len(audit.multiple_teams)})**")
+    listed(lines, [f"- {member.mention}: keeps {keep.name}, extra {', '.join(role.name for role in extra)}"
+                   for member, keep, extra in audit.multiple_teams])
+    lines.append(f"**Team roles not in the team list ({len(audit.stale_roles)})**")
+    listed(lines, [f"- {role.name} ({holders} members)" for role, holders in audit.stale_roles])
+    lines.append(f"**Other roles among the team roles, not deleted by --fix ({len(audit.unknown_roles)})**")
+    listed(lines, [f"- {role.name} ({holders} members)" for role, holders in audit.unknown_roles])
+    lines.append(f"**Nicknames that don't match the team ({len(audit.nickname_mismatch)})**")
+    listed(lines, [f"- {member.mention} ({member.nick or member.name}): {role.name}"
+                   for member, role in audit.nickname_mismatch])
+    lines.append(f"**League Members without a team ({len(audit.no_team)})**")
+    listed(lines, [f"- {member.mention}" for member in audit.no_team])
+    header = (f"Team audit of {audit.members} members in {audit.elapsed * 1000:.0f}ms: "
+              f"{audit.problems} problems. Members per conference:")
+    await send_chunked(ctx, lines, header=header)
+    if not fix or not audit.problems:
+        return
+
+    mutations = team_audit_fixes(ctx.guild, audit)
+    summary = await mutation_executor.run(mutations, progress=progress_message(ctx, "Fixing team audit"))
+    # Members without a team get the team picker again through the onboarding queue
+    queued = 0
+    for member in audit.no_team:
+        if await onboarding_queue.enqueue(ctx.guild.id, member.id, 'rules'):
+            queued += 1
+    result = f"Team audit fixes: {summary.describe()}; team picker re-sent to {queued} members."
+    bot_log(ctx.guild, result)
+    await ctx.send(result.split("\n")[0])
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def who_picked(ctx, *, team: str):
+    """List members who picked a team. Usage: !who_picked Alabama"""
+    query = team.strip().casefold()
+    team_names = catalog_for(ctx.guild).names
+    matches = [name for name in team_names if name.casefold() == query]
+    if not matches:
+        matches = sorted(name for name in team_names if query in name.casefold())
+    if len(matches) != 1:
+        if matches:
+            await ctx.send(f"'{team}' matches several teams: {', '.join(matches[:10])}. Please be more specific.")
+        else:
+            await ctx.send(f"No team matches '{team}'.")
+        return
+    member_ids = state_store.members_with_team(ctx.guild.id, matches[0])
+    if not member_ids:
+        await ctx.send(f"Nobody has picked {matches[0]}.")
+        return
+    mentions = [f"<@{member_id}>" for member_id in sorted(member_ids)]
+    await send_chunked(ctx, [", ".join(mentions)], header=f"{len(mentions)} members picked {matches[0]}:")
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def onboarding_status(ctx):
+    """Show the onboarding queue depth and processing lag."""
+    q = onboarding_queue
+    await ctx.send(
+        f"Onboarding queue: {q.depth(ctx.guild.id)} waiting here ({q.depth()} in all servers), "
+        f"oldest waiting {q.lag(ctx.guild.id):.1f}s, last job waited {q.last_lag:.1f}s.\n"
+        f"Processed {q.processed}, failed {q.failed}, rejected (queue full) {q.rejected}; "
+        f"{q.workers} workers, {q.per_guild_concurrency} at a time per server."
+    )
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    """Show handler latency, REST calls per route and 429 counts since the bot started."""
+    uptime = time.time() - metrics.started
+    total_calls = sum(metrics.api_calls.values())
+    total_429s = sum(metrics.api_429s.values())
+    rss = resident_memory()
+    lines = [
+        f"Up {uptime / 3600:.1f}h{f', {rss / 2**20:.0f}MB resident' if rss else ''}"
+        f"{' (low-memory mode)' if LOW_MEMORY_MODE else ''}. REST calls: {total_calls}, 429s: {total_429s}, "
+        f"parked routes: {sum(metrics.parked.values())}, retries: {sum(metrics.retries.values())}. Onboarding queue: {onboarding_queue.depth()} "
+        f"waiting, oldest {onboarding_queue.lag():.1f}s.",
+        "**Slowest handlers** (by total time): count, p50, p95, max, errors",
+    ]
+    by_total = sorted(metrics.latency.items(), key=lambda item: item[1].total, reverse=True)
+    for name, hist in by_total[:15]:
+        lines.append(f"`{name}` {hist.count}, {hist.quantile(0.5) * 1000:.0f}ms, "
+                     f"{hist.quantile(0.95) * 1000:.0f}ms, {hist.max * 1000:.0f}ms, {hist.errors}")
+    lines.append("**Busiest routes**: calls, 429s")
+    for (method, route), n in metrics.api_calls.most_common(15):
+        lines.append(f"`{method} {route}` {n}, {metrics.api_429s[(method, route)]}")
+    await send_chunked(ctx, lines)
 
 # Admin command to close a ticket
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def close_ticket(ctx, member: discord.Member):
-    """Close a user's ticket channel. Usage: !close_ticket @user"""
-    ticket_channel_name = f"ticket-{member.id}"
-    ticket_channel = discord.utils.get(ctx.guild.text_channels, name=ticket_channel_name)
-    if not ticket_channel:
+    """Close a user's ticket thread. Usage: !close_ticket @user"""
+    if not await ticket_desk.close(ctx.guild, member.id):
         await ctx.send(f"No open ticket found for {member.mention}.")
         return
-    await ticket_channel.delete()
     await ctx.send(f"Ticket for {member.mention} has been closed.")
 
-# Helper: Create a ticket channel for a user and notify admins
-async def create_ticket(guild, user, error_message):
-    ticket_channel_name = f"ticket-{user.id}"
-    # Check if ticket already exists
-    existing = discord.utils.get(guild.text_channels, name=ticket_channel_name)
-    if existing:
-        await existing.send(f"Another error occurred: {error_message}")
-        return existing
-    # Create channel, only user and admins can see
-    overwrites = {
-        guild.default_role: discord.PermissionOverwrite(view_channel=False),
-        user: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_messages=True)
-    }
-    admin_role = discord.utils.get(guild.roles, name=ADMIN_ROLE)
-    if admin_role:
-        overwrites[admin_role] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_messages=True)
-    ticket_channel = await guild.create_text_channel(ticket_channel_name, overwrites=overwrites, topic=f"Support ticket for {user.display_name}")
-    await ticket_channel.send(f"Hello {user.mention}, a ticket has been created for your error:\n> {error_message}\nAn admin will assist you here.")
-    return ticket_channel
-# To run the bot, uncomment and add your token:
-bot.run('')
+
+class TicketUpdate:
+    """One error posted to a ticket, and the repeats merged into it."""
+    __slots__ = ('thread', 'message', 'key', 'started', 'repeats', 'members', 'flush')
+
+    def __init__(self, thread, message, key, member_id):
+        self.thread = thread
+        self.message = message
+        self.key = key
+        self.started = time.monotonic()
+        self.repeats = 0
+        self.members = [member_id]
+        self.flush = None
+
+
+class TicketDesk:
+    """Support tickets as private threads under each server's support channel.
+
+    The member -> thread index is state_store.tickets (rebuilt from the open threads on startup),
+    so finding a member's ticket never scans channels. An error with the same signature (see
+    error_signature) as one posted less than merge_window seconds ago is merged into that post:
+    other members who hit it are added to the same thread, and the post is edited once at the
+    end of the window with the repeat count.
+    """
+
+    def __init__(self, merge_window=TICKET_MERGE_WINDOW):
+        self.merge_window = merge_window
+        self._recent = {}  # (guild id, error signature) -> TicketUpdate
+        self._locks = collections.defaultdict(asyncio.Lock)  # guild id -> lock
+
+    def thread_for(self, guild, member_id):
+        """The member's open ticket thread (or pre-thread ticket channel), or None."""
+        channel_id = state_store.ticket_channel(guild.id, member_id)
+        return guild.get_channel_or_thread(channel_id) if channel_id else None
+
+    async def open(self, guild, user, error_message, signature=None):
+        """Report an error in the user's ticket, opening one if needed. Returns the thread, or None.
+
+        error_message is what the post says; errors merge on signature (the message if None).
+        """
+        key = (guild.id, error_message if signature is None else signature)
+        # One guild at a time, so a burst of identical errors can't open several threads
+        async with self._locks[guild.id]:
+            now = time.monotonic()
+            # Errors that were never repeated have nothing to flush; forget them once their window ends
+            for old in [k for k, u in self._recent.items() if u.flush is None and now - u.started >= self.merge_window]:
+                del self._recent[old]
+            update = self._recent.get(key)
+            if update and now - update.started < self.merge_window:
+                await self._merge(guild, update, user)
+                return update.thread
+            thread = self.thread_for(guild, user.id)
+            if thread:
+                message = await thread.send(f"Another error occurred: {error_message}")
+            else:
+                support = get_text_channel(guild, guild_config(guild).support_channel)
+                if support is None:
+                    bot_log(guild, f"No #{guild_config(guild).support_channel} channel, could not open a ticket "
+                                   f"for {user.mention}: {error_message}", severe=True)
+                    return None
+                thread = await support.create_thread(name=f"ticket-{user.id}", type=discord.ChannelType.private_thread,
+                                                     invitable=False)
+                await thread.add_user(user)
+                await state_store.set_ticket(guild.id, user.id, thread.id)
+                message = await thread.send(f"Hello {user.mention}, a ticket has been created for your error:\n"
+                                            f"> {error_message}\nAn admin will assist you here.")
+                bot_log(guild, f"Opened ticket {thread.mention} for {user.mention}.")
+            self._recent[key] = TicketUpdate(thread, message, key, user.id)
+            return thread
+
+    async def _merge(self, guild, update, user):
+        update.repeats += 1
+        if user.id not in update.members:
+            update.members.append(user.id)
+            if not self.thread_for(guild, user.id):
+                await update.thread.add_user(user)
+                await state_store.set_ticket(guild.id, user.id, update.thread.id)
+        if update.flush is None:
+            update.flush = asyncio.create_task(self._flush(update))
+
+    async def _flush(self, update):
+        # One edit per window, however many repeats there were
+        await asyncio.sleep(max(0.0, update.started + self.merge_window - time.monotonic()))
+        affected = update.members[1:]
+        note = f"Repeated {update.repeats} more times"
+        if affected:
+            note += ", also for " + ", ".join(f"<@{member_id}>" for member_id in affected)
+        try:
+            await update.message.edit(content=f"{update.message.content}\n({note}.)")
+        except discord.HTTPException:
+            pass
+        if self._recent.get(update.key) is update:
+            del self._recent[update.key]
+
+    async def close(self, guild, member_id):
+        """Archive and lock a member's ticket thread. False if they have no open ticket."""
+        thread = self.thread_for(guild, member_id)
+        if thread is None:
+            return False
+        if isinstance(thread, discord.Thread):
+            await thread.edit(archived=True, locked=True)
+        else:
+            await thread.delete()  # A ticket channel from before ticket threads
+        # Everyone merged into the same thread shares the ticket
+        for key, channel_id in list(state_store.tickets.items()):
+            if key[0] == guild.id and channel_id == thread.id:
+                await state_store.set_ticket(guild.id, key[1], None)
+        return True
+
+
+ticket_desk = TicketDesk()
+
+
+def error_signature(kind, team, error):
+    """What makes a failure the same for every member: the change, its team and the Discord error."""
+    return (kind, team, type(error).__name__, getattr(error, 'code', None), getattr(error, 'status', None))
+
+
+# Helper: Open or update a user's support ticket
+async def create_ticket(guild, user, error_message, signature=None):
+    return await ticket_desk.open(guild, user, error_message, signature)
+# To run the bot, add your token:
+if __name__ == '__main__':
+    bot.run('')